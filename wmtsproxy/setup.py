@@ -12,6 +12,14 @@ setup(name='wmtsproxy',
       install_requires=[
         "PyYAML",
         "requests",
-        "mapproxy>=1.7.0",
-      ]
+        "mapproxy>=1.12.0",
+      ],
+      entry_points={
+        'console_scripts': [
+            'wmtsproxy-cache-gc = wmtsproxy.cache_gc:main',
+            'wmtsproxy-seed = wmtsproxy.seed:main',
+            'wmtsproxy-refresh = wmtsproxy.refresh:main',
+            'wmtsproxy-loadtest = wmtsproxy.loadtest:main',
+        ],
+      },
 )
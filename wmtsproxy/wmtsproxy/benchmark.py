@@ -0,0 +1,73 @@
+"""
+Benchmark of the grid calculation of WMTS sources.
+
+Compares the NumPy implementation of `grid.make_mapproxy_grid` with the
+loop over all TileMatrices for each TileMatrixSet of a capabilities
+document::
+
+    python -m wmtsproxy.benchmark --number 1000 WMTSCapabilities.xml
+"""
+
+from __future__ import absolute_import
+
+import sys
+import timeit
+import optparse
+
+from . import grid
+from .wmtsparse import parse_capabilities, TileMatrixSet
+
+def grid_benchmark(tile_matrix_sets, number=1000, repeat=3):
+    """
+    Return list of (id, levels, loop_seconds, numpy_seconds) with the best
+    time of `number` grid calculations for each of the `tile_matrix_sets`.
+    numpy_seconds is None if NumPy is not installed.
+    """
+    results = []
+    for tile_matrix_set in tile_matrix_sets:
+        loop = min(timeit.repeat(lambda: grid._make_mapproxy_grid(tile_matrix_set),
+            number=number, repeat=repeat))
+        vectorized = None
+        if grid.numpy is not None:
+            vectorized = min(timeit.repeat(lambda: grid._make_mapproxy_grid_numpy(tile_matrix_set),
+                number=number, repeat=repeat))
+        results.append((tile_matrix_set['id'], len(tile_matrix_set.ids), loop, vectorized))
+    return results
+
+def synthetic_matrix_set(levels):
+    """
+    Return a TileMatrixSet with `levels` EPSG:4326 TileMatrices.
+    """
+    tile_matrix_set = TileMatrixSet('levels_%d' % levels, 'urn:ogc:def:crs:EPSG::4326')
+    for level in range(levels):
+        tile_matrix_set.append(str(level), (90.0, -180.0), (256, 256),
+            (2 ** min(level + 1, 30), 2 ** min(level, 30)), 2.795411320143589E8 / 2 ** level)
+    return tile_matrix_set
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] [capabilities.xml ...]')
+    parser.add_option('--number', type='int', default=1000,
+        help='number of grid calculations for each TileMatrixSet')
+    parser.add_option('--levels', type='int', action='append', default=[],
+        help='add synthetic TileMatrixSet with LEVELS TileMatrices, can be repeated')
+
+    options, args = parser.parse_args(argv)
+    if not args and not options.levels:
+        parser.error('missing capabilities or --levels')
+
+    tile_matrix_sets = []
+    for filename in args:
+        cap = parse_capabilities(filename)
+        tile_matrix_sets.extend(tms for _, tms in sorted(cap.matrix_sets.items()))
+    tile_matrix_sets.extend(synthetic_matrix_set(levels) for levels in options.levels)
+
+    print '%-30s %6s %10s %10s %8s' % ('TileMatrixSet', 'levels', 'loop', 'numpy', 'speedup')
+    for id, levels, loop, vectorized in grid_benchmark(tile_matrix_sets, options.number):
+        if vectorized is None:
+            print '%-30s %6d %9.3fs %10s %8s' % (id, levels, loop, '-', '-')
+        else:
+            print '%-30s %6d %9.3fs %9.3fs %7.1fx' % (id, levels, loop, vectorized, loop / vectorized)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,325 @@
+"""
+Garbage collection of orphaned tile caches.
+
+Each (re-)added layer gets new timestamped cache names (see
+`config_writer.cache_suffix`). Cache directories of older registrations
+are never referenced again. The collector compares the cache directories
+on disk with the cache names of the current CSV records and removes the
+unreferenced ones.
+
+Shared upstream caches (see `config_writer.shared_tmpcache_name`) are only
+collected if the directory of the generated configurations is known.
+Configurations of older versions used a ``<id>_<timestamp>_tmpcache`` for
+each layer. These caches are kept, unless the generated configurations
+show that they are not used anymore.
+
+The collector also expires cached empty tiles (see `negative_cache` of
+`config_writer.mapproxy_conf_from_wmts_capabilities`).
+"""
+
+from __future__ import absolute_import
+
+import os
+import re
+import sys
+import time
+import threading
+import optparse
+
+import yaml
+
+import logging
+
+from .csv import read_csv
+from .config_writer import record_cache_names, cache_base_dir, config_filename
+
+log = logging.getLogger(__name__)
+
+# MapProxy file caches are stored in <cache_name>_<grid_name>
+cache_dir_re = re.compile(r'_(\d+_)?(tmp)?cache_[^/]+$')
+shared_cache_dir_re = re.compile(r'^src_[0-9a-f]+_tmpcache_')
+
+def is_cache_dir(name):
+    """
+    >>> is_cache_dir('foo_1400000000_cache_webmercator')
+    True
+    >>> is_cache_dir('foo_tmpcache_EPSG4326_1km')
+    True
+    >>> is_cache_dir('tile_locks')
+    False
+    """
+    return bool(cache_dir_re.search(name))
+
+def legacy_tmpcache_names(rec):
+    """
+    Return the names of the intermediate caches of `rec` that were used
+    before upstream caches were shared.
+
+    >>> from .csv import record
+    >>> legacy_tmpcache_names(record('foo', 'wmts', '', 'foo', 'EPSG4326', '', 1400000100.5, ''))
+    ['foo_1400000100_tmpcache']
+    """
+    return [name[:-len('_cache')] + '_tmpcache' for name in record_cache_names(rec)]
+
+def live_cache_names(csv_file, configs_path=None, sharded=False):
+    """
+    Return the set of all cache names referenced by the records in `csv_file`.
+    Also includes the caches from the generated configurations in
+    `configs_path` of these records. Legacy intermediate caches are
+    included if `configs_path` is None.
+    """
+    names = set()
+    for id, rec in read_csv(csv_file).iteritems():
+        names.update(record_cache_names(rec))
+        if configs_path is None:
+            names.update(legacy_tmpcache_names(rec))
+            continue
+        conf_file = config_filename(configs_path, id, sharded=sharded)
+        if not os.path.exists(conf_file):
+            continue
+        with open(conf_file, 'rb') as f:
+            conf = yaml.safe_load(f) or {}
+        names.update((conf.get('caches') or {}).keys())
+    return names
+
+def dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+def orphaned_cache_dirs(cache_dir, live_names, include_shared=False):
+    """
+    Return all cache directories in `cache_dir` that do not belong to one of
+    the `live_names` caches. Shared upstream caches are only returned if
+    `include_shared` is True.
+    """
+    orphaned = []
+    if not os.path.isdir(cache_dir):
+        return orphaned
+    for name in sorted(os.listdir(cache_dir)):
+        path = os.path.join(cache_dir, name)
+        if not os.path.isdir(path) or not is_cache_dir(name):
+            continue
+        if not include_shared and shared_cache_dir_re.match(name):
+            continue
+        if any(name.startswith(live_name + '_') for live_name in live_names):
+            continue
+        orphaned.append(path)
+    return orphaned
+
+
+# MapProxy stores single color tiles as links to single_color_tiles/<rgba>.<ext>,
+# empty tiles are transparent
+empty_tile_link_re = re.compile(r'single_color_tiles/[0-9a-f]{6}00\.\w+$')
+
+def expire_empty_tiles(cache_dir, ttl):
+    """
+    Remove links to empty tiles that are older than `ttl` seconds from all
+    caches in `cache_dir`. Returns the number of removed links.
+    """
+    if not os.path.isdir(cache_dir):
+        return 0
+    removed = 0
+    expire_before = time.time() - ttl
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not os.path.isdir(path) or not is_cache_dir(name):
+            continue
+        for root, dirs, files in os.walk(path):
+            for filename in files:
+                filename = os.path.join(root, filename)
+                try:
+                    if not os.path.islink(filename):
+                        continue
+                    if not empty_tile_link_re.search(os.readlink(filename)):
+                        continue
+                    if os.lstat(filename).st_mtime < expire_before:
+                        os.unlink(filename)
+                        removed += 1
+                except OSError:
+                    pass
+    return removed
+
+
+class RateLimiter(object):
+    """
+    Limits removal to `max_bytes` per second. Unlimited if `max_bytes` is None.
+    """
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.start = time.time()
+        self.consumed = 0
+
+    def consume(self, nbytes):
+        if not self.max_bytes:
+            return
+        self.consumed += nbytes
+        expected = self.consumed / float(self.max_bytes)
+        elapsed = time.time() - self.start
+        if expected > elapsed:
+            time.sleep(expected - elapsed)
+
+
+def remove_tree(path, limiter):
+    """
+    Remove `path` file by file and throttle by size of the removed files.
+    Returns the number of removed bytes.
+    """
+    removed = 0
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            filename = os.path.join(root, name)
+            try:
+                size = os.lstat(filename).st_size
+                os.unlink(filename)
+            except OSError as ex:
+                log.warn('unable to remove %s: %s', filename, ex)
+                continue
+            removed += size
+            limiter.consume(size)
+        for name in dirs:
+            dirname = os.path.join(root, name)
+            try:
+                if os.path.islink(dirname):
+                    os.unlink(dirname)
+                else:
+                    os.rmdir(dirname)
+            except OSError as ex:
+                log.warn('unable to remove %s: %s', dirname, ex)
+    try:
+        os.rmdir(path)
+    except OSError as ex:
+        log.warn('unable to remove %s: %s', path, ex)
+    return removed
+
+
+class CacheCollector(object):
+    """
+    Removes cache directories in `cache_dir` that are not referenced by
+    any record of `csv_file`. Shared upstream caches are only removed if
+    `configs_path` is set.
+
+    `max_bytes_per_sec` limits the I/O of the removal. Cached empty tiles
+    are removed after `empty_tile_ttl` seconds, if set.
+    """
+    def __init__(self, cache_dir, csv_file, configs_path=None, max_bytes_per_sec=None,
+        empty_tile_ttl=None, sharded=False):
+        self.cache_dir = cache_dir
+        self.csv_file = csv_file
+        self.configs_path = configs_path
+        self.sharded = sharded
+        self.empty_tile_ttl = empty_tile_ttl
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self._stop = threading.Event()
+
+    def report(self):
+        """
+        Return list of (path, size) tuples of all orphaned cache directories.
+        """
+        return [(path, dir_size(path)) for path in self._orphaned_cache_dirs()]
+
+    def collect(self, dry_run=False):
+        """
+        Remove all orphaned cache directories and return the number of
+        reclaimed bytes. Only calculates the reclaimable bytes if `dry_run`
+        is True.
+        """
+        limiter = RateLimiter(self.max_bytes_per_sec)
+        reclaimed = 0
+        for path in self._orphaned_cache_dirs():
+            if self._stop.is_set():
+                break
+            if dry_run:
+                reclaimed += dir_size(path)
+            else:
+                log.info('removing orphaned cache %s', path)
+                reclaimed += remove_tree(path, limiter)
+        return reclaimed
+
+    def _orphaned_cache_dirs(self):
+        live_names = live_cache_names(self.csv_file, self.configs_path, self.sharded)
+        return orphaned_cache_dirs(self.cache_dir, live_names,
+            include_shared=self.configs_path is not None)
+
+    def run(self, interval):
+        while not self._stop.is_set():
+            try:
+                reclaimed = self.collect()
+                log.info('reclaimed %d bytes from orphaned caches', reclaimed)
+                if self.empty_tile_ttl:
+                    expired = expire_empty_tiles(self.cache_dir, self.empty_tile_ttl)
+                    log.info('expired %d empty tiles', expired)
+            except Exception as ex:
+                log.exception(ex)
+            self._stop.wait(interval)
+
+    def start(self, interval=3600):
+        """
+        Collect orphaned caches every `interval` seconds in a background thread.
+        """
+        t = threading.Thread(target=self.run, args=(interval, ))
+        t.daemon = True
+        t.start()
+        return t
+
+    def stop(self):
+        self._stop.set()
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] csv_file')
+    parser.add_option('--cache-dir', help='MapProxy cache directory')
+    parser.add_option('--base-file', help='MapProxy base configuration, to determine cache directory')
+    parser.add_option('--configs-path', help='directory of generated configurations, required to remove shared caches')
+    parser.add_option('--sharded', action='store_true', default=False,
+        help='configurations in configs path are sharded')
+    parser.add_option('--dry-run', action='store_true', default=False,
+        help='only report orphaned caches')
+    parser.add_option('--max-mb-per-sec', type='float', default=None,
+        help='limit removal to this many MB per second')
+    parser.add_option('--interval', type='int', default=None,
+        help='run as daemon and collect every INTERVAL seconds')
+    parser.add_option('--empty-tile-ttl', type='int', default=None,
+        help='remove cached empty tiles after EMPTY_TILE_TTL seconds')
+
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('missing csv_file')
+
+    cache_dir = options.cache_dir
+    if cache_dir is None:
+        if not (options.base_file and options.configs_path):
+            parser.error('requires --cache-dir or --base-file and --configs-path')
+        cache_dir = cache_base_dir(options.base_file, options.configs_path)
+
+    logging.basicConfig(level=logging.INFO)
+
+    max_bytes = None
+    if options.max_mb_per_sec:
+        max_bytes = options.max_mb_per_sec * 1024 * 1024
+    collector = CacheCollector(cache_dir, args[0], configs_path=options.configs_path,
+        max_bytes_per_sec=max_bytes, empty_tile_ttl=options.empty_tile_ttl, sharded=options.sharded)
+
+    if options.dry_run:
+        total = 0
+        for path, size in collector.report():
+            print '%12d %s' % (size, path)
+            total += size
+        print '%12d bytes reclaimable' % total
+        return 0
+
+    if options.interval:
+        collector.run(options.interval)
+    else:
+        print '%d bytes reclaimed' % collector.collect()
+        if options.empty_tile_ttl:
+            print '%d empty tiles expired' % expire_empty_tiles(cache_dir, options.empty_tile_ttl)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,228 @@
+"""
+HTTP cache headers of served tiles.
+
+MapProxy sets the Cache-Control max-age of tiles to the
+``globals.tiles.expires_hours`` option, with a default of 72 hours.
+Records with the ``expires_hours`` option, or the ``expires_hours``
+writer option, set this value in the generated configuration.
+Configurations without either option use the value of the base file.
+
+The ETag of MapProxy is built from the timestamp of the stored tile.
+New tiles have no timestamp, so all new tiles get the same ETag and no
+Last-Modified header. Stored tiles compare Last-Modified with sub-second
+file timestamps and only match unquoted ETags. Clients would receive
+each tile again when they revalidate it. `ConditionalTileApp` sets
+Last-Modified instead of the ETag for new tiles and answers conditional
+requests for stored tiles with 304 Not Modified.
+"""
+
+from __future__ import absolute_import
+
+import time
+
+from itertools import chain
+from urlparse import parse_qsl
+
+from mapproxy.util.times import parse_httpdate, format_httpdate
+
+from .exceptions import UserError
+
+# one year, longest max-age allowed by RFC 2616
+MAX_EXPIRES_HOURS = 365 * 24
+
+def parse_expires_hours(value):
+    """
+    Return `value` as number of hours for the Cache-Control max-age of
+    tiles. 0 requires clients to revalidate each tile.
+
+    >>> parse_expires_hours('24')
+    24
+    >>> parse_expires_hours('0.5')
+    0.5
+    """
+    try:
+        hours = float(value)
+    except (TypeError, ValueError):
+        raise UserError('Invalid expires_hours "%s"' % value)
+    if not 0 <= hours <= MAX_EXPIRES_HOURS:
+        raise UserError('Invalid expires_hours "%s"' % value)
+    if hours == int(hours):
+        return int(hours)
+    return hours
+
+def tile_expires_hours(options, writer_options=None):
+    """
+    Return the ``expires_hours`` of a record with `options`, or None if
+    neither the record nor the `writer_options` set a value.
+
+    >>> tile_expires_hours({'expires_hours': '1'}, {'expires_hours': 24})
+    1
+    >>> tile_expires_hours({}, {'expires_hours': 24})
+    24
+    >>> tile_expires_hours({}) is None
+    True
+    """
+    value = options.get('expires_hours')
+    if value in (None, ''):
+        value = (writer_options or {}).get('expires_hours')
+    if value in (None, ''):
+        return None
+    return parse_expires_hours(value)
+
+def cache_headers_globals(mapproxy_conf, expires_hours):
+    """
+    Set ``expires_hours`` in the globals of `mapproxy_conf`.
+
+    >>> cache_headers_globals({'globals': {}}, 24)
+    {'globals': {'tiles': {'expires_hours': 24}}}
+    """
+    if expires_hours is not None:
+        mapproxy_conf['globals'].setdefault('tiles', {})['expires_hours'] = expires_hours
+    return mapproxy_conf
+
+
+def etag_matches(etag, if_none_match):
+    """
+    Return True if `etag` is in the list of the If-None-Match header.
+    Weak and unquoted ETags are also compared.
+
+    >>> etag_matches('"abc"', 'W/"abc", "def"')
+    True
+    >>> etag_matches('"abc"', 'abc')
+    True
+    >>> etag_matches('"abc"', '"def"')
+    False
+    """
+    if if_none_match.strip() == '*':
+        return True
+    etag = etag.strip('"')
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag.strip('"') == etag:
+            return True
+    return False
+
+def not_modified(environ, etag, last_modified):
+    """
+    Return True if the conditional request of `environ` matches the
+    `etag` or `last_modified` (HTTP date) of the response.
+    If-Modified-Since is ignored if the request has an If-None-Match
+    header (RFC 7232).
+    """
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        return etag_matches(etag, if_none_match)
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified:
+        since = parse_httpdate(if_modified_since)
+        modified = parse_httpdate(last_modified)
+        return since is not None and modified is not None and modified <= since
+    return False
+
+class ConditionalTileApp(object):
+    """
+    Wraps the WSGI app of a MapProxy configuration. Sets Last-Modified
+    for new tiles and answers conditional requests for stored tiles with
+    304 Not Modified. Responses are not buffered. Other requests are
+    passed to the app unchanged.
+    """
+    # headers of 304 responses, see RFC 7232 4.1
+    not_modified_headers = frozenset(['cache-control', 'etag', 'expires', 'last-modified', 'vary',
+        'access-control-allow-origin'])
+
+    def __init__(self, app):
+        self.app = app
+
+    def __getattr__(self, name):
+        return getattr(self.app, name)
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD', 'GET') not in ('GET', 'HEAD') or not is_tile_request(environ):
+            return self.app(environ, start_response)
+
+        response = []
+        written = []
+        def capture_response(status, headers, exc_info=None):
+            # delay start_response till the headers of a tile are checked,
+            # data of the write callable is sent before the body
+            response[:] = [(status, headers, exc_info)]
+            return written.append
+
+        result = self.app(environ, capture_response)
+        if not response:
+            # app calls start_response with the first part of the body
+            try:
+                result = list(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        status, headers, exc_info = response[0]
+
+        if is_tile_response(status, headers):
+            headers = dict((key.lower(), (key, value)) for key, value in headers)
+            if 'last-modified' not in headers:
+                # ETag of new tiles is not valid for the stored tile, the
+                # stored tile is not modified after this time
+                headers.pop('etag', None)
+                headers['last-modified'] = ('Last-modified', format_httpdate(time.time()))
+            elif not_modified(environ, headers.get('etag', (None, ''))[1], headers['last-modified'][1]):
+                if hasattr(result, 'close'):
+                    result.close()
+                start_response('304 Not Modified', [header for key, header in headers.items()
+                    if key in self.not_modified_headers])
+                return []
+            headers = headers.values()
+
+        start_response(status, headers, exc_info)
+        if written:
+            return PrependedBody(written, result)
+        return result
+
+class PrependedBody(object):
+    """
+    Response body with the `data` of the write callable before the
+    `result` of the app.
+    """
+    def __init__(self, data, result):
+        self.data = data
+        self.result = result
+
+    def __iter__(self):
+        return chain(self.data, self.result)
+
+    def close(self):
+        if hasattr(self.result, 'close'):
+            self.result.close()
+
+# first part of the PATH_INFO of tile services
+tile_services = frozenset(['wmts', 'tiles', 'tms'])
+
+def is_tile_request(environ):
+    """
+    Return True for requests of the WMTS or tile services of a MapProxy
+    app, including KVP GetTile requests.
+
+    >>> is_tile_request({'PATH_INFO': '/wmts/map/webmercator/2/1/1.png'})
+    True
+    >>> is_tile_request({'PATH_INFO': '/service', 'QUERY_STRING': 'SERVICE=WMTS&REQUEST=GetTile'})
+    True
+    >>> is_tile_request({'PATH_INFO': '/service', 'QUERY_STRING': 'SERVICE=WMS&REQUEST=GetMap'})
+    False
+    """
+    path = environ.get('PATH_INFO', '').lstrip('/')
+    if path.split('/', 1)[0] in tile_services:
+        return True
+    for key, value in parse_qsl(environ.get('QUERY_STRING', '')):
+        if key.lower() == 'request':
+            return value.lower() == 'gettile'
+    return False
+
+def is_tile_response(status, headers):
+    if not status.startswith('200'):
+        return False
+    for key, value in headers:
+        if key.lower() == 'content-type':
+            return value.startswith('image/')
+    return False
@@ -2,6 +2,11 @@ from __future__ import absolute_import
 
 import requests
 import sys
+import time
+import weakref
+import threading
+
+from collections import OrderedDict
 
 from cStringIO import StringIO
 
@@ -11,8 +16,12 @@ from mapproxy.grid import tile_grid
 
 from . import csv
 from .wmtsparse import parse_capabilities as parse_wmts_capabilities, WMTSCapabilities
-from .exceptions import CapabilitiesError, UserError, FeatureError, ServiceError
+from .exceptions import CapabilitiesError, UserError, FeatureError, ServiceError, ConfigWriterError
 from .utils import is_supported_srs
+from .grid import output_grid_names, NATIVE_GRID
+from .dimensions import DIMENSION_MODES, mapproxy_dimensions
+from .formats import cache_image_options, format_options
+from .cache_headers import parse_expires_hours
 
 
 webmercator_grid = tile_grid(3857, origin='nw')
@@ -56,17 +65,85 @@ def request_capabilities(cap_url):
 
     return StringIO(response.content)
 
-def cap_dict(cap_url):
-    cap = parsed_capabilities(cap_url)
+class CapabilitiesCache(object):
+    """
+    Cache for the `max_docs` most recently used parsed capabilities.
+    Documents are requested again after `ttl` seconds.
+    """
+    def __init__(self, max_docs=32, ttl=300):
+        self.max_docs = max_docs
+        self.ttl = ttl
+        self._docs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cap_url, load=None):
+        with self._lock:
+            entry = self._docs.pop(cap_url, None)
+            if entry is not None and entry[0] + self.ttl > time.time():
+                self._docs[cap_url] = entry
+                return entry[1]
+
+        cap = (load or parsed_capabilities)(cap_url)
+
+        with self._lock:
+            self._docs[cap_url] = (time.time(), cap)
+            while len(self._docs) > self.max_docs:
+                self._docs.popitem(last=False)
+        return cap
+
+    def clear(self):
+        with self._lock:
+            self._docs.clear()
+
+capabilities_cache = CapabilitiesCache()
+
+def cap_dict(cap_url, layer_name=None, offset=0, limit=None, query=None, fields=None, lazy=False):
+    """
+    Return dict with the layers of the capabilities. Returns only the layer
+    `layer_name` and its sub-layers for WMS capabilities.
+
+    See `page_layers` for `offset`, `limit`, `query`, `fields` and `lazy`.
+    Capabilities are cached, so that the following pages are returned
+    without requesting and parsing the document again.
+    """
+    cap = capabilities_cache.get(cap_url)
     if isinstance(cap, WMTSCapabilities):
-        return wmts_cap_dict(cap)
-    return wms_cap_dict(cap)
+        return wmts_cap_dict(cap, offset=offset, limit=limit, query=query, fields=fields, lazy=lazy)
+    return wms_cap_dict(cap, layer_name, offset=offset, limit=limit, query=query, fields=fields, lazy=lazy)
 
-def wmts_cap_dict(cap):
-    cap_layers = cap.layers.items()
+def page_layers(layers, layer_dict, offset=0, limit=None, query=None, fields=None, lazy=False):
+    """
+    Return (total, page) for the (name, title, layer) tuples of `layers`.
 
-    layers = []
-    for layer_name, layer in cap_layers:
+    `total` is the number of all layers where the name or title contains
+    `query` (case insensitive). `page` contains the dicts of these layers
+    from `offset` to `offset` + `limit`, as returned by `layer_dict`.
+    Only the keys in `fields` are returned, if set. `page` is a generator
+    that creates the dicts on demand if `lazy` is True.
+    """
+    if query:
+        query = query.lower()
+        layers = [l for l in layers if query in (l[0] or '').lower() or query in (l[1] or '').lower()]
+    total = len(layers)
+    if limit is not None:
+        layers = layers[offset:offset + limit]
+    else:
+        layers = layers[offset:]
+
+    def iter_page():
+        for layer in layers:
+            layer_obj = layer_dict(layer[2])
+            if fields:
+                layer_obj = dict((k, v) for k, v in layer_obj.iteritems() if k in fields)
+            yield layer_obj
+
+    if lazy:
+        return total, iter_page()
+    return total, list(iter_page())
+
+def wmts_cap_dict(cap, offset=0, limit=None, query=None, fields=None, lazy=False):
+    def layer_dict(layer_name):
+        layer = cap.layers[layer_name]
         layer_obj = {
             'name': layer_name,
             'title': layer['title'],
@@ -78,11 +155,16 @@ def wmts_cap_dict(cap):
             layer_obj['dimensions'] = dimension
         if 'url_template' in layer:
             layer_obj['url_template'] = layer['url_template']
-        layers.append(layer_obj)
+        return layer_obj
+
+    # sorted by name, for stable pages
+    cap_layers = [(name, layer['title'], name) for name, layer in sorted(cap.layers.items())]
+    total, layers = page_layers(cap_layers, layer_dict, offset, limit, query, fields, lazy)
     return {
         'type': 'wmts',
         'title': cap.service['title'],
         'layers': layers,
+        'total': total,
     }
 
 def wmts_layer_dimensions(layer):
@@ -95,6 +177,71 @@ def wmts_layer_dimensions(layer):
     return dimensions
 
 
+class WMSLayerIndex(object):
+    """
+    Name index of all named layers of parsed WMS capabilities.
+    Duplicate layer names refer to the first layer in the document.
+    """
+    def __init__(self, cap):
+        self._layers = {}
+        self._names = []
+        self._index(cap.layers())
+
+    def _index(self, root_layer):
+        # iterative pre-order traversal, for deeply nested layer trees
+        stack = [root_layer]
+        while stack:
+            layer = stack.pop()
+            name = layer.get('name')
+            if name and name not in self._layers:
+                self._layers[name] = layer
+                self._names.append(name)
+            stack.extend(reversed(layer.get('layers', [])))
+
+    def __contains__(self, name):
+        return name in self._layers
+
+    def get(self, name):
+        return self._layers.get(name)
+
+    def layers_list(self, name=None):
+        """
+        Return list of all named layers in document order, or only of the
+        layer `name` and all its sub-layers.
+        """
+        if name is None:
+            return [self._layers[n] for n in self._names]
+        if name not in self._layers:
+            return []
+        layers = []
+        stack = [self._layers[name]]
+        while stack:
+            layer = stack.pop()
+            if layer.get('name'):
+                layers.append(layer)
+            stack.extend(reversed(layer.get('layers', [])))
+        return layers
+
+# index for each parsed document, removed with the document
+_wms_layer_indexes = weakref.WeakKeyDictionary()
+_wms_layer_indexes_lock = threading.Lock()
+
+def wms_layer_index(cap):
+    """
+    Return the `WMSLayerIndex` of `cap`. The index is built only once
+    for each parsed document.
+    """
+    with _wms_layer_indexes_lock:
+        index = _wms_layer_indexes.get(cap)
+    if index is None:
+        try:
+            index = WMSLayerIndex(cap)
+        except Exception as ex:
+            reraise_exception(CapabilitiesError('not a valid capabilities document', ex.args[0]), sys.exc_info())
+        with _wms_layer_indexes_lock:
+            index = _wms_layer_indexes.setdefault(cap, index)
+    return index
+
 def sorted_srs_list(srs):
     """
     "sort" list of SRS. Moves EPSG:3857, EPSG:900913 and EPSG:4326 to the
@@ -112,37 +259,39 @@ def sorted_srs_list(srs):
         result.insert(0, 'EPSG:3857')
     return result
 
-def wms_cap_dict(cap):
-    try:
-        cap_layers = cap.layers_list()
-    except Exception as ex:
-        reraise_exception(CapabilitiesError('not a valid capabilities document', ex.args[0]), sys.exc_info())
-
-    layers = []
-    for layer in cap_layers:
+def wms_cap_dict(cap, layer_name=None, offset=0, limit=None, query=None, fields=None, lazy=False):
+    def layer_dict(layer):
         srs = []
         for _srs in sorted_srs_list(layer['srs']):
             # don't add unsupported srs
             if not is_supported_srs(_srs):
                 continue
             srs.append(_srs)
-        layers.append({
+        layer_obj = {
             'name': layer['name'],
             'title': layer['title'],
             'srs': srs,
             'llbbox': layer['llbbox'],
-        })
+        }
         if layer['res_hint']:
             min_res, max_res = layer['res_hint']
             if min_res is not None:
-                layers[-1]['min_level'] = webmercator_grid.closest_level(min_res)
+                layer_obj['min_level'] = webmercator_grid.closest_level(min_res)
             if max_res is not None:
-                layers[-1]['max_level'] = webmercator_grid.closest_level(max_res)
+                layer_obj['max_level'] = webmercator_grid.closest_level(max_res)
+        return layer_obj
+
+    index = wms_layer_index(cap)
+    if layer_name is not None and layer_name not in index:
+        raise UserError('Layer "%s" not found in given capabilities document' % layer_name)
+    cap_layers = [(layer['name'], layer['title'], layer) for layer in index.layers_list(layer_name)]
+    total, layers = page_layers(cap_layers, layer_dict, offset, limit, query, fields, lazy)
 
     return {
         'type': 'wms',
         'title': cap.metadata()['title'],
         'layers': layers,
+        'total': total,
     }
 
 def res_to_zoom(res):
@@ -150,9 +299,7 @@ def res_to_zoom(res):
     print res
 
 
-def add_wmts_layer(cap_url, layer_name, matrix_set, csv_config_file, dimensions=None):
-    cap = parsed_wmts_capabilities(cap_url)
-
+def _check_wmts_layer(cap, layer_name, matrix_set):
     if not layer_name in cap.layers.keys():
         raise UserError('Layer "%s" not found in given capabilities document' % layer_name)
     found = False
@@ -164,21 +311,17 @@ def add_wmts_layer(cap_url, layer_name, matrix_set, csv_config_file, dimensions=
     if not found:
         raise UserError('MatrixSet "%s" not supported by layer "%s"' % (matrix_set, layer_name,))
 
+def _check_wmts_dimensions(cap, layer_name, dimensions):
+    layer = cap.layers[layer_name]
+    if not layer['dimensions']:
+        raise UserError('Layer "%s" has no dimensions' % layer_name)
     try:
-        mapproxy_id = csv.to_csv(csv_config_file, 'wmts', cap_url, layer_name, matrix_set, dimensions=dimensions)
-    except Exception as ex:
-        reraise_exception(ServiceError('Creating layer failed', ex.args[0]), sys.exc_info())
-
-    return mapproxy_id
-
-def add_wms_layer(cap_url, layer_name, srs, csv_config_file):
-    cap = parsed_wms_capabilities(cap_url)
+        mapproxy_dimensions(layer, dimensions)
+    except ConfigWriterError as ex:
+        reraise_exception(UserError(ex.user_msg, ex.system_msg), sys.exc_info())
 
-    layer = None
-    for cap_layer in cap.layers_list():
-        if cap_layer['name'] == layer_name:
-            layer = cap_layer
-            break
+def _check_wms_layer(cap, layer_name, srs):
+    layer = wms_layer_index(cap).get(layer_name)
     if layer is None:
         raise UserError('Layer "%s" not found in given capabilities document' % layer_name)
     if srs not in layer['srs']:
@@ -186,11 +329,113 @@ def add_wms_layer(cap_url, layer_name, srs, csv_config_file):
     if not is_supported_srs(srs):
         raise FeatureError('Unsupported SRS "%s"' % srs)
 
+def _check_options(options, cap_type):
+    """
+    Check and normalize the record `options`.
+    """
+    options = dict(options or {})
+    if options.get('grids'):
+        grids = output_grid_names(options['grids'])
+        if cap_type == 'wms' and NATIVE_GRID in grids:
+            raise FeatureError('Native grid not supported for WMS layers')
+        options['grids'] = ','.join(grids)
+    if options.get('image') or options.get('jpeg_quality'):
+        cache_image_options(options.get('image', 'png'), options.get('jpeg_quality'))
+    if options.get('expires_hours') not in (None, ''):
+        options['expires_hours'] = str(parse_expires_hours(options['expires_hours']))
+    if options.get('dimension_mode'):
+        if options['dimension_mode'] not in DIMENSION_MODES:
+            raise UserError('Unknown dimension mode "%s"' % options['dimension_mode'])
+        if options['dimension_mode'] == 'request':
+            if cap_type != 'wmts':
+                raise FeatureError('Dimension mode "request" only supported for single WMTS layers')
+            # MapProxy can not reproject tiles with dimensions
+            if output_grid_names(options.get('grids') or NATIVE_GRID) != [NATIVE_GRID]:
+                raise FeatureError('Dimension mode "request" only supported for the native grid')
+            options['grids'] = NATIVE_GRID
+    return options
+
+def add_wmts_layer(cap_url, layer_name, matrix_set, csv_config_file, dimensions=None, options=None,
+    writer_options=None):
+    options = _check_options(options, 'wmts')
+    cap = parsed_wmts_capabilities(cap_url)
+
+    _check_wmts_layer(cap, layer_name, matrix_set)
+    if options.get('dimension_mode') == 'request':
+        _check_wmts_dimensions(cap, layer_name, dimensions)
+    options.update(format_options(cap, [(layer_name, matrix_set)], writer_options, dimensions))
+
     try:
-        mapproxy_id = csv.to_csv(csv_config_file, 'wms', cap_url, layer_name, srs)
+        mapproxy_id = csv.to_csv(csv_config_file, 'wmts', cap_url, layer_name, matrix_set, dimensions=dimensions,
+            options=options)
     except Exception as ex:
         reraise_exception(ServiceError('Creating layer failed', ex.args[0]), sys.exc_info())
 
     return mapproxy_id
 
+def add_wms_layer(cap_url, layer_name, srs, csv_config_file, options=None):
+    options = _check_options(options, 'wms')
+    cap = parsed_wms_capabilities(cap_url)
+
+    _check_wms_layer(cap, layer_name, srs)
+
+    try:
+        mapproxy_id = csv.to_csv(csv_config_file, 'wms', cap_url, layer_name, srs, options=options)
+    except Exception as ex:
+        reraise_exception(ServiceError('Creating layer failed', ex.args[0]), sys.exc_info())
+
+    return mapproxy_id
+
+def add_wmts_layers(cap_url, layer_names, matrix_sets, csv_config_file, options=None, writer_options=None):
+    """
+    Add multiple layers of one WMTS as a single service. `matrix_sets` is
+    a list with one matrix set for each layer, or with a single matrix set
+    for all layers. The formats are selected with the ``select_format``
+    option of `writer_options`, see `formats.format_options`.
+    """
+    if len(matrix_sets) == 1:
+        matrix_sets = matrix_sets * len(layer_names)
+    if not layer_names or len(layer_names) != len(matrix_sets):
+        raise UserError('Number of layers and matrix sets differ')
+    if len(set(zip(layer_names, matrix_sets))) != len(layer_names):
+        raise UserError('Duplicate layers with the same matrix set')
+
+    options = _check_options(options, 'wmts_group')
+    cap = parsed_wmts_capabilities(cap_url)
+    for layer_name, matrix_set in zip(layer_names, matrix_sets):
+        if ',' in layer_name or ',' in matrix_set:
+            raise FeatureError('Layer names with "," not supported for multiple layers')
+        _check_wmts_layer(cap, layer_name, matrix_set)
+    options.update(format_options(cap, zip(layer_names, matrix_sets), writer_options))
 
+    try:
+        mapproxy_id = csv.to_csv(csv_config_file, 'wmts_group', cap_url, ','.join(layer_names), ','.join(matrix_sets),
+            options=options)
+    except Exception as ex:
+        reraise_exception(ServiceError('Creating layer failed', ex.args[0]), sys.exc_info())
+
+    return mapproxy_id
+
+def add_wms_layers(cap_url, layer_names, srs, csv_config_file, options=None):
+    """
+    Add multiple layers of one WMS as a single service.
+    """
+    if not layer_names:
+        raise UserError('No layers given')
+    if len(set(layer_names)) != len(layer_names):
+        raise UserError('Duplicate layers')
+
+    options = _check_options(options, 'wms')
+    cap = parsed_wms_capabilities(cap_url)
+    for layer_name in layer_names:
+        if ',' in layer_name:
+            raise FeatureError('Layer names with "," not supported for multiple layers')
+        _check_wms_layer(cap, layer_name, srs)
+
+    try:
+        mapproxy_id = csv.to_csv(csv_config_file, 'wms_group', cap_url, ','.join(layer_names), srs,
+            options=options)
+    except Exception as ex:
+        reraise_exception(ServiceError('Creating layer failed', ex.args[0]), sys.exc_info())
+
+    return mapproxy_id
@@ -1,27 +1,140 @@
+import os
 import yaml
 import sys
+import copy
+import hashlib
 
 from mapproxy.srs import SRS
 from mapproxy.util.py import reraise_exception
 
 from . import csv
-from .capabilities import parsed_wmts_capabilities, parsed_wms_capabilities
-from .grid import make_mapproxy_grid
+from .capabilities import parsed_wmts_capabilities, parsed_wms_capabilities, wms_layer_index
+from .grid import (make_mapproxy_grid, tile_matrix_limits_bboxes, limits_coverage_bbox, levels_res_range,
+    OUTPUT_GRIDS, NATIVE_GRID, DEFAULT_OUTPUT_GRIDS, output_grid_names, snap_to_webmercator, resample_ratios,
+    webmercator_resolutions)
+from .formats import tile_url_parameter, is_transparent_format, cache_image_options
+from .dimensions import mapproxy_dimensions
+from .cache_headers import tile_expires_hours, cache_headers_globals
+from .hosts import apply_host_policies
 from .exceptions import ConfigWriterError, FeatureError, TileMatrixError, UserError, ServiceError
-from .utils import is_supported_srs
+from .utils import is_supported_srs, safe_name, config_filename, shard_dirs
+
+import logging
+
+log = logging.getLogger(__name__)
 
 
 DEFAULT_CACHE_TYPE = 'file'
 
+# upstream responses for tiles without data
+EMPTY_TILE_STATUS_CODES = (204, 400, 404)
+
+# max. difference in pixel for upstream grids that are snapped to webmercator
+DEFAULT_SNAP_TOLERANCE = 2
+
 def mangle_name(name):
     """remove unsafe characters from name"""
     return name.replace(':', '_')
 
-def mapproxy_conf_from_wms_capabilities(mapproxy_conf, cap, service_name, layer_name=None, srs=None, timestamp=None):
-    cache_suffix = '_cache'
-    if timestamp:
-        cache_suffix = '_%d_cache' % timestamp
-
+def cache_suffix(timestamp=None):
+    """
+    Return the cache suffix for a record timestamp.
+
+    >>> cache_suffix()
+    '_cache'
+    >>> cache_suffix(1400000000.5)
+    '_1400000000_cache'
+    """
+    if timestamp and float(timestamp):
+        return '_%d_cache' % float(timestamp)
+    return '_cache'
+
+def cache_name(id, timestamp=None):
+    """
+    Return name of the output cache of the config for record `id`.
+    """
+    return mangle_name(id) + cache_suffix(timestamp)
+
+def split_group(value):
+    """
+    Split comma separated layer names or system ids of group records.
+
+    >>> split_group('osm,osm_roads')
+    ['osm', 'osm_roads']
+    """
+    return [v for v in value.split(',') if v]
+
+def wmts_group_layers(layer_names, matrix_sets):
+    """
+    Return list of (layer_name, matrix_set) tuples of a wmts_group record.
+    A single matrix set is used for all layers.
+
+    >>> wmts_group_layers('a,b', 'EPSG:4326')
+    [('a', 'EPSG:4326'), ('b', 'EPSG:4326')]
+    >>> wmts_group_layers('a,a', 'EPSG:4326,EPSG:3857')
+    [('a', 'EPSG:4326'), ('a', 'EPSG:3857')]
+    """
+    layer_names = split_group(layer_names)
+    matrix_sets = split_group(matrix_sets)
+    if len(matrix_sets) == 1:
+        matrix_sets = matrix_sets * len(layer_names)
+    if len(layer_names) != len(matrix_sets):
+        raise ConfigWriterError('Number of layers and matrix sets of group differ')
+    return zip(layer_names, matrix_sets)
+
+def member_service_name(id, *parts):
+    """
+    Return service name of a single layer of a group record.
+
+    >>> member_service_name('foo', 'opengeo:geonames', 'EPSG:4326')
+    'foo_opengeo_geonames_EPSG_4326'
+    """
+    return '_'.join([id] + [safe_name(p) for p in parts])
+
+def record_cache_names(rec):
+    """
+    Return names of all output caches of the configuration for `rec`.
+    """
+    if rec.type == 'wms_group':
+        return [cache_name(member_service_name(rec.id, layer_name), rec.timestamp)
+            for layer_name in split_group(csv.record_layer_names(rec))]
+    if rec.type == 'wmts_group':
+        return [cache_name(member_service_name(rec.id, layer_name, matrix_set), rec.timestamp)
+            for layer_name, matrix_set in wmts_group_layers(csv.record_layer_names(rec), rec.system_id)]
+    return [cache_name(rec.id, rec.timestamp)]
+
+def source_key(url, grid_name):
+    """
+    Return canonical key for an upstream tile source.
+
+    `url` is the source URL with the layer, format, TileMatrixSet and
+    all dimensions already substituted. Configurations with the same key
+    request identical tiles.
+    """
+    return hashlib.sha1(url.encode('utf-8') + '|' + grid_name.encode('utf-8')).hexdigest()[:16]
+
+def shared_tmpcache_name(key):
+    return 'src_' + key + '_tmpcache'
+
+def layer_cache_names(mapproxy_conf):
+    """
+    Return names of all caches that are served by the layers of `mapproxy_conf`.
+    """
+    names = []
+    for layer in mapproxy_conf['layers']:
+        for name in layer.get('tile_sources', layer['sources']):
+            if name not in names:
+                names.append(name)
+    return names
+
+def mapproxy_conf_from_wms_capabilities(mapproxy_conf, cap, service_name, layer_name=None, srs=None, timestamp=None,
+    mapproxy_layer_name='map', grids=None, image_conf=None):
+    """
+    Add WMS layer to `mapproxy_conf`. The layer is cached in all output
+    `grids` (default is `DEFAULT_OUTPUT_GRIDS`). `image_conf` contains the
+    image options of the cache (see `formats.cache_image_options`).
+    """
+    grids = grids or DEFAULT_OUTPUT_GRIDS
     def _add_source(mapproxy_conf, layer_name, layer, srs):
         source = {
             'type': 'wms',
@@ -53,31 +166,29 @@ def mapproxy_conf_from_wms_capabilities(mapproxy_conf, cap, service_name, layer_
         mapproxy_conf['sources'][mangle_name(layer_name) + '_source'] = source
 
     def _add_cache(mapproxy_conf, service_name, layer_name):
-        mapproxy_conf['caches'][mangle_name(service_name) + cache_suffix] = {
+        mapproxy_conf['caches'][cache_name(service_name, timestamp)] = {
             'sources': [mangle_name(layer_name) + '_source'],
-            'grids': ['webmercator'],
+            'grids': list(grids),
             'cache': {
                 'type': DEFAULT_CACHE_TYPE,
             },
         }
+        mapproxy_conf['caches'][cache_name(service_name, timestamp)].update(copy.deepcopy(image_conf or {}))
 
     def _add_layer(mapproxy_conf, service_name, layer):
         mapproxy_conf['layers'].append({
-            'name': 'map',
+            'name': mapproxy_layer_name,
             'title': layer['title'],
-            'sources': [mangle_name(service_name) + cache_suffix],
+            'sources': [cache_name(service_name, timestamp)],
         })
 
     if layer_name is None:
         raise ConfigWriterError('No layer given')
 
-    layer = None
-
-    for cap_layer in cap.layers_list():
-        if layer_name == cap_layer['name']:
-            layer = cap_layer
-            break
+    if NATIVE_GRID in grids:
+        raise FeatureError('Native grid not supported for WMS layers')
 
+    layer = wms_layer_index(cap).get(layer_name)
     if layer is None:
         raise ConfigWriterError('Layer "%s" not found' % layer_name)
 
@@ -97,15 +208,39 @@ def mapproxy_conf_from_wms_capabilities(mapproxy_conf, cap, service_name, layer_
     return mapproxy_conf
 
 
-def mapproxy_conf_from_wmts_capabilities(mapproxy_conf, cap, service_name, layer_name=None, matrix_set_id=None, dimensions=None, timestamp=None):
-    cache_suffix = '_cache'
-    tmpcache_suffix = '_tmpcache'
-    if timestamp:
-        cache_suffix = '_%d_cache' % timestamp
-        tmpcache_suffix = '_%d_tmpcache' % timestamp
-
+def mapproxy_conf_from_wmts_capabilities(mapproxy_conf, cap, service_name, layer_name=None, matrix_set_id=None, dimensions=None, timestamp=None,
+    negative_cache=False, mapproxy_layer_name='map', grids=None, format=None, image_conf=None,
+    snap_tolerance=DEFAULT_SNAP_TOLERANCE, dimension_mode='fixed'):
+    """
+    Add WMTS layer to `mapproxy_conf`.
+
+    Tiles are requested in `format`, or in the first format of the layer if
+    `format` is None (see `formats.select_format`). `image_conf` contains the
+    image options of the output cache (see `formats.cache_image_options`).
+    Tiles of the native grid are served as they are stored in the tmpcache.
+
+    Upstream grids in EPSG:3857 are snapped to the webmercator grid within
+    `snap_tolerance` pixels, so that MapProxy copies these tiles instead of
+    resampling them (see `grid.snap_to_webmercator`).
+
+    The layer is available in all output `grids` (default is
+    `DEFAULT_OUTPUT_GRIDS`). The `NATIVE_GRID` is served directly from the
+    cache of the upstream tiles, all other grids are derived from that cache.
+
+    Empty tiles (see `EMPTY_TILE_STATUS_CODES`) are cached as links to a
+    single transparent tile if `negative_cache` is True. Otherwise each
+    request for an empty tile is passed to the upstream service.
+
+    The `dimensions` are fixed in the source URL, unless `dimension_mode`
+    is ``request``. The layer then has MapProxy `dimensions` for all values
+    of the capabilities, with `dimensions` as default values, and the
+    values are passed to the source URL for each request (see
+    `dimensions.DimensionTileSourceConfiguration`). This is only supported
+    for the `NATIVE_GRID` and tiles are not stored, since MapProxy can
+    not store tiles for multiple dimension values.
+    """
     def _add_grid(mapproxy_conf, grid):
-        if grid['name'] in ['GLOBAL_GEODETIC', 'GLOBAL_MERCATOR', 'GLOBAL_WEBMERCATOR']:
+        if grid['name'] in ['GLOBAL_GEODETIC', 'GLOBAL_MERCATOR', 'GLOBAL_WEBMERCATOR'] + OUTPUT_GRIDS.keys():
             grid['name'] += '_'
         if grid['name'] not in mapproxy_conf['grids'].keys():
             mapproxy_conf['grids'][grid['name']] = {
@@ -116,25 +251,48 @@ def mapproxy_conf_from_wmts_capabilities(mapproxy_conf, cap, service_name, layer
                 'origin': 'nw'
             }
 
-    def _add_layer(mapproxy_conf, service_name, layer):
-        mapproxy_conf['layers'].append({
-            'name': 'map',
+    def _add_layer(mapproxy_conf, service_name, layer, tmpcache_name):
+        layer_conf = {
+            'name': mapproxy_layer_name,
             'title': layer['title'],
-            'sources': [mangle_name(service_name) + cache_suffix]
-        })
-
-    def _add_cache(mapproxy_conf, service_name, layer_name, grid_name):
-        mapproxy_conf['caches'][mangle_name(service_name) + tmpcache_suffix] = {
+        }
+        if output_grids:
+            layer_conf['sources'] = [cache_name(service_name, timestamp)]
+            if NATIVE_GRID in grids:
+                layer_conf['tile_sources'] = [cache_name(service_name, timestamp), tmpcache_name]
+        else:
+            layer_conf['sources'] = [tmpcache_name]
+        if request_dimensions:
+            layer_conf['dimensions'] = mapproxy_dimensions(layer, dimensions)
+        mapproxy_conf['layers'].append(layer_conf)
+
+    def _source_name(layer_name, grid_name):
+        return mangle_name(layer_name) + '_' + grid_name + '_source'
+
+    def _add_cache(mapproxy_conf, service_name, layer_name, grid_name, tmpcache_name):
+        # tmpcache is shared by all configurations with the same upstream source
+        mapproxy_conf['caches'][tmpcache_name] = {
             'grids': [grid_name],
-            'sources': [mangle_name(layer_name) + '_source'],
+            'sources': [_source_name(layer_name, grid_name)],
             'cache': {
                 'type': DEFAULT_CACHE_TYPE,
             },
         }
-
-        mapproxy_conf['caches'][mangle_name(service_name) + cache_suffix] = {
-            'grids': ['webmercator'],
-            'sources': [mangle_name(service_name) + tmpcache_suffix],
+        if format == 'image/jpeg':
+            # store upstream tiles without recompression
+            mapproxy_conf['caches'][tmpcache_name]['format'] = format
+        if negative_cache:
+            # store empty tiles as links, see cache_gc.expire_empty_tiles
+            mapproxy_conf['caches'][tmpcache_name]['link_single_color_images'] = True
+        if request_dimensions:
+            mapproxy_conf['caches'][tmpcache_name]['disable_storage'] = True
+
+        if not output_grids:
+            return
+
+        mapproxy_conf['caches'][cache_name(service_name, timestamp)] = {
+            'grids': list(output_grids),
+            'sources': [tmpcache_name],
             'meta_size': [6, 6],
             'meta_buffer': 0,
             'concurrent_tile_creators': 4,
@@ -142,27 +300,17 @@ def mapproxy_conf_from_wmts_capabilities(mapproxy_conf, cap, service_name, layer
                 'type': DEFAULT_CACHE_TYPE,
             },
         }
+        mapproxy_conf['caches'][cache_name(service_name, timestamp)].update(copy.deepcopy(image_conf or {}))
+        if negative_cache:
+            mapproxy_conf['caches'][cache_name(service_name, timestamp)]['link_single_color_images'] = True
 
     def _add_source(mapproxy_conf, layer_name, layer, tile_matrix_set, grid):
-        source_url = None
-
-        url_parameter = {
-            'tile_matrix_set': tile_matrix_set['id'],
-            'layer': layer_name,
-            'format': layer['formats'][0],
-             # WMTS does not provide opacity information, depend on format
-            'transparent': True if layer['formats'][0] == 'image/png' else False,
-        }
-
-        if 'dimensions' in layer:
-            for dim in layer['dimensions']:
-                # replace dimension variables with user provided values...
-                if dim['id'] in dimensions:
-                    url_parameter[dim['id']] = dimensions[dim['id']]
-                # or with default values
-                else:
-                    default_value = dim['default'] if 'default' in dim else ''
-                    url_parameter[dim['id']] = default_value
+        url_parameter = tile_url_parameter(layer_name, layer, tile_matrix_set['id'],
+            format or layer['formats'][0], dimensions)
+        if request_dimensions:
+            # keep dimensions as parameters of the source URL
+            for dim in layer.get('dimensions', []):
+                url_parameter[dim['id']] = '%%(%s)s' % dim['id']
         source_url = layer['url_template'] % url_parameter
         if grid['prefix'] is not None:
             source_url = source_url.replace('%(z)s', '%s%%(z)s' % grid['prefix'])
@@ -176,7 +324,7 @@ def mapproxy_conf_from_wmts_capabilities(mapproxy_conf, cap, service_name, layer
             min(grid_4326_bbox[3], layer['bbox'][3])
         ]
 
-        mapproxy_conf['sources'][mangle_name(layer_name) + '_source'] = {
+        source = {
             'type': 'tile',
             'url': source_url,
             'grid': grid['name'],
@@ -184,18 +332,64 @@ def mapproxy_conf_from_wmts_capabilities(mapproxy_conf, cap, service_name, layer
                 'bbox': coverage_bbox,
                 'srs': 'EPSG:4326'
             },
-            'on_error': {
-                204: {
-                    'response': 'transparent',
-                    'cache': False
-                },
-                400: {
-                    'response': 'transparent',
-                    'cache': False
-                }
+            'on_error': _on_error(),
+        }
+        if format:
+            # WMTS does not provide opacity information, depend on selected format
+            source['transparent'] = is_transparent_format(format)
+
+        limits = layer.get('matrix_set_limits', {}).get(tile_matrix_set['id'])
+        if limits:
+            _add_limits(source, coverage_bbox, limits, tile_matrix_set, grid)
+
+        mapproxy_conf['sources'][_source_name(layer_name, grid['name'])] = source
+
+        return source_url
+
+    def _on_error():
+        if negative_cache:
+            return dict((code, {'response': 'transparent', 'cache': True}) for code in EMPTY_TILE_STATUS_CODES)
+        return {
+            204: {
+                'response': 'transparent',
+                'cache': False
+            },
+            400: {
+                'response': 'transparent',
+                'cache': False
             }
         }
 
+    def _add_limits(source, coverage_bbox, limits, tile_matrix_set, grid):
+        # restrict source to the levels and extent of the TileMatrixSetLimits,
+        # so that MapProxy does not request tiles that are not available
+        try:
+            level_bboxes = tile_matrix_limits_bboxes(tile_matrix_set, limits)
+        except TileMatrixError as ex:
+            # some services (e.g. older GeoWebCache versions) publish invalid limits
+            log.warn('ignoring TileMatrixSetLimits of "%s": %s', tile_matrix_set['id'], ex.args[0])
+            return
+
+        limits_bbox = grid['srs'].transform_bbox_to(SRS(4326), limits_coverage_bbox(level_bboxes))
+        coverage_bbox[0] = max(coverage_bbox[0], limits_bbox[0])
+        coverage_bbox[1] = max(coverage_bbox[1], limits_bbox[1])
+        coverage_bbox[2] = min(coverage_bbox[2], limits_bbox[2])
+        coverage_bbox[3] = min(coverage_bbox[3], limits_bbox[3])
+        if coverage_bbox[0] >= coverage_bbox[2] or coverage_bbox[1] >= coverage_bbox[3]:
+            raise ConfigWriterError('Layer "%s" has no tiles within TileMatrixSetLimits' % layer_name)
+
+        min_res, max_res = levels_res_range(grid['resolutions'], [level for level, _ in level_bboxes], grid['srs'])
+        if min_res is not None:
+            source['min_res'] = min_res
+        if max_res is not None:
+            source['max_res'] = max_res
+
+    grids = grids or DEFAULT_OUTPUT_GRIDS
+    output_grids = [grid for grid in grids if grid != NATIVE_GRID]
+    request_dimensions = dimension_mode == 'request'
+    if request_dimensions and output_grids:
+        raise FeatureError('Dimension mode "request" only supported for the native grid')
+
     if layer_name is None:
         raise ConfigWriterError('No layer given')
     if layer_name not in cap.layers.keys():
@@ -222,24 +416,160 @@ def mapproxy_conf_from_wmts_capabilities(mapproxy_conf, cap, service_name, layer
         matrix_set = cap_layer['matrix_sets'][0]
 
     try:
-        mapproxy_grid = make_mapproxy_grid(cap_matrix_set)
+        mapproxy_grid = make_mapproxy_grid(matrix_set)
     except TileMatrixError as ex:
-        reraise_exception(FeatureError('Tile matrix "%s" not supported' % cap_matrix_set['id'], ex.args[0]), sys.exc_info())
+        reraise_exception(FeatureError('Tile matrix "%s" not supported' % matrix_set['id'], ex.args[0]), sys.exc_info())
+
+    if snap_tolerance:
+        snapped = snap_to_webmercator(mapproxy_grid, snap_tolerance)
+        if snapped:
+            log.debug('snapped levels %s of "%s" to webmercator', snapped, matrix_set['id'])
+    if 'webmercator' in output_grids:
+        log.info('resample ratios for webmercator levels of "%s": %s', layer_name, ', '.join('%d: %.3f' % (level, ratio)
+            for level, ratio in enumerate(resample_ratios(webmercator_resolutions(), mapproxy_grid['resolutions']))))
 
     _add_grid(mapproxy_conf, mapproxy_grid)
-    _add_layer(mapproxy_conf, service_name, cap_layer)
-    _add_source(mapproxy_conf, layer_name, cap_layer, cap_matrix_set, mapproxy_grid)
-    _add_cache(mapproxy_conf, service_name, layer_name, mapproxy_grid['name'])
+    source_url = _add_source(mapproxy_conf, layer_name, cap_layer, matrix_set, mapproxy_grid)
+    if request_dimensions:
+        # not shared, tiles are not stored
+        tmpcache_name = cache_name(service_name, timestamp)
+    else:
+        tmpcache_name = shared_tmpcache_name(source_key(source_url, mapproxy_grid['name']))
+    _add_cache(mapproxy_conf, service_name, layer_name, mapproxy_grid['name'], tmpcache_name)
+    _add_layer(mapproxy_conf, service_name, cap_layer, tmpcache_name)
+
+    return mapproxy_conf
+
+
+def mapproxy_conf_from_wms_group(mapproxy_conf, cap, service_name, layer_names, srs=None, timestamp=None, grids=None,
+    image_conf=None):
+    """
+    Add all `layer_names` of the WMS to `mapproxy_conf`.
+    """
+    for layer_name in split_group(layer_names):
+        mapproxy_conf_from_wms_capabilities(mapproxy_conf, cap, member_service_name(service_name, layer_name),
+            layer_name, srs, timestamp=timestamp, mapproxy_layer_name=safe_name(layer_name), grids=grids,
+            image_conf=image_conf)
+    return mapproxy_conf
 
+def mapproxy_conf_from_wmts_group(mapproxy_conf, cap, service_name, layer_names, matrix_sets, timestamp=None,
+    negative_cache=False, grids=None, formats=None, image_conf=None, snap_tolerance=DEFAULT_SNAP_TOLERANCE):
+    """
+    Add all layers of the WMTS to `mapproxy_conf`. `layer_names` and `matrix_sets`
+    are comma separated lists, see `wmts_group_layers`.
+
+    All layers share the grids of their matrix sets. Layers that are added with
+    multiple matrix sets are named <layer_name>_<matrix_set>.
+
+    `formats` is a list with the format for each layer.
+    """
+    group_layers = wmts_group_layers(layer_names, matrix_sets)
+    all_layer_names = [layer_name for layer_name, _ in group_layers]
+    formats = formats or [None] * len(group_layers)
+    for (layer_name, matrix_set), format in zip(group_layers, formats):
+        mapproxy_layer_name = safe_name(layer_name)
+        if all_layer_names.count(layer_name) > 1:
+            mapproxy_layer_name += '_' + safe_name(matrix_set)
+        mapproxy_conf_from_wmts_capabilities(mapproxy_conf, cap, member_service_name(service_name, layer_name, matrix_set),
+            layer_name, matrix_set, {}, timestamp=timestamp, negative_cache=negative_cache,
+            mapproxy_layer_name=mapproxy_layer_name, grids=grids, format=format, image_conf=image_conf,
+            snap_tolerance=snap_tolerance)
     return mapproxy_conf
 
 
+def record_formats(rec):
+    """
+    Return list with the format for each layer of the record, or None if
+    the first format of each layer should be used. The formats are stored
+    in the options of the record, see `formats.format_options`.
+    """
+    options = csv.record_options(rec)
+    if options.get('format'):
+        return split_group(options['format'])
+    return None
+
+def cache_base_dir(base_file, configs_path):
+    """
+    Return the cache directory as MapProxy resolves it for configs
+    in `configs_path` that use `base_file`.
+    """
+    with open(base_file, 'rb') as f:
+        base_conf = yaml.safe_load(f) or {}
+    base_dir = base_conf.get('globals', {}).get('cache', {}).get('base_dir', 'cache_data')
+    return os.path.join(configs_path, base_dir)
+
+def source_lock_dir(base_file, configs_path):
+    """
+    Return the lock directory as MapProxy resolves it for configs
+    in `configs_path` that use `base_file`.
+    """
+    with open(base_file, 'rb') as f:
+        base_conf = yaml.safe_load(f) or {}
+    # default of MapProxy, not relative to the cache base_dir
+    lock_dir = base_conf.get('globals', {}).get('cache', {}).get('lock_dir', './cache_data/tile_locks')
+    return os.path.join(configs_path, lock_dir)
+
+def shard_mapproxy_conf(mapproxy_conf, base_file, configs_path):
+    """
+    Set absolute paths for the base configuration, the cache directory and
+    the lock directory. MapProxy resolves relative paths from the directory
+    of the configuration, but the sharded configurations should use the
+    same files as configurations in `configs_path`.
+    """
+    mapproxy_conf['base'] = [os.path.abspath(base_file)]
+    cache_conf = mapproxy_conf.setdefault('globals', {}).setdefault('cache', {})
+    cache_conf['base_dir'] = os.path.abspath(cache_base_dir(base_file, configs_path))
+    # locks for concurrent_requests of sources, see `hosts`
+    cache_conf['lock_dir'] = os.path.abspath(source_lock_dir(base_file, configs_path))
+    return mapproxy_conf
+
 def write_mapproxy_conf(mapproxy_conf, filename):
     content = yaml.safe_dump(mapproxy_conf, default_flow_style=False)
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
     with open(filename, 'wb') as f:
         f.write(content)
 
-def mapproxy_config_from_csv(id, base_file, csv_config_file=None):
+def mapproxy_config_from_csv(id, base_file, csv_config_file=None, writer_options=None):
+    """
+    Create MapProxy configuration for record `id`.
+
+    `writer_options` is a dict with global options for all configurations:
+
+    ``negative_cache``
+        Cache empty tiles of WMTS sources, see `mapproxy_conf_from_wmts_capabilities`.
+
+    ``select_format``
+        Select the format of WMTS sources by preference instead of using
+        the first format of the layer. The format is selected when the
+        layer is added or refreshed, see `formats.format_options`.
+
+    ``format_preferences``
+        Dict with lists of preferred formats for ``opaque`` and ``transparent``
+        layers, see `formats.DEFAULT_FORMAT_PREFERENCES`.
+
+    ``probe_format``
+        Request a sample tile to check if a layer is transparent before the
+        format is selected.
+
+    ``image``
+        Default image pipeline of the output caches for records without
+        the ``image`` option, see `formats.cache_image_options`.
+
+    ``snap_tolerance``
+        Snap upstream grids to webmercator within this many pixels, see
+        `mapproxy_conf_from_wmts_capabilities`. 0 disables snapping.
+
+    ``expires_hours``
+        Cache-Control max-age of the tiles for records without the
+        ``expires_hours`` option, see `cache_headers`.
+
+    ``host_policies``
+        Dict with the maximum number of parallel requests and the timeout
+        for each upstream host, see `hosts`.
+    """
+    writer_options = writer_options or {}
     try:
         rec = csv.from_csv(id, csv_config_file)
     except ServiceError as ex:
@@ -247,6 +577,11 @@ def mapproxy_config_from_csv(id, base_file, csv_config_file=None):
     except Exception as ex:
         reraise_exception(ServiceError('Unable to load configuration', ex.args[0]), sys.exc_info())
 
+    options = csv.record_options(rec)
+    grids = output_grid_names(options.get('grids', ''))
+    image_conf = cache_image_options(options.get('image') or writer_options.get('image', 'png'),
+        options.get('jpeg_quality'))
+
     mapproxy_conf = {
         'base': [base_file],
         'services': {
@@ -255,22 +590,37 @@ def mapproxy_config_from_csv(id, base_file, csv_config_file=None):
         'layers': [],
         'caches': {},
         'sources': {},
-        'grids': {
-            'webmercator': { # custom grid for different name in WMTS URLs
-                'base': 'GLOBAL_WEBMERCATOR',
-            }
-        },
+        'grids': dict((name, dict(OUTPUT_GRIDS[name])) for name in grids if name in OUTPUT_GRIDS),
         'globals': {},
     }
+    cache_headers_globals(mapproxy_conf, tile_expires_hours(options, writer_options))
 
     if rec.type == 'wms':
         cap = parsed_wms_capabilities(rec.url)
-        return mapproxy_conf_from_wms_capabilities(mapproxy_conf, cap, rec.id, rec.layer_name, rec.system_id,
-            timestamp=rec.timestamp)
+        mapproxy_conf = mapproxy_conf_from_wms_capabilities(mapproxy_conf, cap, rec.id, rec.layer_name, rec.system_id,
+            timestamp=rec.timestamp, grids=grids, image_conf=image_conf)
     elif rec.type == 'wmts':
         cap = parsed_wmts_capabilities(rec.url)
-        return mapproxy_conf_from_wmts_capabilities(mapproxy_conf, cap, rec.id, rec.layer_name, rec.system_id, rec.dimensions,
-            timestamp=rec.timestamp)
+        dimensions = csv.unserialize_dimensions(rec.dimensions)
+        formats = record_formats(rec)
+        mapproxy_conf = mapproxy_conf_from_wmts_capabilities(mapproxy_conf, cap, rec.id, rec.layer_name, rec.system_id,
+            dimensions, timestamp=rec.timestamp, negative_cache=writer_options.get('negative_cache', False), grids=grids,
+            format=formats[0] if formats else None, image_conf=image_conf,
+            snap_tolerance=writer_options.get('snap_tolerance', DEFAULT_SNAP_TOLERANCE),
+            dimension_mode=options.get('dimension_mode', 'fixed'))
+    elif rec.type == 'wms_group':
+        cap = parsed_wms_capabilities(rec.url)
+        mapproxy_conf = mapproxy_conf_from_wms_group(mapproxy_conf, cap, rec.id, csv.record_layer_names(rec), rec.system_id,
+            timestamp=rec.timestamp, grids=grids, image_conf=image_conf)
+    elif rec.type == 'wmts_group':
+        cap = parsed_wmts_capabilities(rec.url)
+        formats = record_formats(rec)
+        mapproxy_conf = mapproxy_conf_from_wmts_group(mapproxy_conf, cap, rec.id, csv.record_layer_names(rec), rec.system_id,
+            timestamp=rec.timestamp, negative_cache=writer_options.get('negative_cache', False), grids=grids,
+            formats=formats, image_conf=image_conf,
+            snap_tolerance=writer_options.get('snap_tolerance', DEFAULT_SNAP_TOLERANCE))
     else:
         raise UserError('No valid capabilities type given')
 
+    return apply_host_policies(mapproxy_conf, writer_options.get('host_policies'))
+
@@ -2,18 +2,20 @@ from __future__ import absolute_import
 
 import time
 import csv
-import re
+import hashlib
 from cStringIO import StringIO
-from urlparse import urlparse
+from urllib import quote
+from urlparse import urlparse, parse_qsl
 from collections import namedtuple
 
 from .exceptions import ServiceError
+from .utils import safe_name
 
 from mapproxy.util.lock import FileLock
 from mapproxy.util.fs import write_atomic
 
 
-fieldnames = ('id', 'type', 'url', 'layer_name', 'system_id', 'dimensions', 'timestamp')
+fieldnames = ('id', 'type', 'url', 'layer_name', 'system_id', 'dimensions', 'timestamp', 'options')
 record = namedtuple('record', fieldnames)
 
 
@@ -39,6 +41,67 @@ def unserialize_dimensions(dims):
         return {}
     return dict(kv.split('=', 1) for kv in dims.split(','))
 
+def serialize_options(options):
+    """
+    >>> serialize_options({'grids': 'webmercator,native'})
+    'grids=webmercator,native'
+    """
+    if not options:
+        return ''
+    return '&'.join(k + '=' + quote(options[k], safe=',:') for k in sorted(options.keys()))
+
+def unserialize_options(options):
+    """
+    >>> unserialize_options('grids=webmercator,native')
+    {'grids': 'webmercator,native'}
+    """
+    if not options:
+        return {}
+    return dict(parse_qsl(options))
+
+def record_options(rec):
+    """
+    Return dict with the options of `rec`. Records of older versions
+    have no options.
+    """
+    return unserialize_options(rec.options)
+
+def record_layer_names(rec):
+    """
+    Return the layer name of `rec`, or the comma separated layer names
+    of a group record. Group records store these names in the ``layers``
+    option, records of older versions in the layer name.
+    """
+    return record_options(rec).get('layers') or rec.layer_name
+
+def group_id(cap_url, layer_names, system_ids):
+    """
+    Return the id of a group record. The id contains a hash of the sorted
+    (layer name, system id) pairs, so that it stays short for many layers.
+    `system_ids` contains a single value for all layers, or one value for
+    each layer.
+
+    >>> group_id('http://example.org/wmts', 'roads,water', 'EPSG:4326')
+    'example_org_group_7b23e0eb68489197'
+    >>> group_id('http://example.org/wmts', 'water,roads', 'EPSG:4326')
+    'example_org_group_7b23e0eb68489197'
+    """
+    layer_names = layer_names.split(',')
+    system_ids = system_ids.split(',')
+    if len(system_ids) == 1:
+        system_ids = system_ids * len(layer_names)
+    key = '\n'.join(sorted('%s %s' % pair for pair in zip(layer_names, system_ids)))
+    return safe_name(urlparse(cap_url).netloc + '_group_' + hashlib.sha1(key).hexdigest()[:16])
+
+def record_config_timestamp(rec):
+    """
+    Return the time of the last change of `rec` that requires a new
+    configuration. This is the timestamp of the record, or the time the
+    capabilities were refreshed (see `refresh`) if this is more recent.
+    """
+    refreshed = record_options(rec).get('refreshed')
+    return max(float(rec.timestamp or 0), float(refreshed or 0))
+
 def read_csv(filename):
     records = {}
     with open(filename, 'rb') as f:
@@ -57,22 +120,78 @@ def write_csv(filename, records):
     buf.seek(0)
     write_atomic(filename, buf.read())
 
-def to_csv(csv_config_file, cap_type, cap_url, layer_name, system_id, dimensions=None):
+def to_csv(csv_config_file, cap_type, cap_url, layer_name, system_id, dimensions=None, options=None):
+    """
+    Add or update the record for the given layer and return its id.
+    `options` is a dict with further settings of the record.
+
+    The `dimensions` are part of the id, unless the ``dimension_mode``
+    option is ``request``. The `dimensions` are then only the default
+    values for requests without dimensions.
+
+    Group records (``wms_group``, ``wmts_group``) with the comma separated
+    `layer_name` get an id from `group_id`. The layer names are stored in
+    the ``layers`` option.
+    """
+    request_dimensions = (options or {}).get('dimension_mode') == 'request'
     dimensions = serialize_dimensions(dimensions)
 
-    id = urlparse(cap_url).netloc + '_' + layer_name + '_' + system_id
-    if dimensions:
-        id += '_' + dimensions
+    if cap_type.endswith('_group'):
+        id = group_id(cap_url, layer_name, system_id)
+        options = dict(options or {}, layers=layer_name)
+        layer_name = ''
+    else:
+        id = urlparse(cap_url).netloc + '_' + layer_name + '_' + system_id
+        if dimensions and not request_dimensions:
+            id += '_' + dimensions
+        id = safe_name(id)
 
-    id = re.sub('[^A-Za-z0-9-_]', '_', id)
+    options = serialize_options(options)
 
     with FileLock(csv_config_file + '.lck'):
         records = read_csv(csv_config_file)
-        records[id] = (id, cap_type, cap_url, layer_name, system_id, dimensions, time.time())
+        records[id] = (id, cap_type, cap_url, layer_name, system_id, dimensions, time.time(), options)
         write_csv(csv_config_file, records)
 
     return id
 
+def _update_record(rec, options, touch=False):
+    rec_options = unserialize_options(rec.options)
+    rec_options.update(options)
+    rec = rec._replace(options=serialize_options(rec_options))
+    if touch:
+        # cache names only contain full seconds of the timestamp
+        rec = rec._replace(timestamp=max(time.time(), int(float(rec.timestamp or 0)) + 1))
+    return rec
+
+def update_options(csv_config_file, id, options, touch=False):
+    """
+    Update the options of record `id`. Keeps the timestamp, so that
+    existing configurations and caches stay valid, unless `touch` is True.
+    """
+    with FileLock(csv_config_file + '.lck'):
+        records = read_csv(csv_config_file)
+        if id not in records:
+            raise ServiceError('No configuration for "%s" found' % id)
+        records[id] = _update_record(records[id], options, touch)
+        write_csv(csv_config_file, records)
+
+def update_records(csv_config_file, updates):
+    """
+    Update the options of multiple records with a single write.
+    `updates` is a dict with (options, touch) for each record id, see
+    `update_options`. Records that were removed in the meantime are
+    skipped.
+    """
+    if not updates:
+        return
+    with FileLock(csv_config_file + '.lck'):
+        records = read_csv(csv_config_file)
+        for id, (options, touch) in updates.iteritems():
+            if id in records:
+                records[id] = _update_record(records[id], options, touch)
+        write_csv(csv_config_file, records)
+
 def from_csv(id, csv_config_file):
     with open(csv_config_file, 'rb') as f:
         csv_reader = csv.DictReader(f, fieldnames=fieldnames)
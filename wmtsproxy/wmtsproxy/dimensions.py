@@ -0,0 +1,198 @@
+"""
+Dimensions of WMTS layers as request parameters.
+
+Records with the ``dimension_mode=request`` option are configured as a
+single MapProxy layer with `dimensions`, instead of one layer for each
+dimension value. The dimension values are passed to the upstream URL
+for each tile request.
+
+MapProxy only passes dimensions from the layer to the sources of its
+cache and it can not store tiles for different dimension values.
+`DimensionTileSourceConfiguration` replaces the configuration of tile
+sources, so that dimensions in the URL template (e.g. ``%(time)s``) are
+substituted for each request. It is used with the host limits of
+`hosts.HostLimitedTileSourceConfiguration` for all tile sources of the
+configurations that WMTSProxy loads (see `hosts.WMTSProxyConfiguration`).
+"""
+
+from __future__ import absolute_import
+
+import re
+import copy
+import calendar
+import datetime
+
+from mapproxy.config import loader
+from mapproxy.client.http import retrieve_image
+from mapproxy.client.tile import TileClient, TileURLTemplate
+from mapproxy.source.tile import TiledSource
+
+from .exceptions import ConfigWriterError
+
+DIMENSION_MODES = ('fixed', 'request')
+
+# maximum number of values of a dimension (e.g. 27 years of daily values)
+MAX_DIMENSION_VALUES = 10000
+
+# parameters of `TileURLTemplate`
+TILE_URL_PARAMETERS = frozenset(['x', 'y', 'z', 'format', 'quadkey', 'tc_path', 'tms_path',
+    'arcgiscache_path', 'bbox'])
+
+period_re = re.compile(r'^P(?:(\d+)Y)?(?:(\d+)M)?(?:(\d+)W)?(?:(\d+)D)?'
+    r'(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+
+time_formats = ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%MZ', '%Y-%m-%d', '%Y-%m', '%Y')
+
+def _parse_time(value):
+    for format in time_formats:
+        try:
+            return datetime.datetime.strptime(value, format), format
+        except ValueError:
+            pass
+    raise ConfigWriterError('Invalid time "%s" in dimension values' % value)
+
+def _add_months(dt, months):
+    month = dt.month - 1 + months
+    year = dt.year + month // 12
+    month = month % 12 + 1
+    day = min(dt.day, calendar.monthrange(year, month)[1])
+    return dt.replace(year=year, month=month, day=day)
+
+def expand_interval(value, max_values=MAX_DIMENSION_VALUES):
+    """
+    Return list of all values of an ISO8601 interval (start/end/period).
+
+    >>> expand_interval('2014-03-29/2014-03-31/P1D')
+    ['2014-03-29', '2014-03-30', '2014-03-31']
+    >>> expand_interval('2014-01-31/2014-04-01/P1M')
+    ['2014-01-31', '2014-02-28', '2014-03-31']
+    >>> expand_interval('2014-03-31T00:00:00Z/2014-03-31T12:00:00Z/PT6H')
+    ['2014-03-31T00:00:00Z', '2014-03-31T06:00:00Z', '2014-03-31T12:00:00Z']
+    """
+    try:
+        start, end, period = value.split('/')
+    except ValueError:
+        raise ConfigWriterError('Invalid interval "%s" in dimension values' % value)
+    match = period_re.match(period)
+    if not match or not any(match.groups()):
+        raise ConfigWriterError('Invalid period "%s" in dimension values' % period)
+    years, months, weeks, days, hours, minutes, seconds = [int(v or 0) for v in match.groups()]
+    months += years * 12
+    delta = datetime.timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds)
+
+    start, format = _parse_time(start)
+    end, _ = _parse_time(end)
+    values = []
+    dt = start
+    while dt <= end:
+        if len(values) >= max_values:
+            raise ConfigWriterError('Interval "%s" has more than %d values' % (value, max_values))
+        values.append(dt.strftime(format))
+        # step from the start, so that months do not drift to shorter month ends
+        n = len(values)
+        dt = _add_months(start, months * n) + delta * n
+    return values
+
+def dimension_values(dimension, max_values=MAX_DIMENSION_VALUES):
+    """
+    Return list of all values of a WMTS `dimension`. Intervals are expanded.
+
+    >>> dimension_values({'values': ['2014-03-30/2014-03-31/P1D', 'latest']})
+    ['2014-03-30', '2014-03-31', 'latest']
+    """
+    values = []
+    for value in dimension.get('values') or [dimension.get('value')]:
+        if not value:
+            continue
+        if value.count('/') == 2:
+            values.extend(expand_interval(value, max_values - len(values)))
+        else:
+            values.append(value)
+    return values
+
+def mapproxy_dimensions(layer, defaults=None):
+    """
+    Return the MapProxy `dimensions` configuration of a WMTS `layer`.
+    `defaults` is a dict with default values that replace the defaults
+    of the capabilities.
+    """
+    defaults = defaults or {}
+    dimensions = {}
+    for dim in layer.get('dimensions', []):
+        values = dimension_values(dim)
+        if not values:
+            raise ConfigWriterError('Dimension "%s" has no values' % dim['id'])
+        default = defaults.get(dim['id']) or dim.get('default') or values[-1]
+        if default not in values:
+            raise ConfigWriterError('Default value "%s" of dimension "%s" not available' % (default, dim['id']))
+        dimensions[dim['id']] = {
+            'values': values,
+            'default': default,
+        }
+    return dimensions
+
+
+class DimensionTileURLTemplate(TileURLTemplate):
+    """
+    `TileURLTemplate` with additional parameters for dimensions.
+    """
+    def __init__(self, template, format='png'):
+        TileURLTemplate.__init__(self, template, format=format)
+        self.dimensions = url_dimensions(template)
+
+    def substitute(self, tile_coord, format=None, grid=None, dimensions=None):
+        values = dict((key.lower(), value) for key, value in (dimensions or {}).iteritems())
+        url = self.template
+        for name, key in self.dimensions.iteritems():
+            url = url.replace('%%(%s)s' % key, values.get(name, ''))
+        return TileURLTemplate(url, self.format).substitute(tile_coord, format, grid)
+
+class DimensionTileClient(TileClient):
+    def get_tile(self, tile_coord, format=None, dimensions=None):
+        url = self.url_template.substitute(tile_coord, format, self.grid, dimensions)
+        if self.http_client:
+            return self.http_client.open_image(url)
+        return retrieve_image(url)
+
+class DimensionTiledSource(TiledSource):
+    """
+    `TiledSource` that passes the dimensions of each query to the client.
+    """
+    def get_map(self, query):
+        source = copy.copy(self)
+        source.client = _BoundClient(self.client, query.dimensions)
+        return TiledSource.get_map(source, query)
+
+class _BoundClient(object):
+    def __init__(self, client, dimensions):
+        self.client = client
+        self.dimensions = dimensions
+
+    def get_tile(self, tile_coord, format=None):
+        return self.client.get_tile(tile_coord, format, self.dimensions)
+
+def url_dimensions(template):
+    """
+    Return dict with lower case names of all dimensions in `template`.
+
+    >>> url_dimensions('http://example.org/%(Time)s/%(z)s/%(x)s/%(y)s.png')
+    {'time': 'Time'}
+    """
+    return dict((name.lower(), name) for name in re.findall(r'%\((\w+)\)s', template)
+        if name not in TILE_URL_PARAMETERS)
+
+
+class DimensionTileSourceConfiguration(loader.TileSourceConfiguration):
+    """
+    Configuration of tile sources with dimensions in the URL template.
+    Other tile sources are configured as before.
+    """
+    def source(self, params=None):
+        source = loader.TileSourceConfiguration.source(self, params)
+        if not isinstance(source, TiledSource) or not url_dimensions(self.conf['url']):
+            return source
+        template = source.client.url_template
+        client = DimensionTileClient(DimensionTileURLTemplate(template.template, format=template.format),
+            http_client=source.client.http_client, grid=source.client.grid)
+        return DimensionTiledSource(source.grid, client, coverage=source.coverage, image_opts=source.image_opts,
+            error_handler=source.error_handler, res_range=source.res_range)
@@ -0,0 +1,244 @@
+"""
+Selection of the format for upstream WMTS tiles.
+
+WMTS capabilities list the available formats of a layer, but they do not
+tell if a layer is opaque (e.g. a base map) or an overlay. The first format
+is often PNG, even if a layer is also available as JPEG. The format is
+selected by a preference policy for opaque layers and for overlays. The
+opacity of a layer can be determined by probing a sample tile.
+"""
+
+from __future__ import absolute_import
+
+import sys
+
+from cStringIO import StringIO
+
+import requests
+
+from mapproxy.util.py import reraise_exception
+
+from .exceptions import CapabilitiesError, UserError, FeatureError
+
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_FORMAT_PREFERENCES = {
+    'opaque': ['image/jpeg', 'image/png8', 'image/png; mode=8bit', 'image/png', 'image/gif'],
+    'transparent': ['image/png8', 'image/png; mode=8bit', 'image/png', 'image/gif'],
+}
+
+def is_transparent_format(format):
+    """
+    >>> is_transparent_format('image/png; mode=8bit')
+    True
+    >>> is_transparent_format('image/jpeg')
+    False
+    """
+    return format.startswith(('image/png', 'image/gif'))
+
+def rank_formats(formats, transparent, preferences=None):
+    """
+    Return `formats` sorted by the preferences for opaque or `transparent`
+    layers. Formats without preference keep their order at the end.
+
+    >>> rank_formats(['image/png', 'image/jpeg'], transparent=False)
+    ['image/jpeg', 'image/png']
+    >>> rank_formats(['image/jpeg', 'image/png', 'image/png8'], transparent=True)
+    ['image/png8', 'image/png', 'image/jpeg']
+    """
+    preferences = preferences or DEFAULT_FORMAT_PREFERENCES
+    preferred = preferences['transparent' if transparent else 'opaque']
+    def key(format):
+        if format in preferred:
+            return preferred.index(format), 0
+        return len(preferred), formats.index(format)
+    return sorted(formats, key=key)
+
+def tile_url_parameter(layer_name, layer, tile_matrix_set_id, format, dimensions=None):
+    """
+    Return the parameters for the `url_template` of `layer`. Dimensions
+    without a value in `dimensions` use the default value.
+    """
+    style = layer.get('default_style') or (layer.get('styles') or [None])[0]
+    url_parameter = {
+        'tile_matrix_set': tile_matrix_set_id,
+        'layer': layer_name,
+        'format': format,
+        'style': style['id'] if style else 'default',
+    }
+    dimensions = dimensions or {}
+    for dim in layer.get('dimensions', []):
+        # replace dimension variables with user provided values...
+        if dim['id'] in dimensions:
+            url_parameter[dim['id']] = dimensions[dim['id']]
+        # or with default values
+        else:
+            url_parameter[dim['id']] = dim.get('default', '')
+    return url_parameter
+
+def sample_tile_url(layer_name, layer, tile_matrix_set, format, dimensions=None):
+    """
+    Return URL of a tile from the center of the first tile matrix of
+    `tile_matrix_set`, or of the first tile matrix with TileMatrixSetLimits.
+    """
+    url = layer['url_template'] % tile_url_parameter(layer_name, layer, tile_matrix_set['id'], format, dimensions)
+    limits = layer.get('matrix_set_limits', {}).get(tile_matrix_set['id']) or {}
+    for tm in tile_matrix_set['tile_matrices']:
+        limit = limits.get(tm['id'])
+        if limits and limit is None:
+            continue
+        num_cols, num_rows = tm['grid_size']
+        if limit and (0 <= limit['min_col'] <= limit['max_col'] < num_cols
+            and 0 <= limit['min_row'] <= limit['max_row'] < num_rows):
+            col = (limit['min_col'] + limit['max_col']) // 2
+            row = (limit['min_row'] + limit['max_row']) // 2
+        else:
+            # no or invalid limits
+            col = num_cols // 2
+            row = num_rows // 2
+        return url % {'z': tm['id'], 'x': col, 'y': row}
+    raise CapabilitiesError('No tile matrix for TileMatrixSet "%s"' % tile_matrix_set['id'])
+
+def probe_transparency(url, timeout=10):
+    """
+    Request the tile `url` and return True if it contains transparent pixels.
+    """
+    from mapproxy.compat.image import Image
+    try:
+        response = requests.get(url, timeout=timeout)
+    except requests.exceptions.RequestException as ex:
+        reraise_exception(CapabilitiesError('Requesting sample tile failed', ex.args[0]), sys.exc_info())
+    if not response.ok:
+        raise CapabilitiesError('Requesting sample tile failed', 'status %d for %s' % (response.status_code, url))
+    try:
+        img = Image.open(StringIO(response.content))
+        img.load()
+    except Exception as ex:
+        reraise_exception(CapabilitiesError('Sample tile is not an image', str(ex)), sys.exc_info())
+
+    if img.mode not in ('RGBA', 'LA') and 'transparency' not in img.info:
+        return False
+    alpha = img.convert('RGBA').split()[3]
+    return alpha.getextrema()[0] < 255
+
+def select_format(layer_name, layer, tile_matrix_set, preferences=None, probe=False, dimensions=None):
+    """
+    Return the preferred format for `layer`.
+
+    Probes a sample tile if `probe` is True, otherwise the layer is handled
+    as an overlay if its first format supports transparency.
+    """
+    formats = layer['formats']
+    if '%(format)s' not in layer['url_template']:
+        # RESTful URLs with a fixed format
+        return formats[0]
+
+    transparent = None
+    if probe:
+        probe_formats = [f for f in formats if is_transparent_format(f)]
+        if not probe_formats:
+            transparent = False
+        else:
+            url = sample_tile_url(layer_name, layer, tile_matrix_set, probe_formats[0], dimensions)
+            try:
+                transparent = probe_transparency(url)
+            except CapabilitiesError as ex:
+                log.warn('unable to probe format of layer "%s": %s', layer_name, ex.system_msg)
+    if transparent is None:
+        transparent = is_transparent_format(formats[0])
+
+    return rank_formats(formats, transparent, preferences)[0]
+
+def format_options(cap, layers, writer_options=None, dimensions=None):
+    """
+    Return the record options with the selected format for each
+    (layer_name, matrix_set_id) of `layers`.
+
+    Returns an empty dict if the ``select_format`` writer option is not
+    set or if a layer is missing (reported by the config writer). The
+    formats are selected when a layer is added or refreshed, and the
+    config writer only reads them from the record.
+    """
+    writer_options = writer_options or {}
+    if not writer_options.get('select_format'):
+        return {}
+
+    formats = []
+    for layer_name, matrix_set_id in layers:
+        layer = cap.layers.get(layer_name)
+        if layer is None or not layer['matrix_sets'] or 'url_template' not in layer:
+            return {}
+        matrix_set = layer['matrix_sets'][0]
+        for cap_matrix_set in layer['matrix_sets']:
+            if cap_matrix_set['id'] == matrix_set_id:
+                matrix_set = cap_matrix_set
+                break
+        format = select_format(layer_name, layer, matrix_set,
+            preferences=writer_options.get('format_preferences'),
+            probe=writer_options.get('probe_format', False), dimensions=dimensions)
+        log.info('selected format %s for layer "%s"', format, layer_name)
+        formats.append(format)
+    return {'format': ','.join(formats)}
+
+
+# image pipelines for the output caches
+IMAGE_PIPELINES = ('png', 'png8', 'jpeg', 'mixed', 'webp')
+
+DEFAULT_JPEG_QUALITY = 90
+
+def cache_image_options(pipeline, jpeg_quality=None):
+    """
+    Return the options of an output cache for the image `pipeline`:
+
+    ``png``
+        PNG with full colors (MapProxy default).
+    ``png8``
+        PNG quantized to 256 colors, with transparency.
+    ``jpeg``
+        JPEG with `jpeg_quality`.
+    ``mixed``
+        JPEG for opaque tiles and PNG for tiles with transparency.
+
+    >>> cache_image_options('jpeg', 80)
+    {'image': {'encoding_options': {'jpeg_quality': 80}}, 'format': 'image/jpeg'}
+    """
+    if pipeline not in IMAGE_PIPELINES:
+        raise UserError('Unknown image pipeline "%s"' % pipeline)
+    if pipeline == 'webp':
+        # no WebP encoder in MapProxy
+        raise FeatureError('WebP not supported by MapProxy')
+
+    if jpeg_quality is not None:
+        try:
+            jpeg_quality = int(jpeg_quality)
+        except ValueError:
+            raise UserError('Invalid JPEG quality "%s"' % jpeg_quality)
+        if not 1 <= jpeg_quality <= 100:
+            raise UserError('Invalid JPEG quality "%s"' % jpeg_quality)
+
+    if pipeline == 'png':
+        return {}
+    if pipeline == 'png8':
+        return {
+            'format': 'image/png',
+            'image': {
+                'mode': 'P',
+                'colors': 256,
+                'transparent': True,
+                'encoding_options': {'quantizer': 'fastoctree'},
+            },
+        }
+    encoding_options = {'jpeg_quality': jpeg_quality or DEFAULT_JPEG_QUALITY}
+    if pipeline == 'jpeg':
+        return {
+            'format': 'image/jpeg',
+            'image': {'encoding_options': encoding_options},
+        }
+    # mixed
+    return {
+        'format': 'mixed',
+        'request_format': 'image/png',
+        'image': {'encoding_options': encoding_options},
+    }
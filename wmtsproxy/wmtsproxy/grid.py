@@ -1,8 +1,15 @@
 import re
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from mapproxy.srs import SRS
 
-from .exceptions import TileMatrixError
+from .exceptions import TileMatrixError, UserError
+from .wmtsparse import TileMatrixSet
 
 test_grid = {
     'id': 'GoogleCRS84Quad',
@@ -29,6 +36,50 @@ test_grid = {
     ]
 }
 
+# output grids of the generated configurations
+OUTPUT_GRIDS = {
+    # custom grids for different names in WMTS URLs
+    'webmercator': {
+        'base': 'GLOBAL_WEBMERCATOR',
+    },
+    'geodetic': {
+        'base': 'GLOBAL_GEODETIC',
+        'origin': 'nw',
+    },
+}
+
+# the grid of the upstream WMTS, served without reprojection
+NATIVE_GRID = 'native'
+
+DEFAULT_OUTPUT_GRIDS = ['webmercator']
+
+output_grid_aliases = {
+    'EPSG:3857': 'webmercator',
+    'EPSG:900913': 'webmercator',
+    'EPSG:4326': 'geodetic',
+}
+
+def output_grid_names(grids):
+    """
+    Return list of output grid names for the comma separated `grids`.
+
+    >>> output_grid_names('EPSG:3857,native')
+    ['webmercator', 'native']
+    >>> output_grid_names('')
+    ['webmercator']
+    """
+    names = []
+    for name in grids.split(','):
+        name = name.strip()
+        if not name:
+            continue
+        name = output_grid_aliases.get(name, name)
+        if name not in OUTPUT_GRIDS and name != NATIVE_GRID:
+            raise UserError('Unknown output grid "%s"' % name)
+        if name not in names:
+            names.append(name)
+    return names or list(DEFAULT_OUTPUT_GRIDS)
+
 def merge_bbox(a, b):
     if a is None:
         return b
@@ -89,6 +140,80 @@ def _split_tm_identifier(s):
     return int(s[start:]), s[:result.start()]
 
 def make_mapproxy_grid(tile_matrix_set):
+    """
+    Return dict with the MapProxy grid parameters of `tile_matrix_set`.
+    Uses NumPy to check and convert all TileMatrices of parsed
+    TileMatrixSets at once, if available.
+    """
+    if numpy is not None and isinstance(tile_matrix_set, TileMatrixSet) and tile_matrix_set.ids:
+        return _make_mapproxy_grid_numpy(tile_matrix_set)
+    return _make_mapproxy_grid(tile_matrix_set)
+
+def _check_tm_identifiers(ids):
+    """
+    Return (index, error) of the first invalid TileMatrix identifier,
+    (None, None) if all are valid, and the common prefix.
+    """
+    number = -1
+    prefix = None
+    for i, id in enumerate(ids):
+        _number, _prefix = _split_tm_identifier(id)
+        if not (number + 1) == _number:
+            return (i, 'TileMatrixSet without numeric range identifier'), prefix
+        number = _number
+        if prefix is not None and _prefix != prefix:
+            return (i, 'TileMatrixSet without clearly identifier'), prefix
+        prefix = _prefix
+    return (None, None), prefix
+
+def _first_mismatch(values):
+    """
+    Return the index of the first row of `values` that differs from the
+    first row, or None.
+    """
+    mismatch = numpy.flatnonzero((values != values[0]).any(axis=1))
+    if len(mismatch):
+        return int(mismatch[0])
+    return None
+
+def _make_mapproxy_grid_numpy(tile_matrix_set):
+    srs = crs_to_mapproxy_srs(tile_matrix_set['crs'])
+    ids = tile_matrix_set.ids
+    top_lefts = numpy.frombuffer(tile_matrix_set.top_lefts, dtype=numpy.float64).reshape(-1, 2)
+    sizes = numpy.frombuffer(tile_matrix_set.sizes, dtype=numpy.int_).reshape(-1, 4)
+    scale_denoms = numpy.frombuffer(tile_matrix_set.scale_denoms, dtype=numpy.float64)
+
+    # raise the same error as _make_mapproxy_grid: errors of the first
+    # invalid TileMatrix, in the order of the checks
+    errors = []
+    id_error, prefix = _check_tm_identifiers(ids)
+    if id_error[0] is not None:
+        errors.append((id_error[0], 0, id_error[1]))
+    index = _first_mismatch(sizes[:, :2])
+    if index is not None:
+        errors.append((index, 1, 'TileMatrixSet with non-uniform TileWidth/TileHeight'))
+    index = _first_mismatch(top_lefts)
+    if index is not None:
+        errors.append((index, 2, 'TileMatrixSet with non-uniform TopLeftCorners'))
+    if errors:
+        raise TileMatrixError(min(errors)[2])
+
+    resolutions = scale_denoms * 0.28e-3 / meters_per_unit(srs)
+    tile_size = (int(sizes[-1, 0]), int(sizes[-1, 1]))
+    num_tiles = (int(sizes[-1, 2]), int(sizes[-1, 3]))
+    tl = (float(top_lefts[-1, 0]), float(top_lefts[-1, 1]))
+
+    return {
+        'tile_size': tile_size,
+        'resolutions': resolutions.tolist(),
+        'bbox': tm_bbox(float(resolutions[-1]), tl, tile_size, num_tiles),
+        'srs': srs,
+        'number_range': True,
+        'prefix': prefix,
+        'name': tile_matrix_set['id'].replace(':', '_')
+    }
+
+def _make_mapproxy_grid(tile_matrix_set):
     srs = crs_to_mapproxy_srs(tile_matrix_set['crs'])
     previous_tl = None
     previous_tile_size = None
@@ -141,6 +266,129 @@ def tm_bbox(res, tl, tile_size, num_tiles):
     )
     return tuple(round(x, 8) for x in (tl[1], br[0], br[1], tl[0]))
 
+def tile_matrix_limits_bboxes(tile_matrix_set, limits):
+    """
+    Return list of (level, bbox) tuples with the extent of the TileMatrixLimits
+    for each TileMatrix in `limits`.
+    """
+    srs = crs_to_mapproxy_srs(tile_matrix_set['crs'])
+    result = []
+    for level, tm in enumerate(tile_matrix_set['tile_matrices']):
+        limit = limits.get(tm['id'])
+        if limit is None:
+            continue
+        num_cols, num_rows = tm['grid_size']
+        if not (0 <= limit['min_col'] <= limit['max_col'] < num_cols
+            and 0 <= limit['min_row'] <= limit['max_row'] < num_rows):
+            raise TileMatrixError('TileMatrixLimits outside of TileMatrix "%s"' % tm['id'])
+
+        res = scale_to_res(tm['scale_denom'], srs)
+        tl = tm['top_left']
+        tile_width, tile_height = tm['tile_size']
+        bbox = (
+            tl[1] + limit['min_col'] * tile_width * res,
+            tl[0] - (limit['max_row'] + 1) * tile_height * res,
+            tl[1] + (limit['max_col'] + 1) * tile_width * res,
+            tl[0] - limit['min_row'] * tile_height * res,
+        )
+        result.append((level, tuple(round(x, 8) for x in bbox)))
+    return result
+
+def bbox_contains(a, b):
+    return a[0] <= b[0] and a[1] <= b[1] and a[2] >= b[2] and a[3] >= b[3]
+
+def limits_coverage_bbox(level_bboxes):
+    """
+    Return a single bbox for the (level, bbox) tuples of all TileMatrixLimits.
+
+    This is the bbox of the most detailed level, if all other levels contain
+    that bbox (i.e. the limits only differ by the size of the tiles),
+    or the union of all bboxes.
+    """
+    if not level_bboxes:
+        return None
+    finest_bbox = max(level_bboxes)[1]
+    if all(bbox_contains(bbox, finest_bbox) for _, bbox in level_bboxes):
+        return finest_bbox
+    bbox = None
+    for _, level_bbox in level_bboxes:
+        bbox = merge_bbox(bbox, level_bbox)
+    return bbox
+
+def levels_res_range(resolutions, levels, srs):
+    """
+    Return (min_res, max_res) in meter/pixel so that only the resolutions of
+    the `levels` are included. min_res or max_res is None if the first
+    or the last level is included.
+    """
+    first, last = min(levels), max(levels)
+    mpu = meters_per_unit(srs)
+    min_res = max_res = None
+    if first > 0:
+        min_res = math.sqrt(resolutions[first - 1] * resolutions[first]) * mpu
+    if last < len(resolutions) - 1:
+        max_res = math.sqrt(resolutions[last] * resolutions[last + 1]) * mpu
+    return min_res, max_res
+
+# EPSG codes of the GLOBAL_WEBMERCATOR grid
+WEBMERCATOR_SRS = ('EPSG:3857', 'EPSG:900913', 'EPSG:102100', 'EPSG:102113')
+WEBMERCATOR_EXTENT = 20037508.342789244
+WEBMERCATOR_LEVELS = 20
+
+def webmercator_resolutions(tile_size=256, num_levels=WEBMERCATOR_LEVELS):
+    return [2 * WEBMERCATOR_EXTENT / tile_size / 2**level for level in range(num_levels)]
+
+def snap_to_webmercator(grid, tolerance=2):
+    """
+    Snap resolutions and origin of the `grid` from `make_mapproxy_grid` to
+    the GLOBAL_WEBMERCATOR grid, if they differ by at most `tolerance` pixels
+    at the last column/row of each level. Only levels up to the last level of
+    GLOBAL_WEBMERCATOR are snapped. The origin is shared by all levels, so
+    no level is snapped if the origin differs by more than `tolerance`
+    pixels at the finest level of the grid.
+
+    MapProxy can only copy tiles between caches if the resolutions are
+    identical, capabilities documents often contain rounded values.
+    Returns list of all snapped levels.
+    """
+    if grid['srs'].srs_code not in WEBMERCATOR_SRS or grid['tile_size'] != (256, 256):
+        return []
+    target_resolutions = webmercator_resolutions()
+    origin_offset = max(abs(grid['bbox'][0] + WEBMERCATOR_EXTENT), abs(grid['bbox'][3] - WEBMERCATOR_EXTENT))
+    if origin_offset / min(grid['resolutions']) > tolerance:
+        return []
+
+    snapped = []
+    resolutions = list(grid['resolutions'])
+    for level, res in enumerate(resolutions):
+        target_level = min(range(len(target_resolutions)), key=lambda l: abs(target_resolutions[l] - res))
+        target_res = target_resolutions[target_level]
+        level_size = 2 * WEBMERCATOR_EXTENT / target_res
+        if abs(res - target_res) / target_res * level_size > tolerance:
+            continue
+        resolutions[level] = target_res
+        snapped.append(level)
+
+    if snapped:
+        grid['resolutions'] = resolutions
+        minx, miny, maxx, maxy = grid['bbox']
+        grid['bbox'] = (-WEBMERCATOR_EXTENT, miny, maxx, WEBMERCATOR_EXTENT)
+    return snapped
+
+def resample_ratios(target_resolutions, source_resolutions):
+    """
+    Return the ratio between each target resolution and the closest
+    source resolution. Tiles are copied without resampling if the ratio is 1.
+
+    >>> resample_ratios([4, 2, 1], [4, 1.5])
+    [1.0, 1.3333333333333333, 0.6666666666666666]
+    """
+    ratios = []
+    for target_res in target_resolutions:
+        source_res = min(source_resolutions, key=lambda res: abs(math.log(res / target_res)))
+        ratios.append(float(target_res) / source_res)
+    return ratios
+
 def meters_per_unit(srs):
     if srs.is_latlong:
         return 20037508.342789244 / 180.0
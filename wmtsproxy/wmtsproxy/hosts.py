@@ -0,0 +1,192 @@
+"""
+Limits for requests to upstream hosts.
+
+The ``host_policies`` writer option is a dict with a policy for each
+upstream host. Keys are host names (``tiles.example.org``), host names
+with port (``example.org:8080``) or patterns (``*.example.org``, ``*``
+for all other hosts). A policy is a dict with:
+
+``concurrent_requests``
+    Maximum number of parallel requests to the host.
+``client_timeout``
+    Timeout in seconds for requests to the host.
+
+`apply_host_policies` adds these settings to all sources of a generated
+configuration. MapProxy limits the requests of WMS sources with a file
+lock for each host in ``globals.cache.lock_dir``, so the limit is shared
+by all apps and processes that use the same lock directory.
+`HostLimitedTileSourceConfiguration` uses the same locks for tile
+sources, where MapProxy ignores ``concurrent_requests``. It is only used
+for configurations that are loaded with `load_mapproxy_conf`.
+"""
+
+from __future__ import absolute_import
+
+import os
+import fnmatch
+import hashlib
+
+from urlparse import urlparse
+
+from mapproxy.config import loader
+from mapproxy.config.spec import validate_options
+from mapproxy.config.validator import validate_references
+from mapproxy.util.yaml import YAMLError
+from mapproxy.source.tile import TiledSource
+from mapproxy.util.lock import SemLock
+
+from .dimensions import DimensionTileSourceConfiguration
+from .exceptions import ConfigWriterError
+
+import logging
+
+log = logging.getLogger(__name__)
+
+HOST_POLICY_OPTIONS = ('concurrent_requests', 'client_timeout')
+
+def host_policy(url, policies):
+    """
+    Return the policy for the host of `url`. Host names with port are
+    preferred to host names, and host names to patterns. The longest
+    matching pattern is used.
+
+    >>> policies = {'*': {'concurrent_requests': 8}, '*.example.org': {'concurrent_requests': 2},
+    ...     'tiles.example.org:8080': {'concurrent_requests': 1}}
+    >>> host_policy('http://tiles.example.org/wmts', policies)
+    {'concurrent_requests': 2}
+    >>> host_policy('http://tiles.example.org:8080/wmts', policies)
+    {'concurrent_requests': 1}
+    >>> host_policy('http://osm.omniscale.net/proxy/service', policies)
+    {'concurrent_requests': 8}
+    """
+    if not policies:
+        return {}
+    url = urlparse(url)
+    host = (url.hostname or '').lower()
+    netloc = host + (':%d' % url.port if url.port else '')
+    for name in (netloc, host):
+        if name in policies:
+            return policies[name]
+    patterns = [p for p in policies if fnmatch.fnmatchcase(host, p.lower()) or fnmatch.fnmatchcase(netloc, p.lower())]
+    if not patterns:
+        return {}
+    return policies[max(patterns, key=len)]
+
+def check_host_policy(name, policy):
+    for key, value in policy.iteritems():
+        if key not in HOST_POLICY_OPTIONS:
+            raise ConfigWriterError('Unknown option "%s" in host policy for "%s"' % (key, name))
+        if not isinstance(value, (int, long, float)) or value <= 0:
+            raise ConfigWriterError('Invalid %s "%s" in host policy for "%s"' % (key, value, name))
+
+def source_url(source):
+    if source.get('type') == 'wms':
+        return source['req']['url']
+    return source.get('url')
+
+def apply_host_policies(mapproxy_conf, policies):
+    """
+    Set ``concurrent_requests`` and ``http.client_timeout`` of all
+    sources of `mapproxy_conf` from the host `policies`.
+
+    >>> conf = {'sources': {'s': {'type': 'tile', 'url': 'http://example.org/%(z)s/%(x)s/%(y)s.png'}}}
+    >>> source = apply_host_policies(conf, {'example.org': {'concurrent_requests': 2, 'client_timeout': 10}})['sources']['s']
+    >>> source['concurrent_requests'], source['http']
+    (2, {'client_timeout': 10})
+    """
+    if not policies:
+        return mapproxy_conf
+    for name, policy in policies.iteritems():
+        check_host_policy(name, policy)
+    for source in mapproxy_conf['sources'].itervalues():
+        url = source_url(source)
+        if not url:
+            continue
+        policy = host_policy(url, policies)
+        if policy.get('concurrent_requests'):
+            source['concurrent_requests'] = int(policy['concurrent_requests'])
+        if policy.get('client_timeout'):
+            source.setdefault('http', {})['client_timeout'] = policy['client_timeout']
+    return mapproxy_conf
+
+
+def host_lock_file(lock_dir, url):
+    """
+    Return the lock file for requests to the host of `url`. Same as the
+    lock file of MapProxy WMS sources.
+    """
+    netloc = urlparse(url).netloc
+    return os.path.join(lock_dir, hashlib.md5(netloc.encode('ascii')).hexdigest() + '.lck')
+
+class LimitedTileClient(object):
+    """
+    Tile client that requests each tile with the `lock`.
+    """
+    def __init__(self, client, lock):
+        self.client = client
+        self.lock = lock
+
+    def get_tile(self, *args, **kw):
+        with self.lock():
+            return self.client.get_tile(*args, **kw)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+class HostLimitedTileSourceConfiguration(DimensionTileSourceConfiguration):
+    """
+    Configuration of tile sources with ``concurrent_requests``.
+    """
+    def source(self, params=None):
+        source = DimensionTileSourceConfiguration.source(self, params)
+        concurrent_requests = self.context.globals.get_value('concurrent_requests', self.conf,
+            global_key='http.concurrent_requests')
+        if not concurrent_requests or not isinstance(source, TiledSource):
+            return source
+        lock_dir = self.context.globals.get_path('cache.lock_dir', self.conf)
+        lock_timeout = self.context.globals.get_value('http.client_timeout', self.conf)
+        lock_file = host_lock_file(lock_dir, self.conf['url'])
+        source.client = LimitedTileClient(source.client,
+            lambda: SemLock(lock_file, concurrent_requests, timeout=lock_timeout))
+        return source
+
+class WMTSProxyConfiguration(loader.ProxyConfiguration):
+    """
+    MapProxy configuration with `HostLimitedTileSourceConfiguration` for
+    all tile sources. ``source_configuration_types`` of MapProxy is not
+    changed, so other MapProxy configurations in the same process keep
+    the tile sources of MapProxy.
+    """
+    def load_sources(self):
+        self.sources = loader.SourcesCollection()
+        for source_name, source_conf in (self.configuration.get('sources') or {}).items():
+            if source_conf.get('type') == 'tile':
+                source = HostLimitedTileSourceConfiguration(conf=source_conf, context=self)
+            else:
+                source = loader.SourceConfiguration.load(conf=source_conf, context=self)
+            self.sources[source_name] = source
+
+def load_mapproxy_conf(conf_dict, conf_base_dir, seed=False):
+    """
+    Return `WMTSProxyConfiguration` for the (merged) configuration dict.
+    Validates the configuration like `mapproxy.config.loader.load_configuration`.
+    """
+    errors, informal_only = validate_options(conf_dict)
+    for error in errors:
+        log.warn(error)
+    if not informal_only:
+        raise loader.ConfigurationError('invalid configuration')
+    for error in validate_references(conf_dict):
+        log.warn(error)
+    return WMTSProxyConfiguration(conf_dict, conf_base_dir=conf_base_dir, seed=seed)
+
+def load_mapproxy_conf_file(filename, seed=False):
+    """
+    Return `WMTSProxyConfiguration` for the configuration file `filename`.
+    """
+    conf_base_dir = os.path.abspath(os.path.dirname(filename))
+    try:
+        conf_dict = loader.load_configuration_file([os.path.basename(filename)], conf_base_dir)
+    except YAMLError as ex:
+        raise loader.ConfigurationError(ex)
+    return load_mapproxy_conf(conf_dict, conf_base_dir, seed=seed)
@@ -0,0 +1,559 @@
+"""
+Load tests with replayed or synthetic tile requests.
+
+Replays the tile requests of an access log, or a stream of requests with
+Zipf distributed tile popularity, against ``make_wsgi_app``. All layers
+use a local stub WMTS or WMS (`StubUpstream`) that serves generated
+capabilities and tiles with configurable latency and error rate, so that
+no real upstream service is required.
+
+The requests are sent to the WSGI app in-process, or over a local HTTP
+server with ``--server``. The report contains the throughput, the
+latency percentiles, the response status codes and the number of
+upstream requests.
+"""
+
+from __future__ import absolute_import
+
+import os
+import re
+import sys
+import math
+import time
+import json
+import random
+import shutil
+import bisect
+import httplib
+import optparse
+import tempfile
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from cStringIO import StringIO
+from collections import Counter
+from urlparse import urlparse, parse_qsl
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+import logging
+
+from . import csv
+from .seed import parse_levels
+from .wsgi import make_wsgi_app
+
+log = logging.getLogger(__name__)
+
+# scale denominator of level 0 of the GoogleMapsCompatible matrix set
+WEBMERCATOR_SCALE_DENOM = 559082264.0287178
+WEBMERCATOR_EXTENT = 20037508.3428
+
+WMTS_CAPABILITIES = '''<?xml version="1.0" encoding="UTF-8"?>
+<Capabilities xmlns="http://www.opengis.net/wmts/1.0" xmlns:ows="http://www.opengis.net/ows/1.1"
+    xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0.0">
+  <ows:ServiceIdentification>
+    <ows:Title>Stub WMTS</ows:Title>
+    <ows:ServiceType>OGC WMTS</ows:ServiceType>
+    <ows:ServiceTypeVersion>1.0.0</ows:ServiceTypeVersion>
+  </ows:ServiceIdentification>
+  <Contents>
+%(layers)s
+    <TileMatrixSet>
+      <ows:Identifier>GoogleMapsCompatible</ows:Identifier>
+      <ows:SupportedCRS>urn:ogc:def:crs:EPSG::900913</ows:SupportedCRS>
+%(tile_matrices)s
+    </TileMatrixSet>
+  </Contents>
+</Capabilities>
+'''
+
+WMTS_LAYER = '''    <Layer>
+      <ows:Title>%(name)s</ows:Title>
+      <ows:WGS84BoundingBox>
+        <ows:LowerCorner>-180 -85.051129</ows:LowerCorner>
+        <ows:UpperCorner>180 85.051129</ows:UpperCorner>
+      </ows:WGS84BoundingBox>
+      <ows:Identifier>%(name)s</ows:Identifier>
+      <Style isDefault="true"><ows:Identifier>default</ows:Identifier></Style>
+      <Format>image/png</Format>
+      <TileMatrixSetLink><TileMatrixSet>GoogleMapsCompatible</TileMatrixSet></TileMatrixSetLink>
+      <ResourceURL format="image/png" resourceType="tile"
+        template="%(url)s/wmts/%(name)s/{TileMatrixSet}/{TileMatrix}/{TileRow}/{TileCol}.png"/>
+    </Layer>'''
+
+WMTS_TILE_MATRIX = '''      <TileMatrix>
+        <ows:Identifier>%(level)d</ows:Identifier>
+        <ScaleDenominator>%(scale_denom)r</ScaleDenominator>
+        <TopLeftCorner>-%(extent)s %(extent)s</TopLeftCorner>
+        <TileWidth>256</TileWidth>
+        <TileHeight>256</TileHeight>
+        <MatrixWidth>%(size)d</MatrixWidth>
+        <MatrixHeight>%(size)d</MatrixHeight>
+      </TileMatrix>'''
+
+WMS_CAPABILITIES = '''<?xml version="1.0"?>
+<WMT_MS_Capabilities version="1.1.1" xmlns:xlink="http://www.w3.org/1999/xlink">
+  <Service><Name>OGC:WMS</Name><Title>Stub WMS</Title></Service>
+  <Capability>
+    <Request>
+      <GetMap>
+        <Format>image/png</Format>
+        <DCPType><HTTP><Get><OnlineResource xlink:href="%(url)s/wms?"/></Get></HTTP></DCPType>
+      </GetMap>
+    </Request>
+    <Layer>
+      <Title>Stub WMS</Title>
+      <SRS>EPSG:3857</SRS>
+      <SRS>EPSG:4326</SRS>
+      <LatLonBoundingBox minx="-180" miny="-85" maxx="180" maxy="85" />
+%(layers)s
+    </Layer>
+  </Capability>
+</WMT_MS_Capabilities>
+'''
+
+WMS_LAYER = '''      <Layer><Name>%(name)s</Name><Title>%(name)s</Title></Layer>'''
+
+def stub_layer_names(num_layers):
+    return ['layer%d' % i for i in range(num_layers)]
+
+
+class StubUpstreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        upstream = self.server.upstream
+        path = urlparse(self.path).path
+        if path.endswith('WMTSCapabilities.xml'):
+            kind, body, content_type = 'capabilities', upstream.wmts_capabilities(), 'application/xml'
+        elif path == '/wms' and dict((k.upper(), v) for k, v in parse_qsl(urlparse(self.path).query)).get(
+                'REQUEST', '').lower() == 'getcapabilities':
+            kind, body, content_type = 'capabilities', upstream.wms_capabilities(), 'application/vnd.ogc.wms_xml'
+        elif path == '/wms':
+            params = dict((k.upper(), v) for k, v in parse_qsl(urlparse(self.path).query))
+            size = int(params.get('WIDTH', 256)), int(params.get('HEIGHT', 256))
+            kind, body, content_type = 'map', upstream.image(size), 'image/png'
+        elif path.startswith('/wmts/'):
+            kind, body, content_type = 'tile', upstream.image((256, 256)), 'image/png'
+        else:
+            self.send_error(404)
+            return
+
+        upstream.count(kind)
+        if kind != 'capabilities':
+            # parallel requests while the response is prepared
+            upstream.enter()
+        try:
+            if upstream.latency:
+                time.sleep(upstream.latency)
+        finally:
+            if kind != 'capabilities':
+                upstream.leave()
+        if kind != 'capabilities' and upstream.random.random() < upstream.error_rate:
+            upstream.count('error')
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class StubUpstream(object):
+    """
+    Local WMTS and WMS with `num_layers` layers in EPSG:3857. Tiles and
+    maps are answered after `latency` seconds and fail with status 500
+    for `error_rate` of all requests.
+    """
+    def __init__(self, num_layers=4, max_level=18, latency=0.0, error_rate=0.0, seed=None):
+        self.layer_names = stub_layer_names(num_layers)
+        self.max_level = max_level
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.counts = Counter()
+        self._active = 0
+        self._images = {}
+        self._lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_port
+
+    @property
+    def wmts_url(self):
+        return self.url + '/wmts/1.0.0/WMTSCapabilities.xml'
+
+    @property
+    def wms_url(self):
+        return self.url + '/wms?SERVICE=WMS&REQUEST=GetCapabilities'
+
+    def count(self, kind):
+        with self._lock:
+            self.counts[kind] += 1
+
+    def enter(self):
+        # maximum number of parallel tile or map requests is reported as max_parallel
+        with self._lock:
+            self._active += 1
+            self.counts['max_parallel'] = max(self.counts['max_parallel'], self._active)
+
+    def leave(self):
+        with self._lock:
+            self._active -= 1
+
+    def wmts_capabilities(self):
+        layers = '\n'.join(WMTS_LAYER % {'name': name, 'url': self.url} for name in self.layer_names)
+        tile_matrices = '\n'.join(WMTS_TILE_MATRIX % {
+            'level': level,
+            'scale_denom': WEBMERCATOR_SCALE_DENOM / 2 ** level,
+            'extent': WEBMERCATOR_EXTENT,
+            'size': 2 ** level,
+        } for level in range(self.max_level + 1))
+        return WMTS_CAPABILITIES % {'layers': layers, 'tile_matrices': tile_matrices}
+
+    def wms_capabilities(self):
+        layers = '\n'.join(WMS_LAYER % {'name': name} for name in self.layer_names)
+        return WMS_CAPABILITIES % {'layers': layers, 'url': self.url}
+
+    def image(self, size):
+        with self._lock:
+            if size not in self._images:
+                from mapproxy.compat.image import Image
+                buf = StringIO()
+                Image.new('RGB', size, (200, 220, 240)).save(buf, 'PNG')
+                self._images[size] = buf.getvalue()
+            return self._images[size]
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubUpstreamHandler)
+        self.server.upstream = self
+        t = threading.Thread(target=self.server.serve_forever, args=(0.05, ))
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+log_request_re = re.compile(r'"(?:GET|HEAD) (\S+) HTTP/[\d.]+"')
+
+def access_log_paths(lines):
+    """
+    Return the paths of all GET requests of an access log in the
+    common or combined log format.
+
+    >>> list(access_log_paths(['127.0.0.1 - - [10/Oct/2014:13:55:36 +0200] "GET /osm/wmts/map/webmercator/1/0/1.png HTTP/1.1" 200 2326']))
+    ['/osm/wmts/map/webmercator/1/0/1.png']
+    """
+    for line in lines:
+        match = log_request_re.search(line)
+        if match:
+            yield match.group(1)
+
+def map_app_ids(paths, app_ids):
+    """
+    Replace the app id of each path with one of `app_ids`. Each id of the
+    log is always replaced with the same id, so that the distribution of
+    the requests is kept.
+
+    >>> list(map_app_ids(['/a/wmts/x', '/b/tiles/y', '/a/wmts/z'], ['l0']))
+    ['/l0/wmts/x', '/l0/tiles/y', '/l0/wmts/z']
+    """
+    mapping = {}
+    for path in paths:
+        parts = path.split('/', 2)
+        if len(parts) < 3 or not parts[1]:
+            continue
+        if parts[1] not in mapping:
+            mapping[parts[1]] = app_ids[len(mapping) % len(app_ids)]
+        yield '/%s/%s' % (mapping[parts[1]], parts[2])
+
+def zipf_paths(num_requests, app_ids, levels=(0, 10), s=1.1, seed=None):
+    """
+    Return `num_requests` WMTS tile paths with Zipf distributed tile
+    popularity. Tiles of lower levels are more popular. Each level has
+    at most 10000 distinct tiles, near the center of the grid.
+    """
+    rnd = random.Random(seed)
+    tiles = []
+    for level in range(levels[0], levels[1] + 1):
+        size = 2 ** level
+        # tiles near the center of each level
+        n = min(size, 100)
+        offset = (size - n) // 2
+        level_tiles = [(level, offset + x, offset + y) for x in range(n) for y in range(n)]
+        rnd.shuffle(level_tiles)
+        tiles.extend(level_tiles)
+
+    cumulative = []
+    total = 0.0
+    for rank in range(1, len(tiles) * len(app_ids) + 1):
+        total += 1.0 / rank ** s
+        cumulative.append(total)
+
+    paths = []
+    for _ in range(num_requests):
+        rank = bisect.bisect_left(cumulative, rnd.random() * total)
+        app_id = app_ids[rank % len(app_ids)]
+        z, x, y = tiles[rank // len(app_ids)]
+        paths.append('/%s/wmts/map/webmercator/%d/%d/%d.png' % (app_id, z, x, y))
+    return paths
+
+def percentile(values, p):
+    """
+    Return the `p` percentile of the sorted `values` (nearest rank).
+
+    >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 50)
+    5
+    >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 99)
+    10
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+class InProcessClient(object):
+    """
+    Calls the WSGI app directly.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    def get(self, path):
+        path, _, query = path.partition('?')
+        environ = {
+            'PATH_INFO': path, 'QUERY_STRING': query, 'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '',
+            'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+            'wsgi.url_scheme': 'http', 'wsgi.input': StringIO(), 'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+        }
+        status = []
+        def start_response(s, headers, exc_info=None):
+            status.append(s)
+        result = self.app(environ, start_response)
+        try:
+            for _ in result:
+                pass
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return int(status[0].split(' ', 1)[0])
+
+class HTTPClient(object):
+    """
+    Requests a local HTTP server with one connection per thread.
+    """
+    def __init__(self, port):
+        self.port = port
+        self._local = threading.local()
+
+    def get(self, path):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        except (httplib.HTTPException, IOError):
+            self._local.conn = None
+            conn.close()
+            raise
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def serve(app):
+    """
+    Serve `app` on a local port in a background thread.
+    """
+    server = make_server('127.0.0.1', 0, app, server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+    t = threading.Thread(target=server.serve_forever, args=(0.05, ))
+    t.daemon = True
+    t.start()
+    return server
+
+def run_requests(client, paths, concurrency=8):
+    """
+    Request all `paths` with `concurrency` threads. Returns the latency in
+    seconds and the status code of each request, and the duration.
+    """
+    paths = iter(paths)
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                path = next(paths, None)
+            if path is None:
+                return
+            start = time.time()
+            try:
+                status = client.get(path)
+            except Exception as ex:
+                log.warn('request for %s failed: %s', path, ex)
+                status = 0
+            latency = time.time() - start
+            with lock:
+                results.append((latency, status))
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.time() - start
+
+def make_report(results, duration, upstream_counts):
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        'requests': len(results),
+        'duration': duration,
+        'throughput': len(results) / duration if duration else None,
+        'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+        'status': dict(Counter(status for _, status in results)),
+        'upstream': dict(upstream_counts),
+    }
+
+def format_report(report):
+    lines = [
+        'requests:   %d in %.2fs' % (report['requests'], report['duration']),
+        'throughput: %.1f req/s' % (report['throughput'] or 0),
+        'latency:    p50 %.1fms, p99 %.1fms' % (report['p50_ms'] or 0, report['p99_ms'] or 0),
+        'status:     %s' % ', '.join('%s: %d' % item for item in sorted(report['status'].items())),
+        'upstream:   %s' % ', '.join('%s: %d' % item for item in sorted(report['upstream'].items())),
+    ]
+    return '\n'.join(lines)
+
+
+class LoadTest(object):
+    """
+    Temporary WMTSProxy installation with one layer for each layer of a
+    `StubUpstream`. `app_options` are passed to ``make_wsgi_app``.
+    """
+    def __init__(self, upstream, cap_type='wmts', app_options=None):
+        self.upstream = upstream
+        self.cap_type = cap_type
+        self.app_options = app_options or {}
+        self.tmp_dir = None
+        self.app_ids = []
+        self.app = None
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='wmtsproxy-loadtest')
+        base_file = os.path.join(self.tmp_dir, 'base.yaml')
+        with open(base_file, 'w') as f:
+            f.write('globals: {cache: {base_dir: cache_data}}\n')
+        csv_file = os.path.join(self.tmp_dir, 'services.csv')
+        open(csv_file, 'w').close()
+        for layer_name in self.upstream.layer_names:
+            if self.cap_type == 'wmts':
+                self.app_ids.append(csv.to_csv(csv_file, 'wmts', self.upstream.wmts_url, layer_name,
+                    'GoogleMapsCompatible'))
+            else:
+                self.app_ids.append(csv.to_csv(csv_file, 'wms', self.upstream.wms_url, layer_name, 'EPSG:3857'))
+        self.app = make_wsgi_app(os.path.join(self.tmp_dir, 'configs'), base_file, csv_file,
+            **self.app_options)
+
+    def teardown(self):
+        if self.tmp_dir:
+            shutil.rmtree(self.tmp_dir)
+            self.tmp_dir = None
+
+    def run(self, paths, concurrency=8, server=False):
+        """
+        Request `paths` and return the report. The paths are requested
+        over a local HTTP server if `server` is True.
+        """
+        self.upstream.counts.clear()
+        http_server = None
+        if server:
+            http_server = serve(self.app)
+            client = HTTPClient(http_server.server_port)
+        else:
+            client = InProcessClient(self.app)
+        try:
+            results, duration = run_requests(client, paths, concurrency)
+        finally:
+            if http_server is not None:
+                http_server.shutdown()
+                http_server.server_close()
+        return make_report(results, duration, self.upstream.counts)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] [access_log]',
+        description='Replay the tile requests of an access log, or --zipf requests, '
+            'against a temporary WMTSProxy with a local stub upstream.')
+    parser.add_option('--zipf', type='int', default=None, metavar='N',
+        help='send N requests with Zipf distributed tile popularity')
+    parser.add_option('--zipf-s', type='float', default=1.1, help='exponent of the Zipf distribution')
+    parser.add_option('--levels', default='0-10', help='levels of the Zipf requests (default 0-10)')
+    parser.add_option('--layers', type='int', default=4, help='number of upstream layers')
+    parser.add_option('--type', default='wmts', choices=['wmts', 'wms'], help='type of the stub upstream')
+    parser.add_option('--latency', type='float', default=0.0, help='upstream latency in seconds')
+    parser.add_option('--error-rate', type='float', default=0.0, help='fraction of failed upstream requests')
+    parser.add_option('--concurrency', type='int', default=8)
+    parser.add_option('--server', action='store_true', default=False,
+        help='send the requests over a local HTTP server instead of in-process')
+    parser.add_option('--concurrent-requests', type='int', default=None,
+        help='host policy with maximum number of parallel upstream requests')
+    parser.add_option('--in-memory', action='store_true', default=False)
+    parser.add_option('--watch', action='store_true', default=False)
+    parser.add_option('--seed', type='int', default=None, help='random seed')
+    parser.add_option('--json', action='store_true', default=False, help='print report as JSON')
+
+    options, args = parser.parse_args(argv)
+    if not options.zipf and len(args) != 1:
+        parser.error('missing access_log or --zipf')
+
+    logging.basicConfig(level=logging.ERROR)
+
+    upstream = StubUpstream(num_layers=options.layers, latency=options.latency,
+        error_rate=options.error_rate, seed=options.seed)
+    upstream.start()
+    app_options = {'in_memory': options.in_memory, 'watch': options.watch}
+    if options.concurrent_requests:
+        app_options['writer_options'] = {
+            'host_policies': {'127.0.0.1': {'concurrent_requests': options.concurrent_requests}}}
+    load_test = LoadTest(upstream, cap_type=options.type, app_options=app_options)
+    try:
+        load_test.setup()
+        if options.zipf:
+            paths = zipf_paths(options.zipf, load_test.app_ids, parse_levels(options.levels),
+                s=options.zipf_s, seed=options.seed)
+        else:
+            with open(args[0]) as f:
+                paths = list(map_app_ids(access_log_paths(f), load_test.app_ids))
+        report = load_test.run(paths, concurrency=options.concurrency, server=options.server)
+    finally:
+        load_test.teardown()
+        upstream.stop()
+
+    if options.json:
+        print json.dumps(report, indent=2, sort_keys=True)
+    else:
+        print format_report(report)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,257 @@
+"""
+Detection of changed capabilities.
+
+Configurations are only created again when the timestamp of their CSV
+record changes, e.g. when a layer is added again. The refresher requests
+all capabilities of the CSV file periodically and calculates a hash of the
+parts of each layer that are relevant for its configuration (e.g. the
+TileMatrixSet, URL template, formats and dimensions of WMTS layers).
+
+Two hashes are stored in the record options. The ``tile_hash`` covers
+all parts that change the requested tiles (e.g. the TileMatrixSet or the
+URL template). If it changes, the refresher updates the record timestamp,
+so that the configuration is created again with new caches (see
+`config_writer.cache_name`) and no outdated tiles are served. The
+``meta_hash`` covers all other parts (e.g. the formats and dimension
+values). If only it changes, the refresher sets the ``refreshed`` option.
+The configuration is created again, but the record timestamp and thus
+the cached tiles are kept.
+
+With the ``select_format`` writer option, the refresher also selects the
+formats of WMTS records without a stored format (e.g. records that were
+added to the CSV file by hand), see `formats.format_options`.
+"""
+
+from __future__ import absolute_import
+
+import sys
+import json
+import time
+import hashlib
+import threading
+import optparse
+
+from array import array
+
+import logging
+
+from . import csv
+from .capabilities import parsed_wmts_capabilities, parsed_wms_capabilities, wms_layer_index
+from .config_writer import wmts_group_layers, split_group
+from .formats import format_options
+from .wmtsparse import Record
+from .exceptions import WMTSProxyError
+
+log = logging.getLogger(__name__)
+
+def _plain(obj):
+    """
+    Return `obj` with records, tuples, sets and arrays converted to
+    JSON compatible types.
+    """
+    if isinstance(obj, (dict, Record)):
+        return dict((k, _plain(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, array)):
+        return [_plain(v) for v in obj]
+    if isinstance(obj, (set, frozenset)):
+        return sorted(_plain(v) for v in obj)
+    return obj
+
+def wmts_layer_subtrees(cap, layer_name, matrix_set_id, dimensions=None):
+    """
+    Return the parts of a WMTS layer that change the tiles and all other
+    parts that are used for its configuration. Dimensions without a value
+    in `dimensions` use the default value in the tile URL. `dimensions`
+    is None for layers with ``dimension_mode=request``.
+    """
+    layer = cap.layers.get(layer_name)
+    if layer is None:
+        return None, None
+    matrix_sets = [ms for ms in layer['matrix_sets'] if ms['id'] == matrix_set_id] or layer['matrix_sets']
+    tile = {
+        'bbox': layer['bbox'],
+        'matrix_sets': matrix_sets,
+        'matrix_set_limits': layer['matrix_set_limits'],
+        'url_template': layer['url_template'],
+        'styles': layer['styles'],
+        'default_style': layer['default_style'],
+    }
+    if dimensions is not None:
+        tile['dimension_defaults'] = dict((dim['id'], dim.get('default'))
+            for dim in layer['dimensions'] if dim['id'] not in dimensions)
+    meta = {
+        'formats': layer['formats'],
+        'dimensions': layer['dimensions'],
+    }
+    return tile, meta
+
+def wms_layer_subtrees(cap, layer_name):
+    """
+    Return the parts of a WMS layer that change the tiles and all other
+    parts that are used for its configuration.
+    """
+    layer = wms_layer_index(cap).get(layer_name)
+    if layer is None:
+        return None, None
+    tile = dict((key, layer.get(key)) for key in ('url', 'name', 'opaque', 'llbbox', 'bbox_srs', 'res_hint'))
+    return tile, {'srs': layer.get('srs')}
+
+def _hash(obj):
+    content = json.dumps(_plain(obj), sort_keys=True)
+    return hashlib.sha1(content).hexdigest()[:16]
+
+def layer_hashes(rec, cap):
+    """
+    Return the hash of the capabilities parts that change the tiles of
+    `rec` and the hash of all other relevant parts.
+    """
+    if rec.type.startswith('wmts'):
+        dimensions = csv.unserialize_dimensions(rec.dimensions)
+        if csv.record_options(rec).get('dimension_mode') == 'request':
+            dimensions = None
+        if rec.type == 'wmts':
+            layers = [(rec.layer_name, rec.system_id)]
+        else:
+            layers = wmts_group_layers(csv.record_layer_names(rec), rec.system_id)
+        subtrees = [wmts_layer_subtrees(cap, layer_name, matrix_set, dimensions)
+            for layer_name, matrix_set in layers]
+    elif rec.type == 'wms':
+        subtrees = [wms_layer_subtrees(cap, rec.layer_name)]
+    else:
+        subtrees = [wms_layer_subtrees(cap, layer_name) for layer_name in split_group(csv.record_layer_names(rec))]
+    return _hash([tile for tile, meta in subtrees]), _hash([meta for tile, meta in subtrees])
+
+def parsed_record_capabilities(rec):
+    if rec.type.startswith('wmts'):
+        return parsed_wmts_capabilities(rec.url)
+    return parsed_wms_capabilities(rec.url)
+
+def record_format_options(rec, cap, writer_options=None):
+    """
+    Return the options with the selected formats for WMTS records without
+    a stored format.
+    """
+    if not rec.type.startswith('wmts') or csv.record_options(rec).get('format'):
+        return {}
+    if rec.type == 'wmts_group':
+        layers = wmts_group_layers(csv.record_layer_names(rec), rec.system_id)
+        return format_options(cap, layers, writer_options)
+    dimensions = csv.unserialize_dimensions(rec.dimensions)
+    return format_options(cap, [(rec.layer_name, rec.system_id)], writer_options, dimensions)
+
+def refresh_records(csv_file, writer_options=None):
+    """
+    Request the capabilities of all records in `csv_file` and refresh
+    records with changed layers. Each capabilities document is only
+    requested once. Returns the list of refreshed ids.
+    """
+    records = csv.read_csv(csv_file)
+    by_url = {}
+    for rec in records.itervalues():
+        by_url.setdefault((rec.url, rec.type.startswith('wmts')), []).append(rec)
+
+    refreshed = []
+    updates = {}
+    for (url, _), recs in sorted(by_url.iteritems()):
+        try:
+            cap = parsed_record_capabilities(recs[0])
+        except WMTSProxyError as ex:
+            log.warn('unable to refresh %s: %s', url, ex.system_msg)
+            continue
+        except Exception as ex:
+            log.exception(ex)
+            continue
+
+        for rec in recs:
+            try:
+                tile_hash, meta_hash = layer_hashes(rec, cap)
+            except Exception as ex:
+                log.warn('unable to refresh %s: %s', rec.id, ex)
+                continue
+            try:
+                options = record_format_options(rec, cap, writer_options)
+            except Exception as ex:
+                log.warn('unable to select format of %s: %s', rec.id, ex)
+                options = {}
+            # new format changes the tiles
+            touch = bool(options)
+
+            rec_options = csv.record_options(rec)
+            previous_tile_hash = rec_options.get('tile_hash')
+            previous_meta_hash = rec_options.get('meta_hash')
+            if (previous_tile_hash, previous_meta_hash) != (tile_hash, meta_hash):
+                options.update({'tile_hash': tile_hash, 'meta_hash': meta_hash})
+                if previous_tile_hash is not None:
+                    # first hashes are only stored
+                    if previous_tile_hash != tile_hash:
+                        log.info('tiles of %s changed', rec.id)
+                        touch = True
+                    elif not touch:
+                        log.info('capabilities of %s changed', rec.id)
+                        options['refreshed'] = '%f' % time.time()
+            if not options:
+                continue
+            if touch or 'refreshed' in options:
+                refreshed.append(rec.id)
+            updates[rec.id] = options, touch
+
+    # single write for all records
+    csv.update_records(csv_file, updates)
+    return refreshed
+
+
+class CapabilitiesRefresher(object):
+    """
+    Refreshes all records of `csv_file` every `interval` seconds in a
+    background thread.
+    """
+    def __init__(self, csv_file, interval=3600, writer_options=None):
+        self.csv_file = csv_file
+        self.interval = interval
+        self.writer_options = writer_options
+        self._stop = threading.Event()
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                refreshed = refresh_records(self.csv_file, self.writer_options)
+                log.info('refreshed %d layers', len(refreshed))
+            except Exception as ex:
+                log.exception(ex)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+        return t
+
+    def stop(self):
+        self._stop.set()
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] csv_file')
+    parser.add_option('--interval', type='int', default=None,
+        help='run as daemon and refresh every INTERVAL seconds')
+    parser.add_option('--select-format', action='store_true', default=False,
+        help='select the format of WMTS layers without a stored format')
+    parser.add_option('--probe-format', action='store_true', default=False,
+        help='request a sample tile before the format is selected')
+
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('missing csv_file')
+
+    logging.basicConfig(level=logging.INFO)
+
+    writer_options = {'select_format': options.select_format, 'probe_format': options.probe_format}
+    if options.interval:
+        CapabilitiesRefresher(args[0], options.interval, writer_options).run()
+    else:
+        for id in refresh_records(args[0], writer_options):
+            print id
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
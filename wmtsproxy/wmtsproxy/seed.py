@@ -0,0 +1,320 @@
+"""
+Seeding of generated MapProxy configurations.
+
+Layers can be seeded right after they were added, so that the first users
+do not need to wait till the caches are filled.
+"""
+
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+import tempfile
+import threading
+import optparse
+import Queue
+
+import yaml
+
+from mapproxy.seed.config import SeedingConfiguration
+from mapproxy.seed.seeder import seed
+from mapproxy.seed.util import ProgressLog
+
+import logging
+
+from .config_writer import (write_mapproxy_conf, mapproxy_config_from_csv, layer_cache_names, config_filename,
+    shard_mapproxy_conf)
+from .csv import from_csv, record_config_timestamp
+from .utils import getmtime
+from .grid import merge_bbox
+from .hosts import load_mapproxy_conf_file
+from .exceptions import UserError, WMTSProxyError
+
+log = logging.getLogger(__name__)
+
+def parse_levels(levels):
+    """
+    >>> parse_levels('0-10')
+    (0, 10)
+    >>> parse_levels('5')
+    (5, 5)
+    """
+    try:
+        if '-' in levels:
+            from_level, to_level = levels.split('-', 1)
+            from_level, to_level = int(from_level), int(to_level)
+        else:
+            from_level = to_level = int(levels)
+    except ValueError:
+        raise UserError('Invalid levels "%s"' % levels)
+    if from_level > to_level:
+        raise UserError('Invalid levels "%s"' % levels)
+    return from_level, to_level
+
+def parse_bbox(bbox):
+    """
+    >>> parse_bbox('5,50,10,55.5')
+    [5.0, 50.0, 10.0, 55.5]
+    """
+    try:
+        bbox = [float(x) for x in bbox.split(',')]
+    except ValueError:
+        raise UserError('Invalid bbox "%s"' % bbox)
+    if len(bbox) != 4:
+        raise UserError('Invalid bbox "%s"' % bbox)
+    return bbox
+
+def layer_coverage(mapproxy_conf):
+    """
+    Return the coverage of the sources of a generated configuration.
+    Returns None if a source has no coverage or if the coverages
+    of multiple sources are in different SRS.
+    """
+    bbox = srs = None
+    for source in mapproxy_conf['sources'].values():
+        if 'coverage' not in source:
+            return None
+        if srs is not None and source['coverage']['srs'] != srs:
+            return None
+        srs = source['coverage']['srs']
+        bbox = merge_bbox(bbox, source['coverage']['bbox'])
+    if bbox is None:
+        return None
+    return {'bbox': list(bbox), 'srs': srs}
+
+def seed_conf(mapproxy_conf, cache_names, levels, bbox=None, srs='EPSG:4326'):
+    """
+    Return a MapProxy seed configuration for all `cache_names`.
+
+    Seeds the coverage of the layer sources if `bbox` is None.
+    """
+    seed = {
+        'caches': list(cache_names),
+        'levels': {
+            'from': levels[0],
+            'to': levels[1],
+        },
+    }
+    conf = {'seeds': {'warmup': seed}}
+
+    if bbox is not None:
+        coverage = {'bbox': list(bbox), 'srs': srs}
+    else:
+        coverage = layer_coverage(mapproxy_conf)
+
+    if coverage is not None:
+        seed['coverages'] = ['warmup']
+        conf['coverages'] = {'warmup': coverage}
+
+    return conf
+
+def current_mapproxy_conf(conf_file, rec):
+    """
+    Return the generated configuration in `conf_file`, or None if it does
+    not exist or if it is older than the record `rec`.
+    """
+    mtime = getmtime(conf_file)
+    if mtime is None or record_config_timestamp(rec) > mtime:
+        return None
+    with open(conf_file, 'rb') as f:
+        return yaml.safe_load(f)
+
+def seed_layer(id, configs_path, base_file, csv_file, levels, bbox=None, concurrency=2, progress_logger=None,
+    writer_options=None, sharded=False):
+    """
+    Seed all caches of the layers of `id` for the given (from, to) `levels`.
+
+    Uses the served configuration of `id` if it is up to date. Otherwise
+    the configuration is created in a temporary file next to the served
+    configuration, so that the served configuration (e.g. with other
+    `writer_options` or of an in-memory loader) is never replaced.
+    """
+    conf_file = config_filename(configs_path, id, sharded=sharded)
+    mapproxy_conf = current_mapproxy_conf(conf_file, from_csv(id, csv_file))
+    if mapproxy_conf is not None:
+        _seed(conf_file, mapproxy_conf, levels, bbox, concurrency, progress_logger)
+        return
+
+    mapproxy_conf = mapproxy_config_from_csv(id, base_file, csv_config_file=csv_file,
+        writer_options=writer_options)
+    if sharded:
+        shard_mapproxy_conf(mapproxy_conf, base_file, configs_path)
+
+    conf_dir = os.path.dirname(conf_file)
+    if not os.path.isdir(conf_dir):
+        os.makedirs(conf_dir)
+    # same directory for the same relative paths, not a .yaml file for the watcher
+    fd, seed_file = tempfile.mkstemp(dir=conf_dir, prefix='.' + id + '_', suffix='.seed')
+    os.close(fd)
+    try:
+        write_mapproxy_conf(mapproxy_conf, seed_file)
+        _seed(seed_file, mapproxy_conf, levels, bbox, concurrency, progress_logger)
+    finally:
+        os.remove(seed_file)
+
+def _seed(conf_file, mapproxy_conf, levels, bbox, concurrency, progress_logger):
+    # concurrent_requests of tile sources, shared with the running apps
+    conf = load_mapproxy_conf_file(conf_file, seed=True)
+    seeding_conf = SeedingConfiguration(seed_conf(mapproxy_conf, layer_cache_names(mapproxy_conf), levels, bbox),
+        mapproxy_conf=conf)
+    tasks = seeding_conf.seeds()
+    seed(tasks, concurrency=concurrency, progress_logger=progress_logger)
+
+
+class SeedJob(object):
+    def __init__(self, id, levels, bbox=None):
+        self.id = id
+        self.levels = levels
+        self.bbox = bbox
+        self.status = 'queued'
+        self.progress = 0.0
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'levels': list(self.levels),
+            'bbox': self.bbox,
+            'status': self.status,
+            'progress': self.progress,
+            'error': self.error,
+        }
+
+
+class NullOut(object):
+    """
+    File-like object that discards all output.
+    """
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+class JobProgressLog(ProgressLog):
+    """
+    ProgressLog that records the progress in the `job`.
+    """
+    def __init__(self, job):
+        ProgressLog.__init__(self, out=NullOut(), silent=True, verbose=False)
+        self.job = job
+
+    def log_step(self, progress):
+        self.job.progress = progress.progress
+
+    def log_progress(self, progress, level, bbox, tiles):
+        self.job.progress = progress.progress
+
+
+class SeedWorkerPool(object):
+    """
+    Seeds layers in `num_workers` background threads.
+    Each seed job uses `concurrency` seed processes. Only the status of
+    the last `max_finished_jobs` finished jobs is kept.
+    """
+    def __init__(self, configs_path, base_file, csv_file, num_workers=1, concurrency=2, writer_options=None,
+        sharded=False, max_finished_jobs=100):
+        self.configs_path = configs_path
+        self.sharded = sharded
+        self.base_file = base_file
+        self.csv_file = csv_file
+        self.writer_options = writer_options
+        self.concurrency = concurrency
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs = {}
+        self.queue = Queue.Queue()
+        self.workers = []
+        for _ in range(num_workers):
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def add(self, id, levels, bbox=None):
+        job = SeedJob(id, levels, bbox)
+        self.jobs[id] = job
+        self.queue.put(job)
+        self._prune()
+        return job
+
+    def _prune(self):
+        """
+        Remove the oldest finished jobs.
+        """
+        finished = sorted((job.finished, id) for id, job in self.jobs.items() if job.finished is not None)
+        for _, id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            self.jobs.pop(id, None)
+
+    def status(self, id=None):
+        if id is not None:
+            job = self.jobs.get(id)
+            return job.as_dict() if job else None
+        return [job.as_dict() for job in self.jobs.values()]
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                self._seed(job)
+            finally:
+                self.queue.task_done()
+
+    def _seed(self, job):
+        job.status = 'running'
+        job.started = time.time()
+        try:
+            seed_layer(job.id, self.configs_path, self.base_file, self.csv_file,
+                job.levels, bbox=job.bbox, concurrency=self.concurrency,
+                progress_logger=JobProgressLog(job), writer_options=self.writer_options,
+                sharded=self.sharded)
+        except WMTSProxyError as ex:
+            log.warn('seeding %s failed: %s', job.id, ex.system_msg)
+            job.status = 'failed'
+            job.error = ex.user_msg
+        except Exception as ex:
+            log.exception(ex)
+            job.status = 'failed'
+            job.error = 'internal error'
+        else:
+            job.status = 'done'
+            job.progress = 1.0
+        job.finished = time.time()
+        self._prune()
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] csv_file id')
+    parser.add_option('--configs-path', help='directory of generated configurations')
+    parser.add_option('--base-file', help='MapProxy base configuration')
+    parser.add_option('--levels', default='0-10', help='levels to seed, e.g. 0-10')
+    parser.add_option('--bbox', default=None,
+        help='seed only this EPSG:4326 bbox (minx,miny,maxx,maxy), defaults to layer coverage')
+    parser.add_option('--concurrency', type='int', default=2, help='number of seed processes')
+    parser.add_option('--sharded', action='store_true', default=False,
+        help='configurations in configs path are sharded')
+
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error('missing csv_file or id')
+    if not (options.base_file and options.configs_path):
+        parser.error('requires --base-file and --configs-path')
+
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        levels = parse_levels(options.levels)
+        bbox = parse_bbox(options.bbox) if options.bbox else None
+        seed_layer(args[1], os.path.abspath(options.configs_path), options.base_file, args[0],
+            levels, bbox=bbox, concurrency=options.concurrency, progress_logger=ProgressLog(),
+            sharded=options.sharded)
+    except WMTSProxyError as ex:
+        print >>sys.stderr, 'error: %s' % ex.system_msg
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
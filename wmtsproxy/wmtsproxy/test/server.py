@@ -0,0 +1,28 @@
+import threading
+import BaseHTTPServer
+
+class RecordingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Base for test request handlers. Subclasses append the path of each
+    request to `requests`.
+    """
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+def start_server(handler):
+    """
+    Serve `handler` on a free local port in a background thread.
+    Clears the recorded `requests` of the handler.
+    """
+    handler.requests = []
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), handler)
+    t = threading.Thread(target=server.serve_forever, args=(0.05, ))
+    t.daemon = True
+    t.start()
+    return server
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,107 @@
+import os
+import time
+import shutil
+import tempfile
+
+import yaml
+
+from ..cache_gc import CacheCollector, orphaned_cache_dirs, expire_empty_tiles
+from ..csv import write_csv
+
+from nose.tools import eq_
+
+class TestCacheCollector(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache_data')
+        self.csv_file = os.path.join(self.tmp_dir, 'layers.csv')
+        write_csv(self.csv_file, {
+            'foo': ('foo', 'wmts', 'http://example.org', 'foo', 'EPSG4326', '', '1400000100.5'),
+        })
+        self.configs_path = os.path.join(self.tmp_dir, 'configs')
+        os.makedirs(self.configs_path)
+        with open(os.path.join(self.configs_path, 'foo.yaml'), 'wb') as f:
+            yaml.safe_dump({'caches': {
+                'foo_1400000100_cache': {},
+                'src_0123456789abcdef_tmpcache': {},
+            }}, f)
+        for name in [
+            'foo_1400000100_cache_webmercator',
+            'src_0123456789abcdef_tmpcache_EPSG4326',
+            'foo_1400000000_cache_webmercator',
+            'src_fedcba9876543210_tmpcache_EPSG4326',
+            'foo_1400000100_tmpcache_EPSG4326',
+            'tile_locks',
+        ]:
+            os.makedirs(os.path.join(self.cache_dir, name, '01'))
+            with open(os.path.join(self.cache_dir, name, '01', 'tile.png'), 'wb') as f:
+                f.write('x' * 100)
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_orphaned_cache_dirs(self):
+        orphaned = orphaned_cache_dirs(self.cache_dir, set(['foo_1400000100_cache']))
+        eq_([os.path.basename(p) for p in orphaned],
+            ['foo_1400000000_cache_webmercator', 'foo_1400000100_tmpcache_EPSG4326'])
+
+    def test_orphaned_cache_dirs_shared(self):
+        orphaned = orphaned_cache_dirs(self.cache_dir,
+            set(['foo_1400000100_cache', 'src_0123456789abcdef_tmpcache']), include_shared=True)
+        eq_([os.path.basename(p) for p in orphaned],
+            ['foo_1400000000_cache_webmercator', 'foo_1400000100_tmpcache_EPSG4326',
+             'src_fedcba9876543210_tmpcache_EPSG4326'])
+
+    def test_dry_run(self):
+        collector = CacheCollector(self.cache_dir, self.csv_file, configs_path=self.configs_path)
+        eq_(collector.collect(dry_run=True), 300)
+        eq_(len(os.listdir(self.cache_dir)), 6)
+
+    def test_collect_without_configs(self):
+        collector = CacheCollector(self.cache_dir, self.csv_file)
+        eq_(collector.collect(), 100)
+        # legacy tmpcache of the record is kept
+        eq_(sorted(os.listdir(self.cache_dir)),
+            ['foo_1400000100_cache_webmercator', 'foo_1400000100_tmpcache_EPSG4326',
+             'src_0123456789abcdef_tmpcache_EPSG4326', 'src_fedcba9876543210_tmpcache_EPSG4326', 'tile_locks'])
+
+    def test_collect(self):
+        collector = CacheCollector(self.cache_dir, self.csv_file, configs_path=self.configs_path)
+        eq_(collector.collect(), 300)
+        eq_(sorted(os.listdir(self.cache_dir)),
+            ['foo_1400000100_cache_webmercator', 'src_0123456789abcdef_tmpcache_EPSG4326', 'tile_locks'])
+
+    def test_collect_legacy_config(self):
+        with open(os.path.join(self.configs_path, 'foo.yaml'), 'wb') as f:
+            yaml.safe_dump({'caches': {
+                'foo_1400000100_cache': {},
+                'foo_1400000100_tmpcache': {},
+            }}, f)
+        collector = CacheCollector(self.cache_dir, self.csv_file, configs_path=self.configs_path)
+        collector.collect()
+        eq_(sorted(os.listdir(self.cache_dir)),
+            ['foo_1400000100_cache_webmercator', 'foo_1400000100_tmpcache_EPSG4326', 'tile_locks'])
+
+class TestExpireEmptyTiles(object):
+    def setup(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.tile_dir = os.path.join(self.cache_dir, 'foo_cache_webmercator')
+        os.makedirs(os.path.join(self.tile_dir, 'single_color_tiles'))
+        os.makedirs(os.path.join(self.tile_dir, '01'))
+        for color in ['ffffff00', 'ff000000', '0000ffff']:
+            open(os.path.join(self.tile_dir, 'single_color_tiles', color + '.png'), 'wb').close()
+            os.symlink(os.path.join('..', 'single_color_tiles', color + '.png'),
+                os.path.join(self.tile_dir, '01', color + '.png'))
+        open(os.path.join(self.tile_dir, '01', 'data.png'), 'wb').close()
+
+    def teardown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_keep_fresh_tiles(self):
+        eq_(expire_empty_tiles(self.cache_dir, 60), 0)
+        eq_(len(os.listdir(os.path.join(self.tile_dir, '01'))), 4)
+
+    def test_expire(self):
+        time.sleep(0.01)
+        eq_(expire_empty_tiles(self.cache_dir, 0), 2)
+        eq_(sorted(os.listdir(os.path.join(self.tile_dir, '01'))), ['0000ffff.png', 'data.png'])
@@ -0,0 +1,133 @@
+import os
+import shutil
+import tempfile
+
+from cStringIO import StringIO
+
+from .. import csv
+from ..capabilities import _check_options
+from ..cache_headers import parse_expires_hours, ConditionalTileApp
+from ..exceptions import UserError
+from ..loadtest import StubUpstream
+from ..wsgi import make_wsgi_app
+
+from nose.tools import eq_, raises
+
+class TestExpiresHours(object):
+    def test_options(self):
+        eq_(_check_options({'expires_hours': '24'}, 'wmts'), {'expires_hours': '24'})
+        eq_(_check_options({'expires_hours': '0.50'}, 'wms'), {'expires_hours': '0.5'})
+
+    @raises(UserError)
+    def test_invalid(self):
+        parse_expires_hours('1d')
+
+    @raises(UserError)
+    def test_negative(self):
+        _check_options({'expires_hours': '-1'}, 'wmts')
+
+class TestTileCacheHeaders(object):
+    def setup(self):
+        self.upstream = StubUpstream(num_layers=1, max_level=4)
+        self.upstream.start()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.base_file = os.path.join(self.tmp_dir, 'base.yaml')
+        with open(self.base_file, 'w') as f:
+            f.write('globals: {cache: {base_dir: cache_data}}\n')
+        self.csv_file = os.path.join(self.tmp_dir, 'services.csv')
+        open(self.csv_file, 'w').close()
+
+    def teardown(self):
+        self.upstream.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def app(self, options=None, writer_options=None):
+        app_id = csv.to_csv(self.csv_file, 'wmts', self.upstream.wmts_url, 'layer0', 'GoogleMapsCompatible',
+            options=_check_options(options, 'wmts'))
+        app = make_wsgi_app(os.path.join(self.tmp_dir, 'configs'), self.base_file, self.csv_file,
+            writer_options=writer_options)
+        return app, app_id
+
+    def request(self, app, app_id, path='/wmts/map/webmercator/2/1/1.png', query_string='', **headers):
+        environ = {'PATH_INFO': '/' + app_id + path, 'REQUEST_METHOD': 'GET',
+            'SCRIPT_NAME': '', 'QUERY_STRING': query_string, 'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+            'wsgi.url_scheme': 'http', 'wsgi.input': StringIO()}
+        environ.update(headers)
+        response = []
+        body = ''.join(app(environ, lambda s, h, exc_info=None: response.append((s, dict(h)))))
+        status, headers = response[0]
+        return int(status.split(' ')[0]), dict((k.lower(), v) for k, v in headers.items()), body
+
+    def test_default(self):
+        app, app_id = self.app()
+        status, headers, _ = self.request(app, app_id)
+        eq_(status, 200)
+        eq_(headers['cache-control'], 'public, max-age=259200, s-maxage=259200')
+
+    def test_writer_option(self):
+        app, app_id = self.app(writer_options={'expires_hours': 24})
+        status, headers, _ = self.request(app, app_id)
+        eq_(headers['cache-control'], 'public, max-age=86400, s-maxage=86400')
+
+    def test_record_option(self):
+        app, app_id = self.app({'expires_hours': '1'}, writer_options={'expires_hours': 24})
+        status, headers, _ = self.request(app, app_id)
+        eq_(headers['cache-control'], 'public, max-age=3600, s-maxage=3600')
+
+    def test_not_modified(self):
+        app, app_id = self.app({'expires_hours': '0'})
+        # new tile, Last-Modified is valid for the stored tile
+        status, headers, body = self.request(app, app_id)
+        eq_(headers['cache-control'], 'public, max-age=0, s-maxage=0')
+        assert 'etag' not in headers
+        upstream_tiles = self.upstream.counts['tile']
+
+        status, headers, body = self.request(app, app_id, HTTP_IF_MODIFIED_SINCE=headers['last-modified'])
+        eq_(status, 304)
+        eq_(body, '')
+        assert 'content-type' not in headers
+        eq_(headers['cache-control'], 'public, max-age=0, s-maxage=0')
+
+        # stored tile with the ETag of MapProxy
+        status, headers, body = self.request(app, app_id)
+        eq_(status, 200)
+        etag = headers['etag']
+        status, _, _ = self.request(app, app_id, HTTP_IF_NONE_MATCH='W/"%s"' % etag.strip('"'))
+        eq_(status, 304)
+        status, _, _ = self.request(app, app_id, HTTP_IF_MODIFIED_SINCE=headers['last-modified'])
+        eq_(status, 304)
+        status, _, _ = self.request(app, app_id, HTTP_IF_MODIFIED_SINCE='Thu, 01 Jan 2015 00:00:00 GMT')
+        eq_(status, 200)
+        status, _, _ = self.request(app, app_id, HTTP_IF_NONE_MATCH='"other"',
+            HTTP_IF_MODIFIED_SINCE=headers['last-modified'])
+        eq_(status, 200)
+        # tile is served from the cache
+        eq_(self.upstream.counts['tile'], upstream_tiles)
+
+    def test_other_responses(self):
+        app, app_id = self.app()
+        status, headers, body = self.request(app, app_id, path='/wmts/1.0.0/WMTSCapabilities.xml')
+        eq_(status, 200)
+        assert '<Capabilities' in body
+
+class TestConditionalTileApp(object):
+    def request(self, environ, use_write=False):
+        def app(environ, start_response):
+            write = start_response('200 OK', [('Content-type', 'image/png')])
+            if use_write:
+                write('foo')
+                return ['bar']
+            return ['foo', 'bar']
+        response = []
+        result = ConditionalTileApp(app)(environ, lambda s, h, exc_info=None: response.append((s, dict(h))))
+        return response[0][1], ''.join(result)
+
+    def test_write(self):
+        headers, body = self.request({'PATH_INFO': '/tiles/1/0/0.png'}, use_write=True)
+        eq_(body, 'foobar')
+        assert 'Last-modified' in headers
+
+    def test_wms(self):
+        headers, body = self.request({'PATH_INFO': '/service', 'QUERY_STRING': 'SERVICE=WMS&REQUEST=GetMap'})
+        eq_(body, 'foobar')
+        assert 'Last-modified' not in headers
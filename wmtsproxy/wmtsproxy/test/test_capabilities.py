@@ -0,0 +1,145 @@
+from cStringIO import StringIO
+
+from mapproxy.util.ext.wmsparse.parse import parse_capabilities
+
+from ..capabilities import (wms_layer_index, wms_cap_dict, wmts_cap_dict, _check_wms_layer, CapabilitiesCache,
+    add_wms_layers, add_wmts_layers)
+from ..wmtsparse import parse_capabilities as parse_wmts_capabilities
+from ..exceptions import UserError
+
+from .test_config_writer import local_filename
+
+from nose.tools import eq_, raises
+
+def layer_xml(name, children=''):
+    return '''<Layer>
+      <Name>%s</Name>
+      <Title>%s title</Title>
+      <SRS>EPSG:4326</SRS>
+      <LatLonBoundingBox minx="-180" miny="-90" maxx="180" maxy="90" />
+      %s
+    </Layer>''' % (name, name, children)
+
+def wms_capabilities(layers):
+    doc = '''<?xml version="1.0"?>
+<WMT_MS_Capabilities version="1.1.1">
+  <Service><Name>OGC:WMS</Name><Title>Test</Title></Service>
+  <Capability>
+    <Request><GetMap><Format>image/png</Format><DCPType><HTTP><Get>
+      <OnlineResource xmlns:xlink="http://www.w3.org/1999/xlink" xlink:href="http://example.org/service?"/>
+    </Get></HTTP></DCPType></GetMap></Request>
+    <Layer>
+      <Title>Root</Title>
+      <SRS>EPSG:3857</SRS>
+      %s
+    </Layer>
+  </Capability>
+</WMT_MS_Capabilities>''' % layers
+    return parse_capabilities(StringIO(doc))
+
+class TestWMSLayerIndex(object):
+    def setup(self):
+        self.cap = wms_capabilities(
+            layer_xml('roads', layer_xml('highways') + layer_xml('streets', layer_xml('paths')))
+            + layer_xml('water')
+        )
+
+    def test_index(self):
+        index = wms_layer_index(self.cap)
+        assert wms_layer_index(self.cap) is index
+        assert not hasattr(self.cap, '_wmtsproxy_layer_index')
+        eq_([l['name'] for l in index.layers_list()], ['roads', 'highways', 'streets', 'paths', 'water'])
+        eq_(index.get('paths')['title'], 'paths title')
+        # srs are inherited from the parent layers
+        eq_(sorted(index.get('paths')['srs']), ['EPSG:3857', 'EPSG:4326'])
+        assert 'unknown' not in index
+        eq_(index.get('unknown'), None)
+
+    def test_subtree(self):
+        index = wms_layer_index(self.cap)
+        eq_([l['name'] for l in index.layers_list('streets')], ['streets', 'paths'])
+        eq_([l['name'] for l in index.layers_list('water')], ['water'])
+        eq_(index.layers_list('unknown'), [])
+
+    def test_cap_dict(self):
+        eq_([l['name'] for l in wms_cap_dict(self.cap)['layers']], ['roads', 'highways', 'streets', 'paths', 'water'])
+        eq_([l['name'] for l in wms_cap_dict(self.cap, 'roads')['layers']], ['roads', 'highways', 'streets', 'paths'])
+
+    def test_cap_dict_page(self):
+        cap = wms_cap_dict(self.cap, offset=1, limit=2)
+        eq_([l['name'] for l in cap['layers']], ['highways', 'streets'])
+        eq_(cap['total'], 5)
+        eq_(wms_cap_dict(self.cap, offset=4, limit=2)['layers'][0]['name'], 'water')
+        eq_(wms_cap_dict(self.cap, offset=10)['layers'], [])
+
+    def test_cap_dict_query(self):
+        cap = wms_cap_dict(self.cap, query='S TITLE')
+        eq_([l['name'] for l in cap['layers']], ['roads', 'highways', 'streets', 'paths'])
+        cap = wms_cap_dict(self.cap, query='wat', fields=set(['name', 'title']))
+        eq_(cap['layers'], [{'name': 'water', 'title': 'water title'}])
+        eq_(cap['total'], 1)
+
+    def test_cap_dict_lazy(self):
+        cap = wms_cap_dict(self.cap, offset=3, lazy=True)
+        eq_(cap['total'], 5)
+        assert not isinstance(cap['layers'], list)
+        eq_([l['name'] for l in cap['layers']], ['paths', 'water'])
+
+    @raises(UserError)
+    def test_cap_dict_unknown_layer(self):
+        wms_cap_dict(self.cap, 'unknown')
+
+    def test_check_layer(self):
+        _check_wms_layer(self.cap, 'paths', 'EPSG:3857')
+
+    @raises(UserError)
+    def test_check_unknown_layer(self):
+        _check_wms_layer(self.cap, 'unknown', 'EPSG:3857')
+
+class TestAddLayers(object):
+    @raises(UserError)
+    def test_duplicate_wms_layers(self):
+        add_wms_layers('http://example.org/service?', ['roads', 'water', 'roads'], 'EPSG:3857', 'services.csv')
+
+    @raises(UserError)
+    def test_duplicate_wmts_layers(self):
+        add_wmts_layers('http://example.org/wmts', ['roads', 'roads'], ['webmercator'], 'services.csv')
+
+class TestWMTSCapDict(object):
+    def test_sorted_pages(self):
+        cap = parse_wmts_capabilities(local_filename('data/wmts-v2.suite.opengeo.org-100.xml'))
+        names = [layer['name'] for layer in wmts_cap_dict(cap)['layers']]
+        eq_(names, sorted(cap.layers))
+        eq_([layer['name'] for layer in wmts_cap_dict(cap, offset=1, limit=1)['layers']], names[1:2])
+
+
+class TestCapabilitiesCache(object):
+    def setup(self):
+        self.loaded = []
+
+    def load(self, url):
+        self.loaded.append(url)
+        return object()
+
+    def test_cached(self):
+        cache = CapabilitiesCache()
+        cap = cache.get('http://a', self.load)
+        assert cache.get('http://a', self.load) is cap
+        eq_(self.loaded, ['http://a'])
+
+    def test_max_docs(self):
+        cache = CapabilitiesCache(max_docs=2)
+        cache.get('http://a', self.load)
+        cache.get('http://b', self.load)
+        cache.get('http://a', self.load)
+        cache.get('http://c', self.load)
+        # b is least recently used
+        cache.get('http://a', self.load)
+        cache.get('http://b', self.load)
+        eq_(self.loaded, ['http://a', 'http://b', 'http://c', 'http://b'])
+
+    def test_ttl(self):
+        cache = CapabilitiesCache(ttl=-1)
+        cache.get('http://a', self.load)
+        cache.get('http://a', self.load)
+        eq_(self.loaded, ['http://a', 'http://a'])
@@ -0,0 +1,212 @@
+import os
+import shutil
+import tempfile
+
+from ..wmtsparse import parse_capabilities
+from ..config_writer import (mapproxy_conf_from_wmts_capabilities, mapproxy_conf_from_wmts_group, record_cache_names,
+    layer_cache_names)
+from ..csv import record, to_csv, from_csv, record_layer_names
+from ..utils import config_filename
+from ..formats import cache_image_options
+from ..exceptions import FeatureError, UserError
+
+from nose.tools import eq_, raises
+
+def local_filename(filename):
+    return os.path.join(os.path.dirname(__file__), filename)
+
+def empty_conf():
+    return {
+        'layers': [],
+        'caches': {},
+        'sources': {},
+        'grids': {},
+    }
+
+class TestWMTSConfig(object):
+    def setup(self):
+        self.cap = parse_capabilities(local_filename('data/wmts-map1.vis.earthdata.nasa.gov.xml'))
+
+    def conf(self, service_name, dimensions=None, timestamp=None):
+        return mapproxy_conf_from_wmts_capabilities(empty_conf(), self.cap, service_name,
+            'AIRS_CO_Total_Column_Day', 'EPSG4326_2km', dimensions or {}, timestamp=timestamp)
+
+    def tmpcache_name(self, conf):
+        cache_name = conf['layers'][0]['sources'][0]
+        return conf['caches'][cache_name]['sources'][0]
+
+    def test_cache_names(self):
+        conf = self.conf('foo', timestamp=1400000000)
+        eq_(conf['layers'][0]['sources'], ['foo_1400000000_cache'])
+        assert self.tmpcache_name(conf).startswith('src_')
+        assert self.tmpcache_name(conf) in conf['caches']
+
+    def test_shared_tmpcache(self):
+        conf_a = self.conf('foo', timestamp=1400000000)
+        conf_b = self.conf('foo', timestamp=1400000100)
+        conf_c = self.conf('bar', {'time': '2014-03-31'})
+        eq_(self.tmpcache_name(conf_a), self.tmpcache_name(conf_b))
+        # 2014-03-31 is the default time
+        eq_(self.tmpcache_name(conf_a), self.tmpcache_name(conf_c))
+
+    def test_on_error(self):
+        conf = self.conf('foo')
+        source = conf['sources']['AIRS_CO_Total_Column_Day_EPSG4326_2km_source']
+        eq_(sorted(source['on_error'].keys()), [204, 400])
+        assert not source['on_error'][204]['cache']
+        for cache in conf['caches'].values():
+            assert 'link_single_color_images' not in cache
+
+    def test_negative_cache(self):
+        conf = mapproxy_conf_from_wmts_capabilities(empty_conf(), self.cap, 'foo',
+            'AIRS_CO_Total_Column_Day', 'EPSG4326_2km', {}, negative_cache=True)
+        source = conf['sources']['AIRS_CO_Total_Column_Day_EPSG4326_2km_source']
+        eq_(sorted(source['on_error'].keys()), [204, 400, 404])
+        for status in source['on_error'].values():
+            eq_(status, {'response': 'transparent', 'cache': True})
+        for cache in conf['caches'].values():
+            eq_(cache['link_single_color_images'], True)
+
+    def test_different_dimensions(self):
+        conf_a = self.conf('foo', {'time': '2014-03-30'})
+        conf_b = self.conf('foo', {'time': '2014-03-31'})
+        assert self.tmpcache_name(conf_a) != self.tmpcache_name(conf_b)
+
+class TestWMTSLimitsConfig(object):
+    def setup(self):
+        self.cap = parse_capabilities(local_filename('data/wmts-v2.suite.opengeo.org-100.xml'))
+
+    def test_invalid_limits_ignored(self):
+        conf = mapproxy_conf_from_wmts_capabilities(empty_conf(), self.cap, 'foo',
+            'opengeo:geonames', 'EPSG:4326', {})
+        source = conf['sources']['opengeo_geonames_EPSG_4326_source']
+        eq_(source['coverage']['bbox'], [-136.266952514648, 24.6002998352051, -66.9471969604492, 57.7822227478027])
+        assert 'min_res' not in source
+        assert 'max_res' not in source
+
+    def test_limits(self):
+        layer = self.cap.layers['opengeo:geonames']
+        layer['matrix_set_limits']['EPSG:4326'] = {
+            'EPSG:4326:3': {'min_col': 1, 'max_col': 2, 'min_row': 1, 'max_row': 2},
+            'EPSG:4326:4': {'min_col': 3, 'max_col': 4, 'min_row': 3, 'max_row': 4},
+        }
+        conf = mapproxy_conf_from_wmts_capabilities(empty_conf(), self.cap, 'foo',
+            'opengeo:geonames', 'EPSG:4326', {})
+        source = conf['sources']['opengeo_geonames_EPSG_4326_source']
+        eq_([round(x, 6) for x in source['coverage']['bbox']], [-136.266953, 33.75, -123.75, 56.25])
+        assert source['min_res'] > source['max_res']
+
+class TestWMTSGroupConfig(object):
+    def setup(self):
+        self.cap = parse_capabilities(local_filename('data/wmts-v2.suite.opengeo.org-100.xml'))
+
+    def test_group(self):
+        conf = mapproxy_conf_from_wmts_group(empty_conf(), self.cap, 'foo',
+            'world,medford,world', 'EPSG:4326,EPSG:4326,EPSG:900913', timestamp=1400000000)
+        eq_([l['name'] for l in conf['layers']], ['world_EPSG_4326', 'medford', 'world_EPSG_900913'])
+        # grids are shared
+        eq_(sorted(conf['grids'].keys()), ['EPSG_4326', 'EPSG_900913'])
+        eq_(len(conf['sources']), 3)
+
+        rec = record('foo', 'wmts_group', 'http://example.org', 'world,medford,world',
+            'EPSG:4326,EPSG:4326,EPSG:900913', '', 1400000000, '')
+        cache_names = record_cache_names(rec)
+        eq_(cache_names, [
+            'foo_world_EPSG_4326_1400000000_cache',
+            'foo_medford_EPSG_4326_1400000000_cache',
+            'foo_world_EPSG_900913_1400000000_cache',
+        ])
+        eq_([l['sources'][0] for l in conf['layers']], cache_names)
+
+    def test_many_layers(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            csv_file = os.path.join(tmp_dir, 'services.csv')
+            open(csv_file, 'w').close()
+            layer_names = ','.join('organisation:theme_%03d_with_a_long_descriptive_layer_name' % i
+                for i in range(200))
+            id = to_csv(csv_file, 'wmts_group', 'http://tiles.example.org/wmts', layer_names, 'EPSG:4326')
+            rec = from_csv(id, csv_file)
+            eq_(record_layer_names(rec), layer_names)
+            # same id for the same layers in another order
+            eq_(to_csv(csv_file, 'wmts_group', 'http://tiles.example.org/wmts',
+                ','.join(reversed(layer_names.split(','))), 'EPSG:4326'), id)
+
+            assert len(os.path.basename(config_filename(tmp_dir, id))) < 64
+            cache_names = record_cache_names(rec)
+            eq_(len(cache_names), 200)
+            # MapProxy cache directories are <cache_name>_<grid_name>
+            assert max(len(name + '_EPSG_4326') for name in cache_names) < 255
+        finally:
+            shutil.rmtree(tmp_dir)
+
+class TestOutputGrids(object):
+    def setup(self):
+        self.cap = parse_capabilities(local_filename('data/wmts-map1.vis.earthdata.nasa.gov.xml'))
+
+    def conf(self, grids):
+        return mapproxy_conf_from_wmts_capabilities(empty_conf(), self.cap, 'foo',
+            'AIRS_CO_Total_Column_Day', 'EPSG4326_2km', {}, grids=grids)
+
+    def test_default(self):
+        conf = self.conf(None)
+        eq_(conf['caches']['foo_cache']['grids'], ['webmercator'])
+        assert 'tile_sources' not in conf['layers'][0]
+
+    def test_multiple_grids(self):
+        conf = self.conf(['webmercator', 'geodetic'])
+        eq_(conf['caches']['foo_cache']['grids'], ['webmercator', 'geodetic'])
+        eq_(layer_cache_names(conf), ['foo_cache'])
+
+    def test_native(self):
+        conf = self.conf(['webmercator', 'native'])
+        tmpcache_name = conf['caches']['foo_cache']['sources'][0]
+        eq_(conf['caches']['foo_cache']['grids'], ['webmercator'])
+        eq_(conf['caches'][tmpcache_name]['grids'], ['EPSG4326_2km'])
+        eq_(conf['layers'][0]['sources'], ['foo_cache'])
+        eq_(conf['layers'][0]['tile_sources'], ['foo_cache', tmpcache_name])
+        eq_(layer_cache_names(conf), ['foo_cache', tmpcache_name])
+
+    def test_native_only(self):
+        conf = self.conf(['native'])
+        assert 'foo_cache' not in conf['caches']
+        eq_(len(conf['caches']), 1)
+        eq_(conf['layers'][0]['sources'], conf['caches'].keys())
+
+class TestImagePipeline(object):
+    def setup(self):
+        self.cap = parse_capabilities(local_filename('data/wmts-v2.suite.opengeo.org-100.xml'))
+
+    def conf(self, image_conf):
+        return mapproxy_conf_from_wmts_capabilities(empty_conf(), self.cap, 'foo',
+            'world', 'EPSG:4326', {}, image_conf=image_conf)
+
+    def test_default(self):
+        conf = self.conf(cache_image_options('png'))
+        assert 'format' not in conf['caches']['foo_cache']
+        assert 'image' not in conf['caches']['foo_cache']
+
+    def test_jpeg(self):
+        conf = self.conf(cache_image_options('jpeg', '80'))
+        eq_(conf['caches']['foo_cache']['format'], 'image/jpeg')
+        eq_(conf['caches']['foo_cache']['image'], {'encoding_options': {'jpeg_quality': 80}})
+        # upstream tiles are not recompressed
+        tmpcache = conf['caches'][conf['caches']['foo_cache']['sources'][0]]
+        assert 'format' not in tmpcache
+
+    def test_mixed(self):
+        conf = self.conf(cache_image_options('mixed'))
+        eq_(conf['caches']['foo_cache']['format'], 'mixed')
+        eq_(conf['caches']['foo_cache']['request_format'], 'image/png')
+
+    def test_png8(self):
+        conf = self.conf(cache_image_options('png8'))
+        eq_(conf['caches']['foo_cache']['image']['mode'], 'P')
+
+    @raises(FeatureError)
+    def test_webp(self):
+        cache_image_options('webp')
+
+    @raises(UserError)
+    def test_invalid_quality(self):
+        cache_image_options('jpeg', '200')
@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+
+from cStringIO import StringIO
+
+from mapproxy.compat.image import Image
+
+from .. import csv
+from ..wmtsparse import parse_capabilities
+from ..capabilities import _check_options
+from ..config_writer import mapproxy_conf_from_wmts_capabilities
+from ..dimensions import expand_interval, mapproxy_dimensions
+from ..wsgi import make_mapproxy_app
+from ..exceptions import ConfigWriterError, FeatureError, UserError
+
+from .test_config_writer import local_filename
+from .server import RecordingHandler, start_server, stop_server
+
+from nose.tools import eq_, raises
+
+class TileHandler(RecordingHandler):
+    def do_GET(self):
+        self.requests.append(self.path)
+        buf = StringIO()
+        Image.new('RGB', (512, 512), (255, 0, 0)).save(buf, 'PNG')
+        self.send_response(200)
+        self.send_header('Content-type', 'image/png')
+        self.end_headers()
+        self.wfile.write(buf.getvalue())
+
+class TestExpandInterval(object):
+    def test_leap_year(self):
+        eq_(expand_interval('2012-02-28/2012-03-01/P1D'), ['2012-02-28', '2012-02-29', '2012-03-01'])
+
+    def test_years(self):
+        eq_(expand_interval('2010/2012/P1Y'), ['2010', '2011', '2012'])
+
+    @raises(ConfigWriterError)
+    def test_max_values(self):
+        expand_interval('2012-01-01/2014-01-01/P1D', max_values=100)
+
+    @raises(ConfigWriterError)
+    def test_invalid_period(self):
+        expand_interval('2012-01-01/2014-01-01/1D')
+
+class TestDimensionMode(object):
+    def test_record_id(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            csv_file = os.path.join(tmp_dir, 'services.csv')
+            open(csv_file, 'w').close()
+            fixed_id = csv.to_csv(csv_file, 'wmts', 'http://example.org', 'modis', 'EPSG4326', {'time': '2014-03-30'})
+            request_id = csv.to_csv(csv_file, 'wmts', 'http://example.org', 'modis', 'EPSG4326', {'time': '2014-03-30'},
+                options={'dimension_mode': 'request'})
+            eq_(fixed_id, 'example_org_modis_EPSG4326_time_2014-03-30')
+            eq_(request_id, 'example_org_modis_EPSG4326')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_options(self):
+        eq_(_check_options({'dimension_mode': 'request'}, 'wmts')['grids'], 'native')
+        eq_(_check_options({'dimension_mode': 'fixed'}, 'wmts'), {'dimension_mode': 'fixed'})
+
+    @raises(FeatureError)
+    def test_output_grids(self):
+        _check_options({'dimension_mode': 'request', 'grids': 'webmercator'}, 'wmts')
+
+    @raises(FeatureError)
+    def test_group(self):
+        _check_options({'dimension_mode': 'request'}, 'wmts_group')
+
+    @raises(UserError)
+    def test_unknown_mode(self):
+        _check_options({'dimension_mode': 'foo'}, 'wmts')
+
+class TestRequestDimensions(object):
+    def setup(self):
+        self.cap = parse_capabilities(local_filename('data/wmts-map1.vis.earthdata.nasa.gov.xml'))
+        self.server = start_server(TileHandler)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        stop_server(self.server)
+        shutil.rmtree(self.tmp_dir)
+
+    def conf(self, dimensions=None, grids=None):
+        conf = {'services': {'wmts': {}}, 'layers': [], 'caches': {}, 'sources': {}, 'grids': {}, 'globals': {}}
+        return mapproxy_conf_from_wmts_capabilities(conf, self.cap, 'foo', 'AIRS_CO_Total_Column_Day',
+            'EPSG4326_2km', dimensions or {}, grids=grids or ['native'], dimension_mode='request')
+
+    def test_conf(self):
+        conf = self.conf({'time': '2014-03-30'})
+        dimensions = conf['layers'][0]['dimensions']
+        eq_(dimensions['time']['default'], '2014-03-30')
+        eq_(dimensions['time']['values'][0], '2012-05-08')
+        eq_(dimensions['time']['values'][-1], '2014-03-31')
+        eq_(conf['layers'][0]['sources'], ['foo_cache'])
+        eq_(conf['caches']['foo_cache']['disable_storage'], True)
+        source = conf['sources']['AIRS_CO_Total_Column_Day_EPSG4326_2km_source']
+        assert '/%(time)s/' in source['url']
+
+    def test_default(self):
+        dimensions = mapproxy_dimensions(self.cap.layers['AIRS_CO_Total_Column_Day'])
+        eq_(dimensions['time']['default'], '2014-03-31')
+
+    @raises(ConfigWriterError)
+    def test_unknown_default(self):
+        self.conf({'time': '2020-01-01'})
+
+    @raises(FeatureError)
+    def test_output_grids(self):
+        self.conf(grids=['webmercator'])
+
+    def test_requests(self):
+        conf = self.conf()
+        source = conf['sources']['AIRS_CO_Total_Column_Day_EPSG4326_2km_source']
+        source['url'] = source['url'].replace('http://map1.vis.earthdata.nasa.gov',
+            'http://127.0.0.1:%d' % self.server.server_port)
+        app = make_mapproxy_app(conf, self.tmp_dir)
+
+        def request(time=None):
+            query = ('SERVICE=WMTS&REQUEST=GetTile&VERSION=1.0.0&LAYER=map&STYLE=&TILEMATRIXSET=EPSG4326_2km'
+                '&TILEMATRIX=0&TILEROW=0&TILECOL=0&FORMAT=image/png')
+            if time:
+                query += '&TIME=' + time
+            environ = {'PATH_INFO': '/service', 'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '', 'QUERY_STRING': query,
+                'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'wsgi.url_scheme': 'http'}
+            status = []
+            ''.join(app(environ, lambda s, h, exc_info=None: status.append(s)))
+            return status[0]
+
+        assert request('2013-01-01').startswith('200')
+        assert request().startswith('200')
+        assert request('2020-01-01').startswith('400')
+        eq_([path.split('/')[4] for path in TileHandler.requests], ['2013-01-01', '2014-03-31'])
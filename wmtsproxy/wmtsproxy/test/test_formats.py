@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+
+from cStringIO import StringIO
+from urlparse import urlparse, parse_qs
+
+from mapproxy.compat.image import Image
+
+from ..wmtsparse import parse_capabilities
+from ..formats import rank_formats, select_format, sample_tile_url, format_options
+from ..config_writer import record_formats, mapproxy_conf_from_wmts_capabilities
+from .. import csv
+
+from .test_config_writer import local_filename, empty_conf
+from .server import RecordingHandler, start_server, stop_server
+
+from nose.tools import eq_
+
+class TileHandler(RecordingHandler):
+    """
+    Returns opaque tiles for the layer `opaque` and transparent
+    tiles for all other layers.
+    """
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        params = parse_qs(urlparse(self.path).query)
+        if params['LAYER'][0] == 'opaque':
+            img = Image.new('RGB', (256, 256), (100, 150, 200))
+        else:
+            img = Image.new('RGBA', (256, 256), (100, 150, 200, 0))
+        buf = StringIO()
+        img.save(buf, 'png')
+        self.send_response(200)
+        self.send_header('Content-type', 'image/png')
+        self.end_headers()
+        self.wfile.write(buf.getvalue())
+
+class TestSelectFormat(object):
+    def setup(self):
+        self.server = start_server(TileHandler)
+
+        self.cap = parse_capabilities(local_filename('data/wmts-v2.suite.opengeo.org-100.xml'))
+        self.layer = dict(self.cap.layers['opengeo:geonames'])
+        self.layer['url_template'] = ('http://127.0.0.1:%d/wmts?LAYER=%%(layer)s&TILEMATRIXSET=%%(tile_matrix_set)s'
+            '&TILEMATRIX=%%%%(z)s&TILEROW=%%%%(y)s&TILECOL=%%%%(x)s&FORMAT=%%(format)s') % self.server.server_port
+        self.layer['formats'] = ['image/png', 'image/jpeg', 'image/png8']
+
+    def teardown(self):
+        stop_server(self.server)
+
+    def test_rank_formats(self):
+        eq_(rank_formats(['image/png', 'image/jpeg', 'image/tiff'], transparent=False),
+            ['image/jpeg', 'image/png', 'image/tiff'])
+        eq_(rank_formats(['image/jpeg'], transparent=True), ['image/jpeg'])
+        eq_(rank_formats(['image/png', 'image/jpeg'], transparent=True,
+            preferences={'transparent': ['image/png'], 'opaque': []}), ['image/png', 'image/jpeg'])
+
+    def test_sample_tile_url(self):
+        url = sample_tile_url('opaque', self.layer, self.layer['matrix_sets'][0], 'image/png')
+        assert url.endswith('LAYER=opaque&TILEMATRIXSET=EPSG:4326&TILEMATRIX=EPSG:4326:0&TILEROW=0&TILECOL=1&FORMAT=image/png'), url
+
+    def test_without_probe(self):
+        eq_(select_format('opaque', self.layer, self.layer['matrix_sets'][0]), 'image/png8')
+        eq_(TileHandler.requests, [])
+
+    def test_probe_opaque(self):
+        eq_(select_format('opaque', self.layer, self.layer['matrix_sets'][0], probe=True), 'image/jpeg')
+        eq_(len(TileHandler.requests), 1)
+
+    def test_probe_transparent(self):
+        eq_(select_format('overlay', self.layer, self.layer['matrix_sets'][0], probe=True), 'image/png8')
+
+    def test_probe_failed(self):
+        self.layer['url_template'] = self.layer['url_template'].replace('/wmts?', ':invalid/wmts?')
+        eq_(select_format('opaque', self.layer, self.layer['matrix_sets'][0], probe=True), 'image/png8')
+
+    def test_format_options(self):
+        self.cap.layers['opengeo:geonames'] = self.layer
+        eq_(format_options(self.cap, [('opengeo:geonames', 'EPSG:4326')]), {})
+        eq_(format_options(self.cap, [('opengeo:geonames', 'EPSG:4326')],
+            writer_options={'select_format': True, 'probe_format': True}), {'format': 'image/png8'})
+        eq_(len(TileHandler.requests), 1)
+        eq_(format_options(self.cap, [('missing', 'EPSG:4326')], writer_options={'select_format': True}), {})
+
+    def test_record_format(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            csv_file = os.path.join(tmp_dir, 'services.csv')
+            open(csv_file, 'w').close()
+            id = csv.to_csv(csv_file, 'wmts', 'http://example.org', 'opengeo:geonames', 'EPSG:4326')
+            eq_(record_formats(csv.from_csv(id, csv_file)), None)
+
+            id = csv.to_csv(csv_file, 'wmts', 'http://example.org', 'opengeo:geonames', 'EPSG:4326',
+                options={'format': 'image/png8'})
+            eq_(record_formats(csv.from_csv(id, csv_file)), ['image/png8'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_config(self):
+        self.cap.layers['opengeo:geonames'] = self.layer
+        conf = mapproxy_conf_from_wmts_capabilities(empty_conf(), self.cap, 'foo',
+            'opengeo:geonames', 'EPSG:4326', {}, format='image/jpeg')
+        source = conf['sources']['opengeo_geonames_EPSG_4326_source']
+        assert source['url'].endswith('FORMAT=image/jpeg')
+        eq_(source['transparent'], False)
+        tmpcache = conf['caches'][conf['caches']['foo_cache']['sources'][0]]
+        eq_(tmpcache['format'], 'image/jpeg')
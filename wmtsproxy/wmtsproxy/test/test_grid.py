@@ -1,6 +1,16 @@
-from ..grid import make_mapproxy_grid
+import copy
 
-from nose.tools import eq_
+from ..grid import (make_mapproxy_grid, tile_matrix_limits_bboxes, limits_coverage_bbox, levels_res_range,
+    snap_to_webmercator, webmercator_resolutions, resample_ratios, _make_mapproxy_grid, _make_mapproxy_grid_numpy)
+from ..wmtsparse import TileMatrixSet
+from ..benchmark import grid_benchmark
+from ..exceptions import TileMatrixError
+from .. import grid
+
+from mapproxy.srs import SRS
+
+from nose.tools import eq_, raises
+from nose.plugins.skip import SkipTest
 
 epsg4326_1km = {
     'crs': 'urn:ogc:def:crs:OGC:1.3:CRS84',
@@ -43,11 +53,175 @@ epsg4326_1km = {
         'top_left': (90.0, -180.0)}]
 }
 
+def parsed_matrix_set(tile_matrix_set):
+    return TileMatrixSet(tile_matrix_set['id'], tile_matrix_set['crs'], tile_matrix_set['tile_matrices'])
+
+def make_grids(tile_matrix_set):
+    """
+    Return the grid of the `tile_matrix_set` dict. Checks that NumPy
+    returns the same grid (or error) for the parsed TileMatrixSet.
+    """
+    try:
+        expected = _make_mapproxy_grid(tile_matrix_set)
+    except TileMatrixError as ex:
+        if grid.numpy is not None:
+            try:
+                _make_mapproxy_grid_numpy(parsed_matrix_set(tile_matrix_set))
+            except TileMatrixError as numpy_ex:
+                eq_(numpy_ex.args, ex.args)
+            else:
+                assert False, 'expected %s' % ex
+        raise
+    if grid.numpy is not None:
+        eq_(_make_mapproxy_grid_numpy(parsed_matrix_set(tile_matrix_set)), expected)
+    eq_(make_mapproxy_grid(tile_matrix_set), expected)
+    return expected
+
 class TestTileMatrixGrid(object):
     def test_nasa_wgs84_grid(self):
-        g = make_mapproxy_grid(epsg4326_1km)
+        g = make_grids(epsg4326_1km)
         eq_(g['name'], 'EPSG4326_1km')
         eq_(g['bbox'], (-180.0, -90.0, 180.0, 90.0))
         eq_(g['tile_size'], (512, 512))
 
-        print g
\ No newline at end of file
+        print g
+
+
+class TestNumpyGrid(object):
+    def setup(self):
+        if grid.numpy is None:
+            raise SkipTest('NumPy not installed')
+
+    def check_equal(self, tile_matrix_set):
+        try:
+            make_grids(tile_matrix_set)
+        except TileMatrixError:
+            pass
+
+    def test_equal(self):
+        self.check_equal(epsg4326_1km)
+        self.check_equal(webmercator_matrix_set(20, scale_factor=1.001))
+
+    def test_benchmark(self):
+        results = grid_benchmark([parsed_matrix_set(epsg4326_1km)], number=1)
+        eq_([(id, levels) for id, levels, _, _ in results], [('EPSG4326_1km', len(epsg4326_1km['tile_matrices']))])
+
+    def test_errors(self):
+        for i, key, value in [
+            (3, 'id', '5'),
+            (0, 'id', 'foo'),
+            (2, 'id', 'EPSG:2'),
+            (4, 'tile_size', (256, 256)),
+            (2, 'top_left', (90.0, 0.0)),
+        ]:
+            tile_matrix_set = copy.deepcopy(epsg4326_1km)
+            tile_matrix_set['tile_matrices'][i][key] = value
+            self.check_equal(tile_matrix_set)
+
+        # first invalid TileMatrix
+        tile_matrix_set = copy.deepcopy(epsg4326_1km)
+        tile_matrix_set['tile_matrices'][5]['id'] = '9'
+        tile_matrix_set['tile_matrices'][3]['top_left'] = (0.0, 0.0)
+        self.check_equal(tile_matrix_set)
+
+
+class TestTileMatrixLimits(object):
+    def test_limits_bboxes(self):
+        bboxes = tile_matrix_limits_bboxes(epsg4326_1km, {
+            '1': {'min_col': 0, 'max_col': 0, 'min_row': 0, 'max_row': 0},
+            '3': {'min_col': 5, 'max_col': 6, 'min_row': 1, 'max_row': 1},
+        })
+        eq_(len(bboxes), 2)
+        eq_(bboxes[0][0], 1)
+        eq_(bboxes[1][0], 3)
+        # 512px tiles of 0.0703125 deg/px
+        eq_(bboxes[1][1], (0.0, 18.0, 72.0, 54.0))
+
+    def test_limits_bboxes_parsed(self):
+        limits = {'3': {'min_col': 5, 'max_col': 6, 'min_row': 1, 'max_row': 1}}
+        eq_(tile_matrix_limits_bboxes(parsed_matrix_set(epsg4326_1km), limits),
+            tile_matrix_limits_bboxes(epsg4326_1km, limits))
+
+    @raises(TileMatrixError)
+    def test_limits_outside_of_matrix(self):
+        tile_matrix_limits_bboxes(epsg4326_1km, {
+            '0': {'min_col': 0, 'max_col': 0, 'min_row': 1, 'max_row': 1},
+        })
+
+    def test_coverage_bbox_nested(self):
+        eq_(limits_coverage_bbox([
+            (1, (-180, -90, 0, 90)),
+            (3, (-100, 10, -50, 50)),
+        ]), (-100, 10, -50, 50))
+
+    def test_coverage_bbox_union(self):
+        eq_(limits_coverage_bbox([
+            (1, (-180, -90, 0, 90)),
+            (3, (10, 10, 50, 50)),
+        ]), (-180, -90, 50, 90))
+
+    def test_res_range(self):
+        res = [4.0, 2.0, 1.0, 0.5]
+        eq_(levels_res_range(res, [0, 3], SRS(3857)), (None, None))
+        min_res, max_res = levels_res_range(res, [1, 2], SRS(3857))
+        assert 2.0 < min_res < 4.0
+        assert 0.5 < max_res < 1.0
+
+def webmercator_matrix_set(num_levels, scale_factor=1.0, top=20037508.0):
+    return {
+        'crs': 'urn:ogc:def:crs:EPSG::900913',
+        'id': 'EPSG:900913',
+        'tile_matrices': [
+            {'grid_size': (2**level, 2**level),
+             'id': 'EPSG:900913:%d' % level,
+             'scale_denom': 559082264.0287178 / 2**level * scale_factor,
+             'tile_size': (256, 256),
+             'top_left': (top, -20037508.34)}
+            for level in range(num_levels)
+        ]
+    }
+
+
+class TestSnapToWebmercator(object):
+    def test_rounded_grid(self):
+        # rounded values of the capabilities (e.g. from GeoServer)
+        grid = make_grids(webmercator_matrix_set(20, scale_factor=1.0000000001))
+        assert grid['resolutions'] != webmercator_resolutions()
+        eq_(snap_to_webmercator(grid), range(20))
+        eq_(grid['resolutions'], webmercator_resolutions())
+        eq_(grid['bbox'][0], -20037508.342789244)
+        eq_(grid['bbox'][3], 20037508.342789244)
+        eq_(resample_ratios(webmercator_resolutions(), grid['resolutions']), [1.0] * 20)
+
+    def test_levels_below_webmercator(self):
+        # origin offset of 0.34 m is 4.6 pixel at level 21
+        grid = make_grids(webmercator_matrix_set(22, scale_factor=1.0000000001))
+        eq_(snap_to_webmercator(grid), [])
+
+    def test_tolerance(self):
+        grid = make_grids(webmercator_matrix_set(20, scale_factor=1.0000000001))
+        # origin offset is 1.14 pixel at level 19, the deepest levels would be shifted
+        eq_(snap_to_webmercator(grid, tolerance=0.5), [])
+        eq_(grid['bbox'][0], -20037508.34)
+
+    def test_origin_offset(self):
+        # origin is 8.3 m off, 54 pixel at level 19 and 0.05 pixel at level 11
+        grid = make_grids(webmercator_matrix_set(20, top=20037500.0))
+        eq_(snap_to_webmercator(grid), [])
+        eq_(grid['bbox'][3], 20037500.0)
+
+        grid = make_grids(webmercator_matrix_set(12, top=20037500.0))
+        eq_(snap_to_webmercator(grid), range(12))
+        eq_(grid['bbox'][3], 20037508.342789244)
+
+    def test_different_grid(self):
+        grid = make_grids(webmercator_matrix_set(20, scale_factor=1.001))
+        # 0.1% difference is more than 2 pixel for level 3
+        eq_(snap_to_webmercator(grid), range(3))
+        ratios = resample_ratios(webmercator_resolutions(), grid['resolutions'])
+        eq_(ratios[:3], [1.0] * 3)
+        assert ratios[3] != 1.0
+
+    def test_other_srs(self):
+        grid = make_grids(epsg4326_1km)
+        eq_(snap_to_webmercator(grid), [])
@@ -0,0 +1,97 @@
+from mapproxy.config import loader
+
+from ..hosts import host_policy, apply_host_policies, load_mapproxy_conf, HostLimitedTileSourceConfiguration
+from ..loadtest import StubUpstream, LoadTest, zipf_paths
+from ..exceptions import ConfigWriterError
+
+from nose.tools import eq_, raises
+
+class TestHostPolicies(object):
+    policies = {
+        'example.org': {'concurrent_requests': 4, 'client_timeout': 30},
+        '*.example.org': {'concurrent_requests': 2},
+        '*': {'concurrent_requests': 16},
+    }
+
+    def test_host_policy(self):
+        eq_(host_policy('http://example.org/wmts', self.policies), {'concurrent_requests': 4, 'client_timeout': 30})
+        eq_(host_policy('http://TILES.example.org/wmts', self.policies), {'concurrent_requests': 2})
+        eq_(host_policy('https://user:pw@other.net:8080/wms?', self.policies), {'concurrent_requests': 16})
+        eq_(host_policy('http://other.net', {'example.org': {'concurrent_requests': 1}}), {})
+
+    def test_apply(self):
+        conf = {'sources': {
+            'tile_source': {'type': 'tile', 'url': 'http://a.example.org/%(z)s/%(x)s/%(y)s.png'},
+            'wms_source': {'type': 'wms', 'req': {'url': 'http://example.org/wms?', 'layers': 'a'},
+                'http': {'headers': {'User-Agent': 'wmtsproxy'}}},
+        }}
+        apply_host_policies(conf, self.policies)
+        eq_(conf['sources']['tile_source']['concurrent_requests'], 2)
+        assert 'http' not in conf['sources']['tile_source']
+        eq_(conf['sources']['wms_source']['concurrent_requests'], 4)
+        eq_(conf['sources']['wms_source']['http'], {'headers': {'User-Agent': 'wmtsproxy'}, 'client_timeout': 30})
+
+    @raises(ConfigWriterError)
+    def test_unknown_option(self):
+        apply_host_policies({'sources': {}}, {'*': {'keep_alive': True}})
+
+    @raises(ConfigWriterError)
+    def test_invalid_value(self):
+        apply_host_policies({'sources': {}}, {'*': {'concurrent_requests': 0}})
+
+class TestLoadConfiguration(object):
+    conf = {
+        'services': {'wmts': {}},
+        'sources': {
+            'tile_source': {'type': 'tile', 'url': 'http://example.org/%(z)s/%(x)s/%(y)s.png',
+                'concurrent_requests': 2},
+            'debug_source': {'type': 'debug'},
+        },
+    }
+
+    def test_tile_sources(self):
+        conf = load_mapproxy_conf(dict(self.conf), '/tmp')
+        assert isinstance(conf.sources['tile_source'], HostLimitedTileSourceConfiguration)
+        assert isinstance(conf.sources['debug_source'], loader.DebugSourceConfiguration)
+
+    def test_mapproxy_sources_unchanged(self):
+        load_mapproxy_conf(dict(self.conf), '/tmp')
+        assert loader.source_configuration_types['tile'] is loader.TileSourceConfiguration
+        conf = loader.ProxyConfiguration(dict(self.conf), conf_base_dir='/tmp')
+        assert not isinstance(conf.sources['tile_source'], HostLimitedTileSourceConfiguration)
+
+class TestConcurrentRequests(object):
+    def setup(self):
+        self.upstream = StubUpstream(num_layers=3, max_level=6, latency=0.02)
+        self.upstream.start()
+
+    def teardown(self):
+        self.upstream.stop()
+
+    def run(self, cap_type, concurrent_requests=None):
+        writer_options = {}
+        if concurrent_requests:
+            writer_options['host_policies'] = {'127.0.0.1': {'concurrent_requests': concurrent_requests}}
+        load_test = LoadTest(self.upstream, cap_type=cap_type, app_options={'writer_options': writer_options})
+        try:
+            load_test.setup()
+            paths = zipf_paths(40, load_test.app_ids, levels=(1, 3), s=0.5, seed=1)
+            return load_test.run(paths, concurrency=8)
+        finally:
+            load_test.teardown()
+
+    def test_unlimited(self):
+        report = self.run('wmts')
+        eq_(report['status'], {200: 40})
+        assert report['upstream']['max_parallel'] > 2
+
+    def test_wmts(self):
+        # limit is shared by the apps of all three layers
+        report = self.run('wmts', concurrent_requests=2)
+        eq_(report['status'], {200: 40})
+        assert 0 < report['upstream']['max_parallel'] <= 2
+
+    def test_wms(self):
+        report = self.run('wms', concurrent_requests=1)
+        eq_(report['status'], {200: 40})
+        eq_(report['upstream']['max_parallel'], 1)
@@ -0,0 +1,76 @@
+import os
+import sys
+import json
+import subprocess
+
+from nose.tools import eq_
+
+# imports `module` in a new interpreter and reports the import time of
+# each module, like `python -X importtime` of Python 3.7
+IMPORT_TIME_SCRIPT = '''
+import sys
+import json
+import time
+import __builtin__
+
+_import = __builtin__.__import__
+stack = []
+report = []
+
+def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    if name in sys.modules:
+        return _import(name, globals, locals, fromlist, level)
+    stack.append(0.0)
+    start = time.time()
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        cumulative = time.time() - start
+        nested = stack.pop()
+        if stack:
+            stack[-1] += cumulative
+        report.append((name, int((cumulative - nested) * 1e6), int(cumulative * 1e6), len(stack)))
+
+__builtin__.__import__ = timed_import
+import %s
+__builtin__.__import__ = _import
+json.dump({'modules': sorted(sys.modules), 'report': report}, sys.stdout)
+'''
+
+# modules of the config writer that are not required to serve existing configurations
+CONFIG_WRITER_MODULES = [
+    'requests',
+    'numpy',
+    'pyinotify',
+    'mapproxy.srs',
+    'mapproxy.util.ext.wmsparse',
+    'xml.etree.ElementTree',
+    'wmtsproxy.capabilities',
+    'wmtsproxy.config_writer',
+    'wmtsproxy.grid',
+    'wmtsproxy.dimensions',
+]
+
+def import_time(module):
+    """
+    Import `module` in a new interpreter. Returns list of imported
+    modules and the import time report.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    out = subprocess.check_output([sys.executable, '-c', IMPORT_TIME_SCRIPT % module], env=env)
+    result = json.loads(out)
+    return result['modules'], result['report']
+
+def format_report(report):
+    lines = ['import time: self [us] | cumulative | imported package']
+    for name, self_us, cumulative_us, depth in report:
+        lines.append('import time: %9d | %10d | %s%s' % (self_us, cumulative_us, '  ' * depth, name))
+    return '\n'.join(lines)
+
+class TestImportTime(object):
+    def test_wsgi(self):
+        modules, report = import_time('wmtsproxy.wsgi')
+        # shown for failed tests or with nosetests -s
+        print format_report(report)
+        eq_([m for m in CONFIG_WRITER_MODULES if m in modules], [])
@@ -0,0 +1,63 @@
+from ..loadtest import StubUpstream, LoadTest, access_log_paths, map_app_ids, zipf_paths
+
+from nose.tools import eq_
+
+ACCESS_LOG = '''127.0.0.1 - - [10/Oct/2014:13:55:36 +0200] "GET /osm/wmts/map/webmercator/1/0/1.png HTTP/1.1" 200 2326
+127.0.0.1 - - [10/Oct/2014:13:55:37 +0200] "GET /basemap/wmts/map/webmercator/2/1/1.png HTTP/1.1" 200 1024 "-" "curl"
+127.0.0.1 - - [10/Oct/2014:13:55:38 +0200] "POST /osm/wmts HTTP/1.1" 405 0
+127.0.0.1 - - [10/Oct/2014:13:55:39 +0200] "GET /osm/wmts/map/webmercator/0/0/0.png HTTP/1.1" 200 2326
+'''
+
+class TestRequestStreams(object):
+    def test_access_log(self):
+        paths = list(map_app_ids(access_log_paths(ACCESS_LOG.splitlines()), ['a', 'b']))
+        eq_(paths, [
+            '/a/wmts/map/webmercator/1/0/1.png',
+            '/b/wmts/map/webmercator/2/1/1.png',
+            '/a/wmts/map/webmercator/0/0/0.png',
+        ])
+
+    def test_zipf(self):
+        paths = zipf_paths(1000, ['a', 'b'], levels=(0, 4), seed=42)
+        eq_(len(paths), 1000)
+        eq_(paths, zipf_paths(1000, ['a', 'b'], levels=(0, 4), seed=42))
+        # the most popular tiles are requested much more often than the least popular
+        counts = sorted((paths.count(p) for p in set(paths)), reverse=True)
+        assert counts[0] > 10 * counts[-1]
+        assert all(0 <= int(p.split('/')[6]) < 2 ** int(p.split('/')[5]) for p in paths)
+
+class TestLoadTest(object):
+    def setup(self):
+        self.upstream = StubUpstream(num_layers=2, max_level=6, seed=1)
+        self.upstream.start()
+
+    def teardown(self):
+        self.upstream.stop()
+
+    def run(self, cap_type='wmts', server=False, **app_options):
+        load_test = LoadTest(self.upstream, cap_type=cap_type, app_options=app_options)
+        try:
+            load_test.setup()
+            paths = zipf_paths(100, load_test.app_ids, levels=(0, 4), seed=1)
+            return load_test.run(paths, concurrency=4, server=server)
+        finally:
+            load_test.teardown()
+
+    def test_wmts(self):
+        report = self.run()
+        eq_(report['requests'], 100)
+        eq_(report['status'], {200: 100})
+        eq_(report['upstream']['capabilities'], 2)
+        assert report['upstream']['tile'] > 0
+        assert report['p50_ms'] <= report['p99_ms']
+
+    def test_wms_server(self):
+        report = self.run('wms', server=True)
+        eq_(report['status'], {200: 100})
+        assert report['upstream']['map'] > 0
+
+    def test_errors(self):
+        self.upstream.error_rate = 1.0
+        report = self.run()
+        assert 200 not in report['status']
+        assert report['upstream']['error'] > 0
@@ -0,0 +1,112 @@
+from cStringIO import StringIO
+
+from .. import csv
+from ..wmtsparse import parse_capabilities
+from ..refresh import refresh_records, layer_hashes, record_format_options
+from ..config_writer import record_cache_names
+from ..wsgi import WMTSMultiMapProxy
+
+from .test_wsgi import CapabilitiesServerTestBase, CapabilitiesHandler, WMS_CAPABILITIES
+from .test_capabilities import wms_capabilities, layer_xml
+from .test_config_writer import local_filename
+
+from nose.tools import eq_
+
+def wmts_capabilities(*replacements):
+    doc = open(local_filename('data/WMTSCapabilities.xml')).read()
+    for old, new in replacements:
+        doc = doc.replace(old, new)
+    return parse_capabilities(StringIO(doc))
+
+class TestLayerHashes(object):
+    def test_relevant_changes(self):
+        rec = csv.record('id', 'wms', 'http://example.org', 'roads', 'EPSG:4326', '', '', '')
+        cap = wms_capabilities(layer_xml('roads') + layer_xml('water'))
+        tile_hash, meta_hash = layer_hashes(rec, cap)
+        eq_(layer_hashes(rec, wms_capabilities(layer_xml('roads'))), (tile_hash, meta_hash))
+        # new SRS only changes the metadata
+        new_tile_hash, new_meta_hash = layer_hashes(rec, wms_capabilities(layer_xml('roads', '<SRS>EPSG:25832</SRS>')))
+        eq_(new_tile_hash, tile_hash)
+        assert new_meta_hash != meta_hash
+        assert layer_hashes(rec, wms_capabilities(layer_xml('water')))[0] != tile_hash
+
+    def test_group(self):
+        rec = csv.record('id', 'wms_group', 'http://example.org', 'roads,water', 'EPSG:4326', '', '', '')
+        cap = wms_capabilities(layer_xml('roads') + layer_xml('water'))
+        tile_hash, meta_hash = layer_hashes(rec, cap)
+        assert layer_hashes(rec, wms_capabilities(layer_xml('roads')))[0] != tile_hash
+
+    def test_wmts(self):
+        rec = csv.record('id', 'wmts', 'http://example.org', 'osm', 'GLOBAL_MERCATOR', '', '', '')
+        tile_hash, meta_hash = layer_hashes(rec, wmts_capabilities())
+        eq_(layer_hashes(rec, wmts_capabilities()), (tile_hash, meta_hash))
+
+        # new format only changes the metadata
+        new_tile_hash, new_meta_hash = layer_hashes(rec, wmts_capabilities(
+            ('<Format>image/png</Format>', '<Format>image/png</Format><Format>image/jpeg</Format>')))
+        eq_(new_tile_hash, tile_hash)
+        assert new_meta_hash != meta_hash
+
+        new_tile_hash, new_meta_hash = layer_hashes(rec, wmts_capabilities(('localhost:8080/wmts', 'localhost:8080/new')))
+        assert new_tile_hash != tile_hash
+
+    def test_wmts_bbox(self):
+        rec = csv.record('id', 'wmts', 'http://example.org', 'osm', 'GLOBAL_MERCATOR', '', '', '')
+        tile_hash, meta_hash = layer_hashes(rec, wmts_capabilities())
+        doc = open(local_filename('data/WMTSCapabilities.xml')).read()
+        lower_corner = doc[doc.index('<ows:LowerCorner>'):doc.index('</ows:LowerCorner>')]
+        new_tile_hash, new_meta_hash = layer_hashes(rec, wmts_capabilities(
+            (lower_corner, '<ows:LowerCorner>0 0')))
+        assert new_tile_hash != tile_hash
+
+    def test_format_options(self):
+        rec = csv.record('id', 'wmts', 'http://example.org', 'osm', 'GLOBAL_MERCATOR', '', '', '')
+        writer_options = {'select_format': True}
+        eq_(record_format_options(rec, wmts_capabilities(), writer_options), {'format': 'image/png'})
+        eq_(record_format_options(rec, wmts_capabilities()), {})
+        # stored formats are kept
+        rec = csv.record('id', 'wmts', 'http://example.org', 'osm', 'GLOBAL_MERCATOR', '', '', 'format=image/jpeg')
+        eq_(record_format_options(rec, wmts_capabilities(), writer_options), {})
+
+class TestRefresh(CapabilitiesServerTestBase):
+    def test_refresh(self):
+        rec = csv.from_csv(self.id, self.csv_file)
+        mp = WMTSMultiMapProxy(self.loader)
+        app, timestamps = mp.create_app(self.id)
+
+        # first run only stores the hashes
+        eq_(refresh_records(self.csv_file), [])
+        assert 'tile_hash' in csv.record_options(csv.from_csv(self.id, self.csv_file))
+        eq_(refresh_records(self.csv_file), [])
+        eq_(len(CapabilitiesHandler.requests), 3)
+        assert not self.loader._is_stale(self.id, self.loader.filename_from_app_name(self.id))
+
+        CapabilitiesHandler.document = WMS_CAPABILITIES.replace('<SRS>EPSG:3857</SRS>',
+            '<SRS>EPSG:3857</SRS><SRS>EPSG:4326</SRS>')
+        eq_(refresh_records(self.csv_file), [self.id])
+        refreshed = csv.from_csv(self.id, self.csv_file)
+        assert csv.record_config_timestamp(refreshed) > rec.timestamp
+        # caches are kept
+        eq_(refreshed.timestamp, rec.timestamp)
+        eq_(record_cache_names(refreshed), record_cache_names(rec))
+        assert self.loader._is_stale(self.id, self.loader.filename_from_app_name(self.id))
+
+    def test_tiles_changed(self):
+        rec = csv.from_csv(self.id, self.csv_file)
+        eq_(refresh_records(self.csv_file), [])
+
+        CapabilitiesHandler.document = WMS_CAPABILITIES.replace('http://example.org/service?',
+            'http://example.org/new_service?')
+        eq_(refresh_records(self.csv_file), [self.id])
+        refreshed = csv.from_csv(self.id, self.csv_file)
+        # tiles change, new caches are used
+        assert refreshed.timestamp > rec.timestamp
+        assert set(record_cache_names(refreshed)).isdisjoint(record_cache_names(rec))
+        eq_(refresh_records(self.csv_file), [])
+
+    def test_unavailable(self):
+        broken_id = csv.to_csv(self.csv_file, 'wms', 'http://127.0.0.1:%d/broken?' % self.server.server_port,
+            'roads', 'EPSG:3857')
+        eq_(refresh_records(self.csv_file), [])
+        assert 'tile_hash' not in csv.record_options(csv.from_csv(broken_id, self.csv_file))
+        assert 'tile_hash' in csv.record_options(csv.from_csv(self.id, self.csv_file))
@@ -0,0 +1,142 @@
+import os
+import time
+import shutil
+import tempfile
+
+from ..seed import (SeedWorkerPool, SeedJob, JobProgressLog, seed_conf, seed_layer, layer_coverage, parse_levels,
+    parse_bbox)
+from ..csv import to_csv
+from ..config_writer import mapproxy_config_from_csv, write_mapproxy_conf
+from ..utils import config_filename
+from ..loadtest import StubUpstream
+from ..exceptions import UserError
+
+from nose.tools import eq_, raises
+
+class TestSeedConf(object):
+    mapproxy_conf = {
+        'sources': {
+            'a_source': {'type': 'tile', 'coverage': {'bbox': [0, 0, 10, 10], 'srs': 'EPSG:4326'}},
+            'b_source': {'type': 'tile', 'coverage': {'bbox': [5, -5, 20, 5], 'srs': 'EPSG:4326'}},
+        },
+    }
+
+    def test_layer_coverage(self):
+        eq_(layer_coverage(self.mapproxy_conf), {'bbox': [0, -5, 20, 10], 'srs': 'EPSG:4326'})
+
+    def test_layer_coverage_missing(self):
+        eq_(layer_coverage({'sources': {
+            'a_source': {'type': 'tile', 'coverage': {'bbox': [0, 0, 10, 10], 'srs': 'EPSG:4326'}},
+            'b_source': {'type': 'tile'},
+        }}), None)
+        eq_(layer_coverage({'sources': {}}), None)
+
+    def test_layer_coverage_srs(self):
+        eq_(layer_coverage({'sources': {
+            'a_source': {'type': 'tile', 'coverage': {'bbox': [0, 0, 10, 10], 'srs': 'EPSG:4326'}},
+            'b_source': {'type': 'tile', 'coverage': {'bbox': [0, 0, 1000, 1000], 'srs': 'EPSG:3857'}},
+        }}), None)
+
+    def test_seed_conf(self):
+        conf = seed_conf(self.mapproxy_conf, ['a_cache', 'b_cache'], (0, 5))
+        eq_(conf['seeds'], {'warmup': {'caches': ['a_cache', 'b_cache'], 'levels': {'from': 0, 'to': 5},
+            'coverages': ['warmup']}})
+        eq_(conf['coverages'], {'warmup': {'bbox': [0, -5, 20, 10], 'srs': 'EPSG:4326'}})
+
+    def test_seed_conf_bbox(self):
+        conf = seed_conf(self.mapproxy_conf, ['a_cache'], (2, 3), bbox=(5, 50, 10, 55))
+        eq_(conf['seeds']['warmup']['levels'], {'from': 2, 'to': 3})
+        eq_(conf['coverages'], {'warmup': {'bbox': [5, 50, 10, 55], 'srs': 'EPSG:4326'}})
+
+    def test_seed_conf_without_coverage(self):
+        conf = seed_conf({'sources': {'a_source': {'type': 'tile'}}}, ['a_cache'], (0, 1))
+        eq_(conf, {'seeds': {'warmup': {'caches': ['a_cache'], 'levels': {'from': 0, 'to': 1}}}})
+
+    @raises(UserError)
+    def test_invalid_levels(self):
+        parse_levels('5-2')
+
+    @raises(UserError)
+    def test_invalid_level(self):
+        parse_levels('a')
+
+    @raises(UserError)
+    def test_invalid_bbox(self):
+        parse_bbox('5,50,10')
+
+    @raises(UserError)
+    def test_invalid_bbox_value(self):
+        parse_bbox('5,50,10,north')
+
+class TestSeedLayer(object):
+    def setup(self):
+        self.upstream = StubUpstream(num_layers=1, max_level=4)
+        self.upstream.start()
+        self.tmp_dir = tempfile.mkdtemp(prefix='wmtsproxy-seed')
+        self.base_file = os.path.join(self.tmp_dir, 'base.yaml')
+        with open(self.base_file, 'w') as f:
+            f.write('globals: {cache: {base_dir: cache_data}}\n')
+        self.csv_file = os.path.join(self.tmp_dir, 'services.csv')
+        open(self.csv_file, 'w').close()
+        self.configs_path = os.path.join(self.tmp_dir, 'configs')
+        self.id = to_csv(self.csv_file, 'wmts', self.upstream.wmts_url, self.upstream.layer_names[0],
+            'GoogleMapsCompatible')
+        self.conf_file = config_filename(self.configs_path, self.id)
+
+    def teardown(self):
+        self.upstream.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def seeded_tiles(self, cache_dir='cache_data'):
+        tiles = 0
+        for path, dirs, files in os.walk(os.path.join(self.configs_path, cache_dir)):
+            tiles += len([f for f in files if f.endswith('.png')])
+        return tiles
+
+    def write_served_conf(self):
+        mapproxy_conf = mapproxy_config_from_csv(self.id, self.base_file, csv_config_file=self.csv_file)
+        mapproxy_conf['globals'] = {'cache': {'base_dir': 'served_cache_data'}}
+        write_mapproxy_conf(mapproxy_conf, self.conf_file)
+        with open(self.conf_file) as f:
+            return f.read()
+
+    def test_temporary_config(self):
+        seed_layer(self.id, self.configs_path, self.base_file, self.csv_file, (0, 1))
+        assert self.seeded_tiles() > 0
+        assert not os.path.exists(self.conf_file)
+        eq_(os.listdir(self.configs_path), ['cache_data'])
+
+    def test_served_config(self):
+        served_conf = self.write_served_conf()
+        seed_layer(self.id, self.configs_path, self.base_file, self.csv_file, (0, 1))
+        assert self.seeded_tiles('served_cache_data') > 0
+        eq_(self.seeded_tiles(), 0)
+        eq_(open(self.conf_file).read(), served_conf)
+
+    def test_stale_served_config(self):
+        served_conf = self.write_served_conf()
+        mtime = int(time.time()) - 3600
+        os.utime(self.conf_file, (mtime, mtime))
+        seed_layer(self.id, self.configs_path, self.base_file, self.csv_file, (0, 1))
+        assert self.seeded_tiles() > 0
+        eq_(self.seeded_tiles('served_cache_data'), 0)
+        eq_(open(self.conf_file).read(), served_conf)
+        eq_(os.path.getmtime(self.conf_file), mtime)
+
+class TestSeedWorkerPool(object):
+    def test_prune_finished_jobs(self):
+        pool = SeedWorkerPool(None, None, None, num_workers=0, max_finished_jobs=2)
+        for i in range(4):
+            job = SeedJob('finished_%d' % i, (0, 1))
+            job.status = 'done'
+            job.finished = 1400000000 + i
+            pool.jobs[job.id] = job
+        pool.add('queued', (0, 1))
+        eq_(sorted(pool.jobs), ['finished_2', 'finished_3', 'queued'])
+
+class TestJobProgressLog(object):
+    def test_message(self):
+        job = SeedJob('foo', (0, 1))
+        progress_log = JobProgressLog(job)
+        progress_log.log_message('discarded')
+        eq_(job.progress, 0.0)
@@ -0,0 +1,107 @@
+import os
+import time
+import shutil
+import tempfile
+
+from .. import csv
+from .. import watch
+from ..watch import PollingWatcher, InotifyWatcher
+
+from nose.tools import eq_
+from nose.plugins.skip import SkipTest
+
+def touch(filename, mtime=None):
+    with open(filename, 'a'):
+        pass
+    if mtime is not None:
+        os.utime(filename, (mtime, mtime))
+
+def wait_for(func, timeout=5):
+    start = time.time()
+    while time.time() - start < timeout:
+        if func():
+            return True
+        time.sleep(0.02)
+    return False
+
+class WatcherTestBase(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.configs_path = os.path.join(self.tmp_dir, 'configs')
+        os.mkdir(self.configs_path)
+        self.base_file = os.path.join(self.tmp_dir, 'base.yaml')
+        touch(self.base_file, 1000)
+        self.csv_file = os.path.join(self.tmp_dir, 'services.csv')
+        touch(self.csv_file)
+        self.id = csv.to_csv(self.csv_file, 'wms', 'http://example.org', 'osm', 'EPSG:3857')
+        self.conf_file = os.path.join(self.configs_path, self.id + '.yaml')
+        touch(self.conf_file, 2000)
+        self.timestamps = {self.conf_file: 2000, self.base_file: 1000}
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+class TestPollingWatcher(WatcherTestBase):
+    def test_changed_files(self):
+        watcher = PollingWatcher(self.configs_path, self.base_file, self.csv_file)
+        watcher.scan()
+        eq_(watcher.needs_reload(self.id, self.timestamps), False)
+
+        touch(self.conf_file, 2001)
+        eq_(watcher.needs_reload(self.id, self.timestamps), False)
+        watcher.scan()
+        eq_(watcher.needs_reload(self.id, self.timestamps), True)
+        eq_(watcher.needs_reload(self.id, {self.conf_file: 2001, self.base_file: 1000}), False)
+
+        touch(self.base_file, 1001)
+        watcher.scan()
+        eq_(watcher.needs_reload(self.id, {self.conf_file: 2001, self.base_file: 1000}), True)
+
+    def test_updated_record(self):
+        watcher = PollingWatcher(self.configs_path, self.base_file, self.csv_file)
+        watcher.scan()
+        csv.to_csv(self.csv_file, 'wms', 'http://example.org', 'osm', 'EPSG:3857')
+        # a new record is not stale
+        other_id = csv.to_csv(self.csv_file, 'wms', 'http://example.org', 'roads', 'EPSG:3857')
+        touch(self.csv_file, time.time() + 10)
+        watcher.scan()
+        eq_(watcher.needs_reload(self.id, self.timestamps), True)
+        eq_(watcher.stale_apps, set([self.id]))
+
+        watcher.reloaded(self.id)
+        eq_(watcher.needs_reload(self.id, self.timestamps), False)
+        eq_(watcher.needs_reload(other_id, {}), False)
+
+    def test_removed_config(self):
+        watcher = PollingWatcher(self.configs_path, self.base_file, self.csv_file, interval=0.02)
+        watcher.start()
+        try:
+            os.unlink(self.conf_file)
+            assert wait_for(lambda: watcher.needs_reload(self.id, self.timestamps))
+        finally:
+            watcher.stop()
+
+class TestInotifyWatcher(WatcherTestBase):
+    def setup(self):
+        if watch.pyinotify is None:
+            raise SkipTest('pyinotify not installed')
+        WatcherTestBase.setup(self)
+        self.watcher = InotifyWatcher(self.configs_path, self.base_file, self.csv_file)
+        self.watcher.start()
+
+    def teardown(self):
+        self.watcher.stop()
+        WatcherTestBase.teardown(self)
+
+    def test_changed_config(self):
+        eq_(self.watcher.needs_reload(self.id, self.timestamps), False)
+        with open(self.conf_file, 'w') as f:
+            f.write('layers: []\n')
+        assert wait_for(lambda: self.watcher.needs_reload(self.id, self.timestamps))
+
+    def test_updated_record(self):
+        # wait till the watches are added
+        assert wait_for(lambda: self.watcher.mtimes.get(self.csv_file))
+        time.sleep(0.1)
+        csv.to_csv(self.csv_file, 'wms', 'http://example.org', 'osm', 'EPSG:3857')
+        assert wait_for(lambda: self.id in self.watcher.stale_apps)
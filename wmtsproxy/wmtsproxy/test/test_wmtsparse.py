@@ -1,6 +1,8 @@
 import os
 
-from ..wmtsparse import parse_capabilities
+from cStringIO import StringIO
+
+from ..wmtsparse import parse_capabilities, TileMatrixSet, TileMatrix
 
 from nose.tools import eq_
 
@@ -82,12 +84,22 @@ class TestWMTS100(object):
 
         eq_(len(test_layer['matrix_sets']), 2)
         for matrix_set in test_layer['matrix_sets']:
-            assert(isinstance(matrix_set, dict))
+            assert(isinstance(matrix_set, TileMatrixSet))
 
         eq_(test_layer['matrix_sets'][0]['crs'], 'urn:ogc:def:crs:EPSG::4326')
 
         eq_(test_layer['url_template'], 'http://v2.suite.opengeo.org/geoserver/gwc/service/wmts?SERVICE=WMTS&REQUEST=GetTile&VERSION=1.0.0&LAYER=%(layer)s&TILEMATRIXSET=%(tile_matrix_set)s&TILEMATRIX=%%(z)s&TILEROW=%%(y)s&TILECOL=%%(x)s&FORMAT=%(format)s')
 
+    def test_parse_layer_limits(self):
+        cap = parse_capabilities(local_filename('data/wmts-v2.suite.opengeo.org-100.xml'))
+        test_layer = cap.layers['opengeo:geonames']
+
+        eq_(sorted(test_layer['matrix_set_limits'].keys()), ['EPSG:4326', 'EPSG:900913'])
+
+        limits = test_layer['matrix_set_limits']['EPSG:4326']
+        eq_(len(limits), 22)
+        eq_(limits['EPSG:4326:4'], {'min_row': 3, 'max_row': 6, 'min_col': 3, 'max_col': 10})
+
     def test_parse_nasa_layer(self):
         cap = parse_capabilities(local_filename('data/wmts-map1.vis.earthdata.nasa.gov.xml'))
         test_layer = cap.layers['AIRS_CO_Total_Column_Day']
@@ -104,19 +116,21 @@ class TestWMTS100(object):
         eq_(test_layer['default_style']['default'], True)
 
         eq_(test_layer['url_template'], 'http://map1.vis.earthdata.nasa.gov/wmts-geo/AIRS_CO_Total_Column_Day/default/%(time)s/%(tile_matrix_set)s/%%(z)s/%%(y)s/%%(x)s.png')
+        eq_(test_layer['matrix_set_limits'], {})
 
         eq_(len(test_layer['dimensions']), 1)
 
         test_dimension = test_layer['dimensions'][0]
 
-        eq_(len(test_dimension), 4)
-        for key in ['id', 'default', 'current', 'value']:
+        eq_(len(test_dimension), 5)
+        for key in ['id', 'default', 'current', 'value', 'values']:
             assert(key in test_dimension.keys())
 
         eq_(test_dimension['id'], 'time')
         eq_(test_dimension['default'], '2014-03-31')
         eq_(test_dimension['current'], 'false')
         eq_(test_dimension['value'], '2012-05-08/2014-03-31/P1D')
+        eq_(test_dimension['values'], ['2012-05-08/2014-03-31/P1D'])
 
 class TestWMTS100BaseMapAT(object):
     def test_parse_service(self):
@@ -192,7 +206,7 @@ class TestWMTS100BaseMapAT(object):
 
         eq_(len(test_layer['matrix_sets']), 1)
         for matrix_set in test_layer['matrix_sets']:
-            assert(isinstance(matrix_set, dict))
+            assert(isinstance(matrix_set, TileMatrixSet))
 
         eq_(test_layer['matrix_sets'][0]['crs'], 'urn:ogc:def:crs:EPSG:6.18:3:3857')
 
@@ -272,8 +286,35 @@ class TestWMTS100BaseMapATArcmap(object):
 
         eq_(len(test_layer['matrix_sets']), 1)
         for matrix_set in test_layer['matrix_sets']:
-            assert(isinstance(matrix_set, dict))
+            assert(isinstance(matrix_set, TileMatrixSet))
 
         eq_(test_layer['matrix_sets'][0]['crs'], 'urn:ogc:def:crs:EPSG:6.18:3:3857')
 
         eq_(test_layer['url_template'], 'http://maps1.wien.gv.at/basemap/geolandbasemap/%(style)s/%(tile_matrix_set)s/%%(z)s/%%(y)s/%%(x)s.jpeg')
+
+class TestRecords(object):
+    def test_tile_matrix_set(self):
+        cap = parse_capabilities(local_filename('data/wmts-v2.suite.opengeo.org-100.xml'))
+        matrix_set = cap.matrix_sets['EPSG:4326']
+        eq_(matrix_set.scale_denoms[0], 279541132.0143589)
+        tm = matrix_set['tile_matrices'][1]
+        assert isinstance(tm, TileMatrix)
+        eq_(dict(tm), {'id': 'EPSG:4326:1', 'top_left': (90.0, -180.0), 'tile_size': (256, 256),
+            'grid_size': (4, 2), 'scale_denom': matrix_set.scale_denoms[1]})
+        eq_(sorted(matrix_set.keys()), ['crs', 'id', 'tile_matrices'])
+        eq_(matrix_set.get('unknown'), None)
+
+    def test_layer(self):
+        cap = parse_capabilities(local_filename('data/wmts-v2.suite.opengeo.org-100.xml'))
+        layer = cap.layers['opengeo:geonames']
+        assert 'url_template' in layer
+        assert layer['matrix_sets'][0] is cap.matrix_sets[layer['matrix_sets'][0]['id']]
+        layer_dict = dict(layer)
+        eq_(layer_dict['title'], layer['title'])
+        assert not hasattr(layer, '__dict__')
+
+    def test_empty_format(self):
+        doc = open(local_filename('data/WMTSCapabilities.xml')).read()
+        doc = doc.replace('<Format>image/png</Format>', '<Format/><Format>image/png</Format>')
+        cap = parse_capabilities(StringIO(doc))
+        eq_(cap.layers['osm']['formats'], ['image/png'])
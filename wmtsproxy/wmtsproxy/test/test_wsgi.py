@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+
+from .. import csv
+from ..wsgi import ConfigLoader, WMTSMultiMapProxy, BuildFailures
+from ..config_writer import shard_mapproxy_conf
+from ..exceptions import CapabilitiesError, UserError
+
+from .server import RecordingHandler, start_server, stop_server
+
+from nose.tools import eq_
+
+WMS_CAPABILITIES = '''<?xml version="1.0"?>
+<WMT_MS_Capabilities version="1.1.1">
+  <Service><Name>OGC:WMS</Name><Title>Test</Title></Service>
+  <Capability>
+    <Request><GetMap><Format>image/png</Format><DCPType><HTTP><Get>
+      <OnlineResource xmlns:xlink="http://www.w3.org/1999/xlink" xlink:href="http://example.org/service?"/>
+    </Get></HTTP></DCPType></GetMap></Request>
+    <Layer>
+      <Name>osm</Name>
+      <Title>OSM</Title>
+      <SRS>EPSG:3857</SRS>
+      <LatLonBoundingBox minx="-180" miny="-85" maxx="180" maxy="85" />
+    </Layer>
+  </Capability>
+</WMT_MS_Capabilities>'''
+
+class CapabilitiesHandler(RecordingHandler):
+    document = WMS_CAPABILITIES
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if 'broken' in self.path:
+            self.send_response(500)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'application/vnd.ogc.wms_xml')
+        self.end_headers()
+        self.wfile.write(self.document)
+
+class TestConfigLoader(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.configs_path = os.path.join(self.tmp_dir, 'configs')
+        os.mkdir(self.configs_path)
+        self.base_file = os.path.join(self.tmp_dir, 'base.yaml')
+        with open(self.base_file, 'w') as f:
+            f.write('globals: {cache: {base_dir: tiles}}\n')
+        self.csv_file = os.path.join(self.tmp_dir, 'services.csv')
+        open(self.csv_file, 'w').close()
+        self.id = csv.to_csv(self.csv_file, 'wms', 'http://example.org', 'osm', 'EPSG:3857')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_app_ids(self):
+        loader = ConfigLoader(self.configs_path, self.base_file, csv_file=self.csv_file)
+        assert loader.app_available(self.id)
+        assert not loader.app_available('manual')
+
+        open(os.path.join(self.configs_path, 'manual.yaml'), 'w').close()
+        # directory changed
+        os.utime(self.configs_path, (time.time() + 10, time.time() + 10))
+        assert loader.app_available('manual')
+
+        other_id = csv.to_csv(self.csv_file, 'wms', 'http://example.org', 'roads', 'EPSG:3857')
+        os.utime(self.csv_file, (time.time() + 10, time.time() + 10))
+        eq_(sorted(loader.available_apps()), sorted([self.id, other_id, 'manual']))
+
+    def test_sharded_filename(self):
+        loader = ConfigLoader(self.configs_path, self.base_file, csv_file=self.csv_file, sharded=True)
+        conf_file = loader.filename_from_app_name(self.id)
+        eq_(os.path.dirname(os.path.dirname(os.path.dirname(conf_file))), self.configs_path)
+        assert loader.app_available(self.id)
+
+    def test_shard_mapproxy_conf(self):
+        conf = shard_mapproxy_conf({'base': ['base.yaml'], 'globals': {}}, self.base_file, self.configs_path)
+        eq_(conf['base'], [self.base_file])
+        eq_(conf['globals']['cache']['base_dir'], os.path.join(self.configs_path, 'tiles'))
+        eq_(conf['globals']['cache']['lock_dir'], os.path.join(self.configs_path, 'cache_data', 'tile_locks'))
+
+
+class CapabilitiesServerTestBase(object):
+    def setup(self):
+        self.server = start_server(CapabilitiesHandler)
+        CapabilitiesHandler.document = WMS_CAPABILITIES
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.base_file = os.path.join(self.tmp_dir, 'base.yaml')
+        with open(self.base_file, 'w') as f:
+            f.write('services: {demo: {}}\nglobals: {cache: {base_dir: tiles}}\n')
+        self.csv_file = os.path.join(self.tmp_dir, 'services.csv')
+        open(self.csv_file, 'w').close()
+        self.id = csv.to_csv(self.csv_file, 'wms', 'http://127.0.0.1:%d/service?' % self.server.server_port,
+            'osm', 'EPSG:3857')
+        self.loader = ConfigLoader(self.tmp_dir, self.base_file, csv_file=self.csv_file, in_memory=True)
+
+    def teardown(self):
+        stop_server(self.server)
+        shutil.rmtree(self.tmp_dir)
+
+class TestInMemoryConfigs(CapabilitiesServerTestBase):
+    def test_generated_conf(self):
+        app_conf = self.loader.app_conf(self.id)
+        conf = app_conf['mapproxy_conf_dict']
+        # merged with base
+        eq_(conf['globals']['cache']['base_dir'], 'tiles')
+        assert 'demo' in conf['services'] and 'wmts' in conf['services']
+        eq_(conf['__config_files__'].keys(), [self.base_file])
+
+        mp = WMTSMultiMapProxy(self.loader)
+        app, timestamps = mp.create_app(self.id)
+        assert 'wmts' in app.handlers
+        assert not self.loader.needs_reload(self.id, timestamps)
+
+        self.loader.config_writer.queue.join()
+        assert os.path.exists(app_conf['mapproxy_conf'])
+        eq_(self.loader.config_writer.pending(app_conf['mapproxy_conf']), None)
+
+    def test_existing_conf(self):
+        self.loader.app_conf(self.id)
+        self.loader.config_writer.queue.join()
+
+        loader = ConfigLoader(self.tmp_dir, self.base_file, csv_file=self.csv_file, in_memory=True)
+        conf = loader.app_conf(self.id)['mapproxy_conf_dict']
+        eq_(sorted(conf['__config_files__'].keys()), sorted([self.base_file, os.path.join(self.tmp_dir, self.id + '.yaml')]))
+        eq_(conf['globals']['cache']['base_dir'], 'tiles')
+
+
+class TestBuildFailures(object):
+    def test_backoff(self):
+        failures = BuildFailures(min_backoff=10, max_backoff=30)
+        eq_(failures.backoff('foo'), None)
+        failure = failures.failed('foo', CapabilitiesError('Opening given capabilities url failed.'))
+        assert failures.backoff('foo') is failure
+        eq_(failure.retry_at - failure.last_failure, 10)
+        eq_(failure.status_code, 503)
+        eq_(failure.message, 'Opening given capabilities url failed.')
+
+        failures.failed('foo', UserError('Layer not found'))
+        failure = failures.failed('foo', UserError('Layer not found'))
+        eq_(failure.retry_at - failure.last_failure, 30)
+        eq_(failure.status_code, 404)
+        eq_(failure.failures, 3)
+        eq_(failures.status()[0]['error'], 'UserError')
+
+        failures.succeeded('foo')
+        eq_(failures.backoff('foo'), None)
+        eq_(failures.status(), [])
+
+    def test_expired(self):
+        failures = BuildFailures(min_backoff=0)
+        failures.failed('foo', ValueError())
+        eq_(failures.backoff('foo'), None)
+        eq_(failures.get('foo').message, 'internal error')
+
+
+class TestFailedApps(CapabilitiesServerTestBase):
+    def start_response(self, status, headers, exc_info=None):
+        self.status = status
+        self.headers = dict(headers)
+
+    def request(self, app, path):
+        environ = {'PATH_INFO': path, 'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '', 'QUERY_STRING': '',
+            'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'wsgi.url_scheme': 'http'}
+        return ''.join(app(environ, self.start_response))
+
+    def test_backoff(self):
+        broken_id = csv.to_csv(self.csv_file, 'wms', 'http://127.0.0.1:%d/broken?' % self.server.server_port,
+            'roads', 'EPSG:3857')
+        app = WMTSMultiMapProxy(self.loader, list_apps=True)
+        self.request(app, '/%s/wmts/1.0.0/WMTSCapabilities.xml' % broken_id)
+        assert self.status.startswith('503')
+        assert 'Retry-After' in self.headers
+        self.request(app, '/%s/wmts/1.0.0/WMTSCapabilities.xml' % broken_id)
+        assert self.status.startswith('503')
+        # no further capabilities request during backoff
+        eq_(len(CapabilitiesHandler.requests), 1)
+
+        status = json.loads(self.request(app, '/_status'))
+        eq_([f['id'] for f in status['failed_builds']], [broken_id])
+        eq_(status['failed_builds'][0]['error'], 'CapabilitiesError')
+
+        self.request(app, '/%s/wmts/1.0.0/WMTSCapabilities.xml' % self.id)
+        assert self.status.startswith('200')
@@ -1,4 +1,84 @@
+import os
+import re
+import json
+import hashlib
+
+import logging
+
+log = logging.getLogger(__name__)
+
 def is_supported_srs(srs):
     if not srs.startswith('EPSG'):
         return False
-    return True
\ No newline at end of file
+    return True
+
+def safe_name(name):
+    """
+    Replace all characters that are not safe for IDs, cache and file names.
+
+    >>> safe_name('osm.omniscale.net_opengeo:geonames')
+    'osm_omniscale_net_opengeo_geonames'
+    """
+    return re.sub('[^A-Za-z0-9-_]', '_', name)
+
+def iter_json(doc, stream_key):
+    """
+    Encode `doc` as JSON in chunks. The value of `stream_key` can be any
+    iterable and it is encoded item by item as a list.
+
+    The response is already sent when an item fails. The list is then
+    closed and the document contains the ``error`` message, so that it
+    is still valid JSON.
+
+    >>> ''.join(iter_json({'title': 'foo', 'layers': iter([1, {'a': 2}])}, 'layers'))
+    '{"title": "foo", "layers": [1, {"a": 2}]}'
+    >>> ''.join(iter_json({'layers': (1 / x for x in [1, 0])}, 'layers'))
+    '{"layers": [1], "error": "internal server error"}'
+    """
+    yield '{'
+    for key, value in sorted(doc.iteritems()):
+        if key != stream_key:
+            yield '%s: %s, ' % (json.dumps(key), json.dumps(value))
+    yield '%s: [' % json.dumps(stream_key)
+    try:
+        for i, item in enumerate(doc[stream_key]):
+            item = json.dumps(item)
+            yield ', ' + item if i else item
+    except Exception as ex:
+        log.exception(ex)
+        yield '], "error": %s}' % json.dumps(getattr(ex, 'user_msg', 'internal server error'))
+        return
+    yield ']}'
+
+def getmtime(filename):
+    """
+    Return modification time of `filename`, or None if it does not exist.
+    """
+    try:
+        return os.path.getmtime(filename)
+    except OSError:
+        return None
+
+SHARD_CHARS = '0123456789abcdef'
+
+def config_filename(configs_path, id, sharded=False, suffix='.yaml'):
+    """
+    Return the filename of the generated configuration `id`. Sharded
+    configurations are stored in two levels of sub-directories, by
+    the hash of the id.
+
+    >>> config_filename('/configs', 'foo')
+    '/configs/foo.yaml'
+    >>> config_filename('/configs', 'foo', sharded=True)
+    '/configs/a/c/foo.yaml'
+    """
+    if not sharded:
+        return os.path.join(configs_path, id + suffix)
+    hash = hashlib.md5(id).hexdigest()
+    return os.path.join(configs_path, hash[0], hash[1], id + suffix)
+
+def shard_dirs(configs_path):
+    """
+    Return the directories of all shards in `configs_path`.
+    """
+    return [os.path.join(configs_path, a, b) for a in SHARD_CHARS for b in SHARD_CHARS]
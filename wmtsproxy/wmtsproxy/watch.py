@@ -0,0 +1,195 @@
+"""
+Watches the generated configurations, the base configuration and the CSV
+file for changes.
+
+`ConfigLoader.needs_reload` is called for each request. Without a watcher
+it checks the modification times of the configuration files and the
+timestamp of the CSV record. With a watcher it only compares the known
+modification times and the set of stale app ids, without any file system
+access. The watcher updates these in a background thread, with inotify
+if pyinotify is installed, or by polling otherwise.
+"""
+
+from __future__ import absolute_import
+
+import os
+import threading
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+import logging
+
+from .csv import read_csv, record_config_timestamp
+from .utils import shard_dirs, getmtime
+
+log = logging.getLogger(__name__)
+
+def record_timestamps(csv_file):
+    timestamps = {}
+    if not os.path.exists(csv_file):
+        return timestamps
+    for id, rec in read_csv(csv_file).iteritems():
+        timestamps[id] = record_config_timestamp(rec)
+    return timestamps
+
+
+class FileWatcher(object):
+    """
+    Base class for watchers of the configurations in `configs_path`, the
+    `base_file` and the `csv_file`.
+    """
+    def __init__(self, configs_path, base_file, csv_file, suffix='.yaml', sharded=False):
+        self.configs_path = os.path.abspath(configs_path)
+        if sharded:
+            self.config_dirs = set(shard_dirs(self.configs_path))
+        else:
+            self.config_dirs = set([self.configs_path])
+        self.base_file = os.path.abspath(base_file)
+        self.csv_file = os.path.abspath(csv_file)
+        self.suffix = suffix
+        # filename -> modification time, None for removed files
+        self.mtimes = {}
+        # ids of apps with an updated CSV record
+        self.stale_apps = set()
+        self._record_timestamps = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def needs_reload(self, app_name, timestamps):
+        """
+        Return True if the CSV record of `app_name` was updated or if one
+        of the configuration files changed since `timestamps`.
+        """
+        if app_name in self.stale_apps:
+            return True
+        for conf_file, timestamp in timestamps.iteritems():
+            mtime = self.mtimes.get(conf_file, timestamp)
+            if mtime is None or mtime > timestamp:
+                return True
+        return False
+
+    def reloaded(self, app_name):
+        """
+        Mark `app_name` as up to date. Called before the configuration is
+        created again.
+        """
+        self.stale_apps.discard(app_name)
+
+    def scan(self):
+        """
+        Update the modification times of all watched files.
+        """
+        self.file_changed(self.base_file)
+        self.file_changed(self.csv_file)
+        for path in self.config_dirs:
+            if not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                if name.endswith(self.suffix):
+                    self.file_changed(os.path.join(path, name))
+
+    def file_changed(self, filename):
+        if filename == self.csv_file:
+            self._csv_changed()
+        elif filename == self.base_file or (
+            os.path.dirname(filename) in self.config_dirs and filename.endswith(self.suffix)):
+            self.mtimes[filename] = getmtime(filename)
+
+    def _csv_changed(self):
+        with self._lock:
+            mtime = getmtime(self.csv_file)
+            if mtime is not None and mtime == self.mtimes.get(self.csv_file):
+                return
+            self.mtimes[self.csv_file] = mtime
+            try:
+                timestamps = record_timestamps(self.csv_file)
+            except Exception as ex:
+                log.warn('unable to read %s: %s', self.csv_file, ex)
+                return
+            for id, timestamp in timestamps.iteritems():
+                previous = self._record_timestamps.get(id)
+                if previous is not None and timestamp > previous:
+                    self.stale_apps.add(id)
+            self._record_timestamps = timestamps
+
+    def start(self):
+        self.scan()
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+        return t
+
+    def run(self):
+        raise NotImplementedError()
+
+    def stop(self):
+        self._stop.set()
+
+
+class PollingWatcher(FileWatcher):
+    """
+    Checks all watched files every `interval` seconds.
+    """
+    def __init__(self, configs_path, base_file, csv_file, suffix='.yaml', sharded=False, interval=1.0):
+        FileWatcher.__init__(self, configs_path, base_file, csv_file, suffix=suffix, sharded=sharded)
+        self.interval = interval
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.scan()
+                # removed configurations
+                for filename, mtime in self.mtimes.items():
+                    if mtime is not None and not os.path.exists(filename):
+                        self.mtimes[filename] = None
+            except Exception as ex:
+                log.exception(ex)
+
+
+class InotifyWatcher(FileWatcher):
+    """
+    Watches the directories of all watched files with inotify.
+    Requires pyinotify.
+    """
+    def run(self):
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+            | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | pyinotify.IN_ATTRIB)
+        wm = pyinotify.WatchManager()
+        dirs = self.config_dirs | set([os.path.dirname(self.base_file), os.path.dirname(self.csv_file)])
+        for path in dirs:
+            wm.add_watch(path, mask)
+        notifier = pyinotify.Notifier(wm, self._process_event, timeout=1000)
+        # check for changes till the watches were added
+        self.scan()
+        try:
+            while not self._stop.is_set():
+                if notifier.check_events():
+                    notifier.read_events()
+                    notifier.process_events()
+        finally:
+            notifier.stop()
+
+    def _process_event(self, event):
+        try:
+            self.file_changed(event.pathname)
+        except Exception as ex:
+            log.exception(ex)
+
+
+def file_watcher(configs_path, base_file, csv_file, suffix='.yaml', backend=None, sharded=False):
+    """
+    Return a new watcher for the `backend` ``inotify`` or ``poll``.
+    Uses inotify if `backend` is None and pyinotify is available.
+    """
+    if backend is None:
+        backend = 'inotify' if pyinotify is not None else 'poll'
+    if backend == 'inotify':
+        if pyinotify is None:
+            raise ImportError('inotify watcher requires pyinotify')
+        return InotifyWatcher(configs_path, base_file, csv_file, suffix=suffix, sharded=sharded)
+    if backend == 'poll':
+        return PollingWatcher(configs_path, base_file, csv_file, suffix=suffix, sharded=sharded)
+    raise ValueError('unknown watch backend %r' % backend)
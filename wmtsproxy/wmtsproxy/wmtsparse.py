@@ -1,6 +1,7 @@
 import re
 import sys
 
+from array import array
 from xml.etree import ElementTree as etree
 
 from mapproxy.util.ext.wmsparse.util import resolve_ns
@@ -8,6 +9,118 @@ from mapproxy.util.py import reraise_exception
 
 from .exceptions import CapabilitiesError
 
+class Record(object):
+    """
+    Base for slotted records with a read-only dict view of the `_fields`.
+    """
+    __slots__ = ()
+    _fields = ()
+
+    def __getitem__(self, key):
+        if key not in self._fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self._fields:
+            return default
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def keys(self):
+        return list(self._fields)
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self._fields]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.items()))
+
+
+class Layer(Record):
+    __slots__ = _fields = ('title', 'bbox', 'formats', 'info_formats', 'matrix_sets', 'styles',
+        'default_style', 'url_template', 'dimensions', 'matrix_set_limits')
+
+    def __init__(self, **kw):
+        for key in self.__slots__:
+            setattr(self, key, kw[key])
+
+
+class TileMatrix(Record):
+    __slots__ = _fields = ('id', 'top_left', 'tile_size', 'grid_size', 'scale_denom')
+
+    def __init__(self, id, top_left, tile_size, grid_size, scale_denom):
+        self.id = id
+        self.top_left = top_left
+        self.tile_size = tile_size
+        self.grid_size = grid_size
+        self.scale_denom = scale_denom
+
+
+class TileMatrixSet(Record):
+    """
+    TileMatrixSet with the values of all TileMatrices in arrays.
+    `tile_matrices` returns `TileMatrix` records of these values.
+    """
+    __slots__ = ('id', 'crs', '_ids', '_top_lefts', '_sizes', '_scale_denoms')
+    _fields = ('id', 'crs', 'tile_matrices')
+
+    def __init__(self, id, crs, tile_matrices=()):
+        self.id = id
+        self.crs = crs
+        self._ids = []
+        # x, y of each top left corner
+        self._top_lefts = array('d')
+        # tile width, tile height, matrix width, matrix height of each tile matrix
+        self._sizes = array('l')
+        self._scale_denoms = array('d')
+        for tm in tile_matrices:
+            self.append(tm['id'], tm['top_left'], tm['tile_size'], tm['grid_size'], tm['scale_denom'])
+
+    def append(self, id, top_left, tile_size, grid_size, scale_denom):
+        self._ids.append(id)
+        self._top_lefts.extend(top_left)
+        self._sizes.extend(tuple(tile_size) + tuple(grid_size))
+        self._scale_denoms.append(scale_denom)
+
+    @property
+    def ids(self):
+        return self._ids
+
+    @property
+    def top_lefts(self):
+        return self._top_lefts
+
+    @property
+    def sizes(self):
+        return self._sizes
+
+    @property
+    def scale_denoms(self):
+        return self._scale_denoms
+
+    @property
+    def tile_matrices(self):
+        tile_matrices = []
+        tl, sizes = self._top_lefts, self._sizes
+        for i, id in enumerate(self._ids):
+            tile_matrices.append(TileMatrix(id, (tl[i*2], tl[i*2+1]),
+                (sizes[i*4], sizes[i*4+1]), (sizes[i*4+2], sizes[i*4+3]),
+                self._scale_denoms[i]))
+        return tile_matrices
+
+
 class WMTSCapabilities(object):
 
     _default_namespace = 'http://www.opengis.net/wmts/1.0'
@@ -92,25 +205,21 @@ class WMTSCapabilities(object):
             identifier = self.findtext(tile_matrix_sets_elem, 'ows:Identifier')
             supported_crs = self.findtext(tile_matrix_sets_elem, 'ows:SupportedCRS')
 
-            tile_matrices = []
+            matrix_set = TileMatrixSet(identifier, supported_crs)
             tile_matrix_elems = self.findall(tile_matrix_sets_elem, 'TileMatrix')
             for tile_matrix_elem in tile_matrix_elems:
                 tile_width = int(self.findtext(tile_matrix_elem, 'TileWidth'))
                 tile_height = int(self.findtext(tile_matrix_elem, 'TileHeight'))
                 matrix_width = int(self.findtext(tile_matrix_elem, 'MatrixWidth'))
                 matrix_height = int(self.findtext(tile_matrix_elem, 'MatrixHeight'))
-                tile_matrices.append(dict(
+                matrix_set.append(
                     id = self.findtext(tile_matrix_elem, 'ows:Identifier'),
                     top_left = top_left_corner_to_coord(self.findtext(tile_matrix_elem, 'TopLeftCorner'), supported_crs),
                     tile_size = (tile_width, tile_height),
                     grid_size = (matrix_width, matrix_height),
                     scale_denom = float(self.findtext(tile_matrix_elem, 'ScaleDenominator'))
-                ))
-            self._matrix_sets[identifier] = {
-                'id': identifier,
-                'crs': supported_crs,
-                'tile_matrices': tile_matrices
-            }
+                )
+            self._matrix_sets[identifier] = matrix_set
 
         return self._matrix_sets
 
@@ -135,7 +244,10 @@ class WMTSCapabilities(object):
             formats = []
             format_elems = self.findall(layer_elem, 'Format')
             for format_elem in format_elems:
-                formats.append(format_elem.text)
+                if not format_elem.text:
+                    continue
+                # formats are repeated for most layers
+                formats.append(intern(format_elem.text.encode('utf-8')))
 
             info_formats = []
             info_format_elems = self.findall(layer_elem, 'InfoFormat')
@@ -166,31 +278,52 @@ class WMTSCapabilities(object):
                     'id': self.findtext(dimension_elem, 'ows:Identifier'),
                     'default': self.findtext(dimension_elem, 'Default'),
                     'current': self.findtext(dimension_elem, 'Current'),
-                    'value': self.findtext(dimension_elem, 'Value')
+                    'value': self.findtext(dimension_elem, 'Value'),
+                    'values': [elem.text for elem in self.findall(dimension_elem, 'Value') if elem.text],
                 })
 
             matrix_sets = []
+            matrix_set_limits = {}
             matrix_set_elems = self.findall(layer_elem, 'TileMatrixSetLink')
             for matrix_set_elem in matrix_set_elems:
                 matrix_set_identifier = self.findtext(matrix_set_elem, 'TileMatrixSet')
                 if not matrix_set_identifier in self.matrix_sets.keys():
                     raise CapabilitiesError('Matrix set required by layer not defined in capabilities document')
                 matrix_sets.append(self.matrix_sets[matrix_set_identifier])
-
-            self._layers[layer_id] = {
-                'title': title,
-                'bbox': bbox,
-                'formats': formats,
-                'info_formats': info_formats,
-                'matrix_sets': matrix_sets,
-                'styles': styles,
-                'default_style': default_style,
-                'url_template': self._wmts_url_template(layer_elem, dimensions),
-                'dimensions': dimensions
-            }
+                limits = self._tile_matrix_limits(matrix_set_elem)
+                if limits:
+                    matrix_set_limits[matrix_set_identifier] = limits
+
+            self._layers[layer_id] = Layer(
+                title=title,
+                bbox=bbox,
+                formats=formats,
+                info_formats=info_formats,
+                matrix_sets=matrix_sets,
+                styles=styles,
+                default_style=default_style,
+                url_template=self._wmts_url_template(layer_elem, dimensions),
+                dimensions=dimensions,
+                matrix_set_limits=matrix_set_limits,
+            )
 
         return self._layers
 
+    def _tile_matrix_limits(self, matrix_set_elem):
+        limits = {}
+        limit_elems = self.findall(matrix_set_elem, 'TileMatrixSetLimits/TileMatrixLimits')
+        for limit_elem in limit_elems:
+            try:
+                limits[self.findtext(limit_elem, 'TileMatrix')] = {
+                    'min_row': int(self.findtext(limit_elem, 'MinTileRow')),
+                    'max_row': int(self.findtext(limit_elem, 'MaxTileRow')),
+                    'min_col': int(self.findtext(limit_elem, 'MinTileCol')),
+                    'max_col': int(self.findtext(limit_elem, 'MaxTileCol')),
+                }
+            except (TypeError, ValueError):
+                raise CapabilitiesError('Invalid TileMatrixLimits in capabilities document')
+        return limits
+
     def _exists_operation_mode(self, operation, mode):
         return self.operations and operation in self.operations.keys() and mode in self.operations[operation].keys()
 
@@ -1,38 +1,289 @@
 from __future__ import absolute_import
 
+import copy
+import json
 import time
 import os.path
+import threading
+import Queue
 
 from mapproxy import multiapp
+from mapproxy.response import Response
+from mapproxy.wsgiapp import MapProxyApp, wrap_wsgi_debug
+from mapproxy.config.loader import ConfigurationError, load_configuration_file, merge_dict
+from mapproxy.util.yaml import load_yaml_file
 
 import logging
 
-from .csv import available_configs, from_csv
-from .config_writer import write_mapproxy_conf, mapproxy_config_from_csv
-from .exceptions import CapabilitiesError, UserError, FeatureError, ServiceError, ConfigWriterError
+from .csv import available_configs, from_csv, record_config_timestamp
+from .exceptions import (CapabilitiesError, UserError, FeatureError, ServiceError, ConfigWriterError,
+    TileMatrixError, WMTSProxyError)
+from .utils import config_filename, shard_dirs, getmtime
+from .cache_headers import ConditionalTileApp
+
+# The config writer (with capabilities, grids and requests), the
+# dimensions and the watcher are imported on first use, so that workers
+# that only serve existing configurations start fast (see test_imports).
 
 log = logging.getLogger(__name__)
 
+class BackgroundConfigWriter(object):
+    """
+    Writes configurations in a background thread. Configurations that
+    are not written yet are available with `pending`.
+    """
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.queue = Queue.Queue()
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def write(self, mapproxy_conf, filename):
+        with self._lock:
+            self._pending[filename] = mapproxy_conf
+        self.queue.put(filename)
+
+    def pending(self, filename):
+        return self._pending.get(filename)
+
+    def _run(self):
+        from .config_writer import write_mapproxy_conf
+        while True:
+            filename = self.queue.get()
+            try:
+                mapproxy_conf = self._pending.get(filename)
+                if mapproxy_conf is not None:
+                    write_mapproxy_conf(mapproxy_conf, filename)
+                    with self._lock:
+                        if self._pending.get(filename) is mapproxy_conf:
+                            del self._pending[filename]
+            except Exception as ex:
+                log.exception(ex)
+            finally:
+                self.queue.task_done()
+
+
+def make_mapproxy_app(conf_dict, conf_base_dir, debug=False):
+    """
+    Return MapProxy app for the (merged) configuration dict. Validates
+    the configuration like `mapproxy.wsgiapp.make_wsgi_app`.
+    """
+    # tile sources of layers with dimension_mode=request or concurrent_requests
+    from .hosts import load_mapproxy_conf
+    return _make_app(load_mapproxy_conf(conf_dict, conf_base_dir), debug)
+
+def make_mapproxy_file_app(conf_file, debug=False):
+    """
+    Return MapProxy app for the configuration file `conf_file`.
+    """
+    from .hosts import load_mapproxy_conf_file
+    return _make_app(load_mapproxy_conf_file(conf_file), debug)
+
+def _make_app(conf, debug=False):
+    app = MapProxyApp(conf.configured_services(), conf.base_config)
+    if debug:
+        app = wrap_wsgi_debug(app, conf)
+    app.config_files = conf.config_files()
+    return app
+
+
+class BuildFailure(object):
+    def __init__(self, id):
+        self.id = id
+        self.error = None
+        self.message = None
+        self.failures = 0
+        self.last_failure = None
+        self.retry_at = None
+
+    @property
+    def status_code(self):
+        """
+        404 for layers that can not be configured, 503 for errors
+        that might be temporary (e.g. unavailable capabilities).
+        """
+        if self.error in (UserError.__name__, FeatureError.__name__, TileMatrixError.__name__,
+            ConfigWriterError.__name__, ConfigurationError.__name__):
+            return 404
+        return 503
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'error': self.error,
+            'message': self.message,
+            'failures': self.failures,
+            'last_failure': self.last_failure,
+            'retry_at': self.retry_at,
+        }
+
+
+class BuildFailures(object):
+    """
+    Remembers failed builds of app configurations. An app is not built
+    again for `min_backoff` seconds after a failure. The backoff is doubled
+    for each following failure, up to `max_backoff` seconds.
+    """
+    def __init__(self, min_backoff=10, max_backoff=3600):
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def failed(self, app_name, ex):
+        with self._lock:
+            failure = self._failures.get(app_name)
+            if failure is None:
+                failure = self._failures[app_name] = BuildFailure(app_name)
+            failure.failures += 1
+            failure.error = ex.__class__.__name__
+            failure.message = ex.user_msg if isinstance(ex, WMTSProxyError) else 'internal error'
+            failure.last_failure = time.time()
+            backoff = min(self.min_backoff * 2 ** (failure.failures - 1), self.max_backoff)
+            failure.retry_at = failure.last_failure + backoff
+            return failure
+
+    def succeeded(self, app_name):
+        if app_name in self._failures:
+            with self._lock:
+                self._failures.pop(app_name, None)
+
+    def get(self, app_name):
+        return self._failures.get(app_name)
+
+    def backoff(self, app_name):
+        """
+        Return the `BuildFailure` of `app_name` if it should not be built yet.
+        """
+        failure = self._failures.get(app_name)
+        if failure is not None and failure.retry_at > time.time():
+            return failure
+        return None
+
+    def status(self):
+        return [failure.as_dict() for failure in sorted(self._failures.values(), key=lambda f: f.id)]
+
+
+class AppBuildError(Exception):
+    pass
+
+def failure_response(failure):
+    resp = Response('configuration of %s failed: %s' % (failure.id, failure.message),
+        status=failure.status_code)
+    if failure.status_code == 503:
+        resp.headers['Retry-After'] = str(max(1, int(failure.retry_at - time.time())))
+    return resp
+
+
+class WMTSMultiMapProxy(multiapp.MultiMapProxy):
+    """
+    MultiMapProxy that creates apps from the configuration dicts of
+    `ConfigLoader.app_conf`, if available.
+
+    Returns 404 or 503 for apps with failed configurations, till the
+    backoff of the failure expires. Tiles are served with the cache
+    headers of `ConditionalTileApp`. Lists these apps as JSON at
+    ``/_status``, if `list_apps` is True.
+    """
+    status_path = '_status'
+
+    def handle(self, req):
+        if self.list_apps and req.path.strip('/') == self.status_path:
+            return Response(json.dumps({'failed_builds': self.loader.failures.status()}),
+                mimetype='application/json')
+        return multiapp.MultiMapProxy.handle(self, req)
+
+    def proj_app(self, proj_name):
+        failure = self.loader.failures.backoff(proj_name)
+        if failure is not None:
+            return failure_response(failure)
+        try:
+            return multiapp.MultiMapProxy.proj_app(self, proj_name)
+        except AppBuildError:
+            return failure_response(self.loader.failures.get(proj_name))
+
+    def create_app(self, proj_name):
+        app_conf = self.loader.app_conf(proj_name)
+        if app_conf is None:
+            raise AppBuildError(proj_name)
+        log.info('initializing project app %s with %s', proj_name, app_conf['mapproxy_conf'])
+        try:
+            if 'mapproxy_conf_dict' not in app_conf:
+                app = make_mapproxy_file_app(app_conf['mapproxy_conf'], debug=self.debug)
+            else:
+                app = make_mapproxy_app(app_conf['mapproxy_conf_dict'], os.path.dirname(app_conf['mapproxy_conf']),
+                    debug=self.debug)
+        except ConfigurationError as ex:
+            log.warn('configuration of %s failed: %s', proj_name, ex)
+            self.loader.failures.failed(proj_name, ex)
+            raise AppBuildError(proj_name)
+        return ConditionalTileApp(app), app.config_files
+
+
 class ConfigLoader(multiapp.DirectoryConfLoader):
+    """
+    Loads the configurations in `base_dir` and creates missing or outdated
+    configurations from the records in `csv_file`.
+
+    Configurations are stored in sub-directories of `base_dir` if `sharded`
+    is True (see `utils.config_filename`).
 
-    def __init__(self, base_dir, base_file, suffix='.yaml', csv_file='/tmp/layers.csv'):
+    `app_conf` returns the configuration as dict if `in_memory` is True.
+    The dict is merged with the cached base configuration, and new
+    configurations are written in the background.
+    """
+    def __init__(self, base_dir, base_file, suffix='.yaml', csv_file='/tmp/layers.csv', writer_options=None,
+        watcher=None, sharded=False, in_memory=False, failures=None):
         super(ConfigLoader, self).__init__(base_dir, suffix='.yaml')
         self.base_file = base_file
         self.csv_file = csv_file
+        self.writer_options = writer_options
+        self.watcher = watcher
+        self.sharded = sharded
         self.last_checks = {}
+        self.config_writer = BackgroundConfigWriter() if in_memory else None
+        self.failures = failures if failures is not None else BuildFailures()
+        # time when configurations were created, till they are written
+        self._conf_timestamps = {}
+        self._base_confs = {}
+        self._app_ids = frozenset()
+        self._app_ids_mtimes = None
+        self._app_ids_lock = threading.Lock()
+
+    def filename_from_app_name(self, app_name):
+        return config_filename(self.base_dir, app_name, sharded=self.sharded, suffix=self.suffix)
 
     def app_available(self, app_name):
-        if app_name in self.available_apps():
-            return True
-        return False
+        return app_name in self.app_ids()
 
     def available_apps(self):
-        apps = super(ConfigLoader, self).available_apps()
-        apps += available_configs(self.csv_file)
+        return list(self.app_ids())
 
-        return list(set(apps))
+    def app_ids(self):
+        """
+        Return set with the ids of all available apps. The set is cached
+        till the CSV file or the directory of the configurations changes.
+        Sharded configurations are only available if they have a record.
+        """
+        mtimes = getmtime(self.csv_file), None if self.sharded else getmtime(self.base_dir)
+        if mtimes != self._app_ids_mtimes:
+            with self._app_ids_lock:
+                if mtimes != self._app_ids_mtimes:
+                    apps = set(available_configs(self.csv_file))
+                    if not self.sharded:
+                        apps.update(super(ConfigLoader, self).available_apps())
+                    self._app_ids = frozenset(apps)
+                    self._app_ids_mtimes = mtimes
+        return self._app_ids
 
     def needs_reload(self, app_name, timestamps):
+        if self.watcher is not None:
+            if not timestamps:
+                return True
+            return self.watcher.needs_reload(app_name, timestamps)
+
         last_check = self.last_checks.get(app_name, 0)
         # check at most once a second
         if last_check and (last_check + 1) > time.time():
@@ -51,34 +302,125 @@ class ConfigLoader(multiapp.DirectoryConfLoader):
     def _is_stale(self, app_name, conf_file):
         """check if csv contains a more recent timestamp"""
         rec = from_csv(app_name, self.csv_file)
-        if rec.timestamp > os.path.getmtime(conf_file):
+        timestamp = self._conf_timestamps.get(app_name)
+        if timestamp is None or (self.config_writer.pending(conf_file) is None and self._is_conf_file(conf_file)):
+            timestamp = os.path.getmtime(conf_file)
+        if record_config_timestamp(rec) > timestamp:
             return True
         return False
 
+    def _base_conf(self, base_files, conf_base_dir):
+        """
+        Return the merged base configuration. Base files are only loaded
+        again if one of the files changed.
+        """
+        key = tuple(base_files), conf_base_dir
+        base_conf = self._base_confs.get(key)
+        if base_conf is not None:
+            for filename, timestamp in base_conf['__config_files__'].iteritems():
+                if not os.path.exists(filename) or os.path.getmtime(filename) != timestamp:
+                    base_conf = None
+                    break
+        if base_conf is None:
+            base_conf = load_configuration_file(base_files, conf_base_dir)
+            self._base_confs[key] = base_conf
+        return base_conf
+
+    def _merged_conf(self, mapproxy_conf, conf_file, timestamp=None):
+        """
+        Return `mapproxy_conf` merged into the base configuration.
+        """
+        mapproxy_conf = copy.deepcopy(mapproxy_conf)
+        base_files = mapproxy_conf.pop('base', [])
+        if isinstance(base_files, basestring):
+            base_files = [base_files]
+        base_conf = copy.deepcopy(self._base_conf(base_files, os.path.dirname(conf_file)))
+        if timestamp is not None:
+            base_conf['__config_files__'][os.path.abspath(conf_file)] = timestamp
+        return merge_dict(mapproxy_conf, base_conf)
+
     def app_conf(self, app_name):
+        if self.watcher is not None:
+            self.watcher.reloaded(app_name)
         conf_file = self.filename_from_app_name(app_name)
 
-        if not self._is_conf_file(conf_file) or self._is_stale(app_name, conf_file):
+        mapproxy_conf = None
+        if self.config_writer is not None:
+            mapproxy_conf = self.config_writer.pending(conf_file)
+        is_conf = mapproxy_conf is not None or self._is_conf_file(conf_file)
+
+        if not is_conf or self._is_stale(app_name, conf_file):
+            from .config_writer import mapproxy_config_from_csv, shard_mapproxy_conf, write_mapproxy_conf
             try:
-                mapproxy_conf = mapproxy_config_from_csv(app_name, self.base_file, csv_config_file=self.csv_file)
+                mapproxy_conf = mapproxy_config_from_csv(app_name, self.base_file, csv_config_file=self.csv_file,
+                    writer_options=self.writer_options)
+                if self.sharded:
+                    shard_mapproxy_conf(mapproxy_conf, self.base_file, self.base_dir)
 
-                write_mapproxy_conf(mapproxy_conf, os.path.join(self.base_dir, app_name + self.suffix))
-                conf_file = self.filename_from_app_name(app_name)
+                if self.config_writer is not None:
+                    self._conf_timestamps[app_name] = time.time()
+                    self.config_writer.write(mapproxy_conf, conf_file)
+                else:
+                    write_mapproxy_conf(mapproxy_conf, conf_file)
             except (CapabilitiesError, UserError) as ex:
                 log.warn(ex.system_msg)
+                self.failures.failed(app_name, ex)
                 return None
             except (FeatureError, ServiceError, ConfigWriterError) as ex:
                 log.warn(ex.system_msg, exc_info=1)
+                self.failures.failed(app_name, ex)
                 return None
             except Exception as ex:
                 log.exception(ex)
+                self.failures.failed(app_name, ex)
                 return None
 
-        return {'mapproxy_conf': conf_file}
+        self.failures.succeeded(app_name)
+        if self.config_writer is None:
+            return {'mapproxy_conf': conf_file}
+
+        try:
+            if mapproxy_conf is None:
+                # existing configuration
+                self._conf_timestamps.pop(app_name, None)
+                timestamp = os.path.getmtime(conf_file)
+                mapproxy_conf = load_yaml_file(conf_file)
+                mapproxy_conf = self._merged_conf(mapproxy_conf, conf_file, timestamp)
+            else:
+                # generated configurations are not reloaded when the
+                # file is written, changes are detected by the CSV timestamp
+                mapproxy_conf = self._merged_conf(mapproxy_conf, conf_file)
+        except Exception as ex:
+            log.exception(ex)
+            self.failures.failed(app_name, ex)
+            return None
+
+        return {'mapproxy_conf': conf_file, 'mapproxy_conf_dict': mapproxy_conf}
+
+def make_wsgi_app(configs_path, base_file, csv_file, allow_listing=True, debug=False, writer_options=None,
+    watch=False, sharded=False, in_memory=False):
+    """
+    Return MultiMapProxy app for all layers of `csv_file`.
 
-def make_wsgi_app(configs_path, base_file, csv_file, allow_listing=True, debug=False):
+    Changed configurations are detected by a background watcher if `watch`
+    is True or the name of a backend (``inotify`` or ``poll``, see
+    `watch.file_watcher`). Configurations are stored in sub-directories
+    of `configs_path` if `sharded` is True. New configurations are loaded
+    without reading the YAML files if `in_memory` is True.
+    """
     configs_path = os.path.abspath(configs_path)
     if not os.path.exists(configs_path):
         os.makedirs(configs_path)
-    loader = ConfigLoader(configs_path, base_file=base_file, csv_file=csv_file)
-    return multiapp.MultiMapProxy(loader, list_apps=allow_listing, debug=debug)
+    if sharded:
+        for path in shard_dirs(configs_path):
+            if not os.path.exists(path):
+                os.makedirs(path)
+    watcher = None
+    if watch:
+        from .watch import file_watcher
+        watcher = file_watcher(configs_path, base_file, csv_file, backend=None if watch is True else watch,
+            sharded=sharded)
+        watcher.start()
+    loader = ConfigLoader(configs_path, base_file=base_file, csv_file=csv_file, writer_options=writer_options,
+        watcher=watcher, sharded=sharded, in_memory=in_memory)
+    return WMTSMultiMapProxy(loader, list_apps=allow_listing, debug=debug)
@@ -1,15 +1,27 @@
 import logging
+from itertools import chain, islice
 from functools import wraps
-from flask import Flask, request, jsonify, current_app
+from flask import Flask, Response, request, jsonify, current_app
 
-from wmtsproxy.capabilities import add_wms_layer, add_wmts_layer, cap_dict
+from wmtsproxy.capabilities import add_wms_layer, add_wmts_layer, add_wms_layers, add_wmts_layers, cap_dict
 from wmtsproxy.exceptions import CapabilitiesError, UserError, FeatureError, ServiceError
+from wmtsproxy.seed import SeedWorkerPool, parse_levels, parse_bbox
+from wmtsproxy.utils import iter_json
 
 log = logging.getLogger(__name__)
 app = Flask(__name__)
 
 class DefaultConfig(object):
     CSV_FILE = './services.csv'
+    # required for seeding
+    CONFIGS_PATH = None
+    BASE_FILE = None
+    SEED_WORKERS = 1
+    SEED_CONCURRENCY = 2
+    # same as writer_options of wmtsproxy.wsgi.make_wsgi_app
+    WRITER_OPTIONS = None
+    # same as sharded of wmtsproxy.wsgi.make_wsgi_app
+    SHARDED_CONFIGS = False
 
 def create_app(config=None):
     app.config.from_object(DefaultConfig())
@@ -19,6 +31,20 @@ def create_app(config=None):
 
     return app
 
+_seed_pool = None
+
+def seed_pool():
+    global _seed_pool
+    if _seed_pool is None:
+        if not app.config.get('CONFIGS_PATH') or not app.config.get('BASE_FILE'):
+            raise ServiceError('Seeding not configured', 'CONFIGS_PATH and BASE_FILE required for seeding')
+        _seed_pool = SeedWorkerPool(app.config['CONFIGS_PATH'], app.config['BASE_FILE'],
+            app.config.get('CSV_FILE'), num_workers=app.config.get('SEED_WORKERS'),
+            concurrency=app.config.get('SEED_CONCURRENCY'),
+            writer_options=app.config.get('WRITER_OPTIONS'),
+            sharded=app.config.get('SHARDED_CONFIGS'))
+    return _seed_pool
+
 def json_error_response(message, status=500):
     resp = jsonify({'error': message})
     resp.status_code = status
@@ -30,14 +56,32 @@ def jsonp(func):
     def decorated_function(*args, **kwargs):
         callback = request.args.get('callback', False)
         if callback:
-            data = str(func(*args, **kwargs).data)
-            content = str(callback) + '(' + data + ')'
+            resp = func(*args, **kwargs)
+            if resp.is_streamed:
+                content = chain([str(callback) + '('], resp.response, [')'])
+            else:
+                content = str(callback) + '(' + str(resp.data) + ')'
             mimetype = 'application/javascript'
             return current_app.response_class(content, mimetype=mimetype)
         else:
             return func(*args, **kwargs)
     return decorated_function
 
+def page_args(args):
+    """
+    Return (offset, limit) from the request `args`.
+    """
+    try:
+        offset = int(args.get('offset', 0))
+        limit = args.get('limit')
+        if limit is not None:
+            limit = int(limit)
+    except ValueError:
+        raise UserError('Invalid offset or limit')
+    if offset < 0 or (limit is not None and limit < 0):
+        raise UserError('Invalid offset or limit')
+    return offset, limit
+
 @app.route('/check')
 @jsonp
 def list_layers():
@@ -45,9 +89,21 @@ def list_layers():
     if cap_url is None:
         return json_error_response('Missing url parameter for capabilities', status=400)
 
+    # only return this layer and its sub-layers (WMS only)
+    layer_name = request.args.get('layer')
+
     try:
-        cap = cap_dict(cap_url)
-        return jsonify(cap)
+        offset, limit = page_args(request.args)
+        fields = request.args.get('fields')
+        if fields:
+            fields = set(f.strip() for f in fields.split(','))
+        cap = cap_dict(cap_url, layer_name, offset=offset, limit=limit,
+            query=request.args.get('q'), fields=fields, lazy=True)
+        # build the first layer before the response starts, so that errors
+        # return an error status, stream the other layers as they are serialized
+        layers = iter(cap['layers'])
+        cap['layers'] = chain(list(islice(layers, 1)), layers)
+        return Response(iter_json(cap, 'layers'), mimetype='application/json')
     except (CapabilitiesError, UserError) as ex:
         log.debug(ex.system_msg)
         return json_error_response(ex.user_msg, status=400)
@@ -67,11 +123,13 @@ def add_layer():
 
     cap_url = request.args.get('url')
     layer_name = request.args.get('layer')
+    # comma separated list of layers for a single service
+    layer_names = request.args.get('layers')
 
     if cap_url is None:
         return json_error_response('Missing url parameter for capabilities', status=400)
 
-    if layer_name is None:
+    if layer_name is None and layer_names is None:
         return json_error_response('Missing layer parameter', status=400)
 
     if cap_type == 'wms':
@@ -83,17 +141,50 @@ def add_layer():
         if not system_id:
             return json_error_response('Missing matrix_set parameter', status=400)
 
+    options = {}
+    # comma separated list of output grids
+    if request.args.get('grids'):
+        options['grids'] = request.args.get('grids')
+    # image pipeline of the output caches, dimensions as request parameters, max-age of the tiles
+    for name in ('image', 'jpeg_quality', 'dimension_mode', 'expires_hours'):
+        if request.args.get(name):
+            options[name] = request.args.get(name)
+
     try:
-        if cap_type == 'wmts':
+        seed_levels = request.args.get('seed_levels')
+        if seed_levels:
+            seed_levels = parse_levels(seed_levels)
+            seed_bbox = request.args.get('seed_bbox')
+            if seed_bbox:
+                seed_bbox = parse_bbox(seed_bbox)
+            # fail before the layer is added
+            pool = seed_pool()
+
+        if layer_names is not None:
+            layer_names = [name for name in layer_names.split(',') if name]
+            if cap_type == 'wmts':
+                service_name = add_wmts_layers(cap_url, layer_names=layer_names, matrix_sets=system_id.split(','),
+                    csv_config_file=app.config.get('CSV_FILE'), options=options,
+                    writer_options=app.config.get('WRITER_OPTIONS'))
+            else:
+                service_name = add_wms_layers(cap_url, layer_names=layer_names, srs=system_id,
+                    csv_config_file=app.config.get('CSV_FILE'), options=options)
+        elif cap_type == 'wmts':
             dimensions = {}
             time = request.args.get('time')
             if time:
                 dimensions['time'] = time
             service_name = add_wmts_layer(cap_url, layer_name=layer_name, matrix_set=system_id,
                 csv_config_file=app.config.get('CSV_FILE'),
-                dimensions=dimensions)
+                dimensions=dimensions, options=options, writer_options=app.config.get('WRITER_OPTIONS'))
         else:
-            service_name = add_wms_layer(cap_url, layer_name=layer_name, srs=system_id, csv_config_file=app.config.get('CSV_FILE'))
+            service_name = add_wms_layer(cap_url, layer_name=layer_name, srs=system_id, csv_config_file=app.config.get('CSV_FILE'),
+                options=options)
+
+        if seed_levels:
+            job = pool.add(service_name, seed_levels, bbox=seed_bbox or None)
+            return jsonify({'mapproxy_id': service_name, 'seed': job.as_dict()})
+
         return jsonify({'mapproxy_id': service_name})
     except (CapabilitiesError, UserError) as ex:
         log.debug(ex.system_msg)
@@ -105,3 +196,18 @@ def add_layer():
         log.exception(ex)
         return json_error_response('internal server error')
 
+
+@app.route('/seed_status')
+@jsonp
+def seed_status():
+    try:
+        mapproxy_id = request.args.get('id')
+        if mapproxy_id is None:
+            return jsonify({'seeds': seed_pool().status()})
+        status = seed_pool().status(mapproxy_id)
+        if status is None:
+            return json_error_response('No seeding for "%s" found' % mapproxy_id, status=404)
+        return jsonify(status)
+    except ServiceError as ex:
+        log.debug(ex.system_msg)
+        return json_error_response(ex.user_msg)